@@ -7,6 +7,12 @@ from jpype import JImplements, JOverride, JImplementationFor
 
 import yaml
 
+from flask import Flask
+
+from apps.hbase import HBaseRegistry
+from apps.cache import ResultCache
+from apps.api.jobs import JobManager
+
 args = yaml.load(open('config.yml'), yaml.Loader)
 
 APIURL = args['APIURL']
@@ -38,6 +44,21 @@ app.title = 'Fink Science Portal'
 nlimit = 10000
 
 app.server.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024
+
+# Catalogs uploaded as files to /api/v1/xmatch are spooled to disk,
+# and can be larger than any other request body
+UPLOAD_LENGTH = args.get('UPLOAD_MBYTES', 2048) * 1024 * 1024
+
+class PortalRequest(Flask.request_class):
+    """ Request whose body limit is raised for catalog uploads only
+    """
+    @property
+    def max_content_length(self):
+        if self.path == '/api/v1/xmatch' and self.mimetype == 'multipart/form-data':
+            return UPLOAD_LENGTH
+        return super().max_content_length
+
+app.server.request_class = PortalRequest
 server = app.server
 
 app.config.suppress_callback_exceptions = True
@@ -53,46 +74,92 @@ from com.astrolabsoftware.FinkBrowser.Utils import Init
 
 Init.init()
 
-client = com.Lomikel.HBaser.HBaseClient(args['HBASEIP'], args['ZOOPORT']);
-client.connect(args['tablename'], args['SCHEMAVER'])
-
-clientT = com.Lomikel.HBaser.HBaseClient(args['HBASEIP'], args['ZOOPORT']);
-clientT.connect(args['tablename'] + ".jd", args['SCHEMAVER'])
-
-clientP128 = com.Lomikel.HBaser.HBaseClient(args['HBASEIP'], args['ZOOPORT']);
-clientP128.connect(args['tablename'] + ".pixel128", args['SCHEMAVER'])
-
-clientP4096 = com.Lomikel.HBaser.HBaseClient(args['HBASEIP'], args['ZOOPORT']);
-clientP4096.connect(args['tablename'] + ".pixel4096", args['SCHEMAVER'])
-
-clientP131072 = com.Lomikel.HBaser.HBaseClient(args['HBASEIP'], args['ZOOPORT']);
-clientP131072.connect(args['tablename'] + ".pixel131072", args['SCHEMAVER'])
-
-clientS = com.Lomikel.HBaser.HBaseClient(args['HBASEIP'], args['ZOOPORT']);
-clientS.connect(args['tablename'] + ".class", args['SCHEMAVER'])
-
-clientU = com.Lomikel.HBaser.HBaseClient(args['HBASEIP'], args['ZOOPORT']);
-clientU.connect(args['tablename'] + ".upper", args['SCHEMAVER'])
-
-clientUV = com.Lomikel.HBaser.HBaseClient(args['HBASEIP'], args['ZOOPORT']);
-clientUV.connect(args['tablename'] + ".uppervalid", args['SCHEMAVER'])
-
-clientSSO = com.Lomikel.HBaser.HBaseClient(args['HBASEIP'], args['ZOOPORT']);
-clientSSO.connect(args['tablename'] + ".ssnamenr", args['SCHEMAVER'])
-
-clientTRCK = com.Lomikel.HBaser.HBaseClient(args['HBASEIP'], args['ZOOPORT']);
-clientTRCK.connect(args['tablename'] + ".tracklet", args['SCHEMAVER'])
-
-clientTNS = com.Lomikel.HBaser.HBaseClient(args['HBASEIP'], args['ZOOPORT']);
-clientTNS.connect(args['tablename'] + ".tns", args['SCHEMAVER'])
+# Maximum number of concurrent range scans per request (pixel index tables)
+SCAN_THREADS = args.get('SCAN_THREADS', 4)
+
+# Tables whose scans return at most `nlimit` rows. Index tables (pixel,
+# upper limits) and statistics are not limited: truncating them would
+# silently drop results.
+LIMITED_TABLES = ['', '.jd', '.class', '.tns', '.ssnamenr', '.tracklet', '.sso_cand', '.orb_cand']
+
+# One pool of clients per table. Each request borrows its own client,
+# so that scan settings (limit, range scan, ...) never leak between requests.
+# Tables are connected the first time they are used.
+# Concurrent scans of all requests run on SCAN_WORKERS long-lived threads.
+registry = HBaseRegistry(
+    args['HBASEIP'], args['ZOOPORT'], args['SCHEMAVER'],
+    size=args.get('POOLSIZE', 4),
+    limits={
+        args['tablename'] + suffix: nlimit
+        for suffix in LIMITED_TABLES
+    },
+    nthreads=args.get('SCAN_WORKERS', 4 * SCAN_THREADS)
+)
 
-clientStats = com.Lomikel.HBaser.HBaseClient(args['HBASEIP'], args['ZOOPORT']);
-clientStats.connect('statistics_class', args['SCHEMAVER'])
+client = registry[args['tablename']]
+clientT = registry[args['tablename'] + ".jd"]
+clientP128 = registry[args['tablename'] + ".pixel128"]
+clientP4096 = registry[args['tablename'] + ".pixel4096"]
+clientP131072 = registry[args['tablename'] + ".pixel131072"]
+clientS = registry[args['tablename'] + ".class"]
+clientU = registry[args['tablename'] + ".upper"]
+clientUV = registry[args['tablename'] + ".uppervalid"]
+clientSSO = registry[args['tablename'] + ".ssnamenr"]
+clientTRCK = registry[args['tablename'] + ".tracklet"]
+clientTNS = registry[args['tablename'] + ".tns"]
+clientStats = registry['statistics_class']
+clientSSOCAND = registry[args['tablename'] + ".sso_cand"]
+clientSSOORB = registry[args['tablename'] + ".orb_cand"]
+
+# HEALPix ordering of the pixel index tables: `ring` (one key per pixel),
+# or `nested` (zero-padded keys, read by range scans).
+# See docs/pixel_index_migration.md
+PIXEL_ORDERING = args.get('PIXEL_ORDERING', 'ring')
+clientP128N = registry[args['tablename'] + ".pixel128_nested"]
+clientP4096N = registry[args['tablename'] + ".pixel4096_nested"]
+clientP131072N = registry[args['tablename'] + ".pixel131072_nested"]
+
+# Number of rows of an uploaded catalog crossmatched at once (/api/v1/xmatch)
+XMATCH_CHUNKSIZE = args.get('XMATCH_CHUNKSIZE', 10000)
+
+# Object data (alerts never change, objects only gain new alerts).
+# Entries are revalidated against the latest alert of the object.
+object_cache = ResultCache(
+    max_entries=args.get('CACHE_ENTRIES', 256),
+    max_bytes=args.get('CACHE_MBYTES', 512) * 1024**2,
+    name='objects'
+)
 
-clientSSOCAND = com.Lomikel.HBaser.HBaseClient(args['HBASEIP'], args['ZOOPORT']);
-clientSSOCAND.connect(args['tablename'] + ".sso_cand", args['SCHEMAVER'])
+# GW sky maps (/api/v1/bayestar): maximum HEALPix order of the credible regions,
+# maximum fraction of a pixel index cell outside the region, and maximum number
+# of scans a cell can be split into (nested tables only, see
+# `apps.healpix.multi_order_ranges`)
+SKYMAP_MAX_ORDER = args.get('SKYMAP_MAX_ORDER', 9)
+BAYESTAR_OVERFETCH = args.get('BAYESTAR_OVERFETCH', 0.2)
+BAYESTAR_MAX_SPLIT = args.get('BAYESTAR_MAX_SPLIT', 16)
+
+# Credible-level maps of GW sky maps (/api/v1/bayestar), per sky map content
+skymap_cache = ResultCache(
+    max_entries=args.get('SKYMAP_CACHE_ENTRIES', 64),
+    max_bytes=args.get('SKYMAP_CACHE_MBYTES', 256) * 1024**2,
+    name='skymaps'
+)
 
-clientSSOORB = com.Lomikel.HBaser.HBaseClient(args['HBASEIP'], args['ZOOPORT']);
-clientSSOORB.connect(args['tablename'] + ".orb_cand", args['SCHEMAVER'])
+# Background execution of heavy queries (`async` option of the API).
+# Status and results are shared on disk between server processes.
+job_manager = JobManager(
+    args.get('JOBS_DIR', '/tmp/fink_jobs'),
+    nthreads=args.get('JOBS_THREADS', 2),
+    max_pending=args.get('JOBS_PENDING', 16),
+    ttl=args.get('JOBS_TTL', 24) * 3600
+)
 
-client.setLimit(nlimit);
+# Optionally connect the most used tables at startup
+# (names are relative to the configured table, e.g. '{tablename}.jd')
+warmup_tables = [
+    name.format(tablename=args['tablename'])
+    for name in args.get('WARMUP', None) or []
+]
+if len(warmup_tables) > 0:
+    registry.warmup(warmup_tables)
+    print(registry.format_report())
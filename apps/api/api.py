@@ -16,9 +16,12 @@ from dash import dcc, html
 import dash_bootstrap_components as dbc
 import dash_mantine_components as dmc
 
-from flask import request, jsonify, Response
+from flask import request, jsonify, Response, g, make_response, send_file
+from flask import stream_with_context
 
 from app import APIURL
+from app import object_cache, skymap_cache
+from app import job_manager
 
 from apps.api.doc import api_doc_summary, api_doc_object, api_doc_explorer
 from apps.api.doc import api_doc_latests, api_doc_sso, api_doc_tracklets
@@ -29,15 +32,24 @@ from apps.api.utils import return_object_pdf, return_explorer_pdf
 from apps.api.utils import return_latests_pdf, return_sso_pdf
 from apps.api.utils import return_ssocand_pdf
 from apps.api.utils import return_tracklet_pdf, format_and_send_cutout
-from apps.api.utils import perform_xmatch, return_bayestar_pdf
+from apps.api.utils import return_bayestar_pdf
 from apps.api.utils import return_statistics_pdf, send_data
 from apps.api.utils import return_random_pdf
+from apps.api.utils import object_etag, sso_etag
+
+from apps.api.compression import compress_response
+from apps.api.serializers import FRAME_STREAMERS
+from apps.api.xmatch import perform_xmatch, parse_xmatch_args, stream_xmatch
 
 from fink_utils.xmatch.simbad import get_simbad_labels
 
 import io
+import json
+import itertools
 import requests
 
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 import numpy as np
 
@@ -48,6 +60,172 @@ from flask import Blueprint
 
 api_bp = Blueprint('', __name__)
 
+@api_bp.after_request
+def add_server_timing(response):
+    """ Report the duration of HBase scans in the `Server-Timing` header
+    """
+    timings = g.get('scan_timings', [])
+    if len(timings) > 0:
+        response.headers['Server-Timing'] = ', '.join(
+            [
+                'scan{};dur={:.1f};desc="{} ({} keys, {} rows)"'.format(
+                    index, timing['duration'] * 1000, timing['table'],
+                    timing['nkeys'], timing.get('nrows', '?')
+                ) for index, timing in enumerate(timings)
+            ]
+        )
+    return response
+
+@api_bp.after_request
+def add_cache_status(response):
+    """ Report whether the result was served from the cache in the `X-Cache` header
+    """
+    status = g.get('cache_status', None)
+    if status is not None:
+        response.headers['X-Cache'] = status.upper()
+    return response
+
+@api_bp.after_request
+def add_row_counts(response):
+    """ Report the number of index rows read, and of rows sent back
+
+    See `apps.api.utils.record_row_counts`
+    """
+    if 'rows_scanned' in g:
+        response.headers['X-Rows-Scanned'] = str(g.rows_scanned)
+        response.headers['X-Rows-Returned'] = str(g.rows_returned)
+    return response
+
+@api_bp.after_request
+def add_compression(response):
+    """ Compress large responses, according to the `Accept-Encoding` of the request
+
+    See `apps.api.compression.compress_response`
+    """
+    return compress_response(
+        response, request.headers.get('Accept-Encoding', '')
+    )
+
+def not_modified(etag: str) -> Response:
+    """ Empty 304 response, for conditional requests whose data did not change
+    """
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    return response
+
+def with_etag(response, etag: str) -> Response:
+    """ Attach an entity tag to a successful response
+
+    Tags are weak: the payload can be compressed differently.
+    """
+    response = make_response(response)
+    if response.status_code == 200:
+        response.set_etag(etag, weak=True)
+    return response
+
+def check_required_args(payload: dict, args: list):
+    """ Check that all required arguments of an endpoint are in the payload
+
+    Parameters
+    ----------
+    payload: dict
+        Arguments of the request
+    args: list of dict
+        Arguments of the endpoint, e.g. `args_objects`
+
+    Returns
+    ----------
+    out: flask.Response or None
+        Error response if an argument is missing, None otherwise
+    """
+    required_args = [i['name'] for i in args if i['required'] is True]
+    for required_arg in required_args:
+        if required_arg not in payload:
+            rep = {
+                'status': 'error',
+                'text': "A value for `{}` is required. Use GET to check arguments.\n".format(required_arg)
+            }
+            return Response(str(rep), 400)
+    return None
+
+def check_explorer_args(payload: dict):
+    """ Find the group of arguments of an explorer query, and check it is complete
+
+    Parameters
+    ----------
+    payload: dict
+        Arguments of the request
+
+    Returns
+    ----------
+    out: int or flask.Response
+        Group of the query, or error response
+    """
+    # Check the user specifies only one group
+    all_groups = [i['group'] for i in args_explorer if i['group'] is not None and i['name'] in payload]
+    if len(np.unique(all_groups)) != 1:
+        rep = {
+            'status': 'error',
+            'text': "You need to set parameters from the same group\n"
+        }
+        return Response(str(rep), 400)
+
+    # Check the user specifies all parameters within a group
+    user_group = np.unique(all_groups)[0]
+    required_args = [i['name'] for i in args_explorer if i['group'] == user_group]
+    required = [i['required'] for i in args_explorer if i['group'] == user_group]
+    for required_arg, required_ in zip(required_args, required):
+        if (required_arg not in payload) and required_:
+            rep = {
+                'status': 'error',
+                'text': "A value for `{}` is required for group {}. Use GET to check arguments.\n".format(required_arg, user_group)
+            }
+            return Response(str(rep), 400)
+
+    return user_group
+
+def is_async(payload: dict) -> bool:
+    """ Whether the user asks to run the query in the background
+    """
+    return str(payload.get('async', False)).lower() in ['true', '1', 'yes']
+
+def submit_job(kind: str, function, payload: dict):
+    """ Run a query in the background, and tell the user where to find it
+
+    Parameters
+    ----------
+    kind: str
+        Name of the endpoint
+    function: callable
+        Called as `function(payload, progress)`, returns a DataFrame
+        or an error response
+    payload: dict
+        Arguments of the request
+
+    Returns
+    ----------
+    out: flask.Response
+        Job id and status URL (202), or error if too many jobs are pending (503)
+    """
+    # request.args cannot be used outside of the request
+    payload = {key: payload[key] for key in payload}
+
+    jobid = job_manager.submit(
+        kind, lambda progress: function(payload, progress)
+    )
+    if jobid is None:
+        rep = {
+            'status': 'error',
+            'text': "Too many jobs are running. Try again later.\n"
+        }
+        return Response(str(rep), 503)
+
+    url = '{}/api/v1/jobs/{}'.format(APIURL, jobid)
+    response = jsonify({'id': jobid, 'status': 'queued', 'url': url})
+    response.status_code = 202
+    response.headers['Location'] = url
+    return response
+
 def layout(is_mobile):
     if is_mobile:
         width = '95%'
@@ -231,7 +409,7 @@ args_objects = [
     {
         'name': 'output-format',
         'required': False,
-        'description': 'Output format among json[default], csv, parquet, votable'
+        'description': 'Output format among json[default], ndjson, csv, parquet, arrow, votable'
     }
 ]
 
@@ -284,11 +462,23 @@ args_explorer = [
         'group': 2,
         'description': 'Time window in minutes. Maximum is 180 minutes.'
     },
+    {
+        'name': 'columns',
+        'required': False,
+        'group': None,
+        'description': 'Comma-separated data columns to transfer. Default is all columns. See {}/api/v1/columns for more information.'.format(APIURL)
+    },
     {
         'name': 'output-format',
         'required': False,
         'group': None,
-        'description': 'Output format among json[default], csv, parquet, votable'
+        'description': 'Output format among json[default], ndjson, csv, parquet, arrow, votable'
+    },
+    {
+        'name': 'async',
+        'required': False,
+        'group': None,
+        'description': 'If true, run the query in the background and return a job id immediately. The status and result of the job are available at {}/api/v1/jobs/<id>. Default is false.'.format(APIURL)
     }
 ]
 
@@ -321,7 +511,12 @@ args_latest = [
     {
         'name': 'output-format',
         'required': False,
-        'description': 'Output format among json[default], csv, parquet, votable'
+        'description': 'Output format among json[default], ndjson, csv, parquet, arrow, votable'
+    },
+    {
+        'name': 'async',
+        'required': False,
+        'description': 'If true, run the query in the background and return a job id immediately. The status and result of the job are available at {}/api/v1/jobs/<id>. Default is false.'.format(APIURL)
     }
 ]
 
@@ -344,7 +539,7 @@ args_sso = [
     {
         'name': 'output-format',
         'required': False,
-        'description': 'Output format among json[default], csv, parquet, votable'
+        'description': 'Output format among json[default], ndjson, csv, parquet, arrow, votable'
     }
 ]
 
@@ -362,7 +557,7 @@ args_tracklet = [
     {
         'name': 'output-format',
         'required': False,
-        'description': 'Output format among json[default], csv, parquet, votable'
+        'description': 'Output format among json[default], ndjson, csv, parquet, arrow, votable'
     }
 ]
 
@@ -418,7 +613,7 @@ args_xmatch = [
     {
         'name': 'catalog',
         'required': True,
-        'description': 'External catalog as CSV'
+        'description': 'External catalog as CSV. Large catalogs can be uploaded as a CSV or parquet file instead (multipart/form-data), in which case matches are streamed back by chunks.'
     },
     {
         'name': 'header',
@@ -435,23 +630,38 @@ args_xmatch = [
         'required': False,
         'description': '[Optional] Time window in days.'
     },
+    {
+        'name': 'output-format',
+        'required': False,
+        'description': 'Output format among json[default], ndjson, csv, parquet, arrow, votable'
+    },
+    {
+        'name': 'async',
+        'required': False,
+        'description': 'If true, run the query in the background and return a job id immediately. The status and result of the job are available at {}/api/v1/jobs/<id>. Default is false.'.format(APIURL)
+    },
 ]
 
 args_bayestar = [
     {
         'name': 'bayestar',
         'required': True,
-        'description': 'LIGO/Virgo probability sky maps, as gzipped FITS (bayestar.fits.gz)'
+        'description': 'LIGO/Virgo probability sky maps, as gzipped FITS (bayestar.fits.gz). Either uploaded as a file (multipart/form-data), or base64 encoded in the JSON payload. `str(data)` of the file content is also accepted.'
     },
     {
         'name': 'credible_level',
         'required': True,
         'description': 'GW credible region threshold to look for. Note that the values in the resulting credible level map vary inversely with probability density: the most probable pixel is assigned to the credible level 0.0, and the least likely pixel is assigned the credible level 1.0.'
     },
+    {
+        'name': 'columns',
+        'required': False,
+        'description': 'Comma-separated data columns to transfer. Default is all columns. See {}/api/v1/columns for more information.'.format(APIURL)
+    },
     {
         'name': 'output-format',
         'required': False,
-        'description': 'Output format among json[default], csv, parquet'
+        'description': 'Output format among json[default], ndjson, csv, parquet, arrow'
     }
 ]
 
@@ -469,7 +679,7 @@ args_stats = [
     {
         'name': 'output-format',
         'required': False,
-        'description': 'Output format among json[default], csv, parquet, votable'
+        'description': 'Output format among json[default], ndjson, csv, parquet, arrow, votable'
     }
 ]
 
@@ -497,7 +707,7 @@ args_random = [
     {
         'name': 'output-format',
         'required': False,
-        'description': 'Output format among json[default], csv, parquet, votable'
+        'description': 'Output format among json[default], ndjson, csv, parquet, arrow, votable'
     }
 ]
 
@@ -525,10 +735,46 @@ args_ssocand = [
     {
         'name': 'output-format',
         'required': False,
-        'description': 'Output format among json[default], csv, parquet, votable'
+        'description': 'Output format among json[default], ndjson, csv, parquet, arrow, votable'
     }
 ]
 
+def explorer_pdf(payload: dict):
+    """ Explorer query, with the checks of /api/v1/explorer
+    """
+    user_group = check_explorer_args(payload)
+
+    # Error propagation
+    if isinstance(user_group, Response):
+        return user_group
+
+    return return_explorer_pdf(payload, user_group)
+
+# Sub-queries accepted by /api/v1/batch: endpoint -> (arguments, function)
+BATCH_ENDPOINTS = {
+    'objects': (args_objects, return_object_pdf),
+    'explorer': ([], explorer_pdf),
+    'latests': (args_latest, return_latests_pdf),
+    'sso': (args_sso, return_sso_pdf),
+    'ssocand': (args_ssocand, return_ssocand_pdf),
+    'tracklet': (args_tracklet, return_tracklet_pdf),
+}
+
+# Maximum number of sub-queries per batch, and number run concurrently
+BATCH_MAX_QUERIES = 100
+BATCH_THREADS = 4
+
+# Sub-queries of all batches run on the same long-lived threads
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_THREADS)
+
+args_batch = [
+    {
+        'name': 'queries',
+        'required': True,
+        'description': 'List of sub-queries. Each sub-query is a dictionary with keys `id` (optional, default is the position in the list), `endpoint` (among {}) and `payload` (arguments of the endpoint, as for a single query). At most {} sub-queries per batch.'.format(', '.join(BATCH_ENDPOINTS), BATCH_MAX_QUERIES)
+    },
+]
+
 @api_bp.route('/api/v1/objects', methods=['GET'])
 def return_object_arguments():
     """ Obtain information about retrieving object data
@@ -557,6 +803,11 @@ def return_object(payload=None):
             }
             return Response(str(rep), 400)
 
+    # Conditional request: nothing new since the client last fetched it
+    etag = object_etag(payload)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+
     pdf = return_object_pdf(payload)
 
     # Error propagation
@@ -564,7 +815,18 @@ def return_object(payload=None):
         return pdf
 
     output_format = payload.get('output-format', 'json')
-    return send_data(pdf, output_format)
+    return with_etag(send_data(pdf, output_format), etag)
+
+@api_bp.route('/api/v1/cache', methods=['GET'])
+def return_cache_statistics():
+    """ Statistics of the result caches of this server process
+    """
+    return jsonify(
+        {
+            'objects': object_cache.report(),
+            'skymaps': skymap_cache.report()
+        }
+    )
 
 @api_bp.route('/api/v1/explorer', methods=['GET'])
 def query_db_arguments():
@@ -584,26 +846,18 @@ def query_db(payload=None):
     if payload is None:
         payload = request.json
 
-    # Check the user specifies only one group
-    all_groups = [i['group'] for i in args_explorer if i['group'] is not None and i['name'] in payload]
-    if len(np.unique(all_groups)) != 1:
-        rep = {
-            'status': 'error',
-            'text': "You need to set parameters from the same group\n"
-        }
-        return Response(str(rep), 400)
+    user_group = check_explorer_args(payload)
 
-    # Check the user specifies all parameters within a group
-    user_group = np.unique(all_groups)[0]
-    required_args = [i['name'] for i in args_explorer if i['group'] == user_group]
-    required = [i['required'] for i in args_explorer if i['group'] == user_group]
-    for required_arg, required_ in zip(required_args, required):
-        if (required_arg not in payload) and required_:
-            rep = {
-                'status': 'error',
-                'text': "A value for `{}` is required for group {}. Use GET to check arguments.\n".format(required_arg, user_group)
-            }
-            return Response(str(rep), 400)
+    # Error propagation
+    if isinstance(user_group, Response):
+        return user_group
+
+    if is_async(payload):
+        return submit_job(
+            'explorer',
+            lambda payload, progress: return_explorer_pdf(payload, user_group, progress=progress),
+            payload
+        )
 
     pdfs = return_explorer_pdf(payload, user_group)
 
@@ -642,6 +896,13 @@ def latest_objects(payload=None):
             }
             return Response(str(rep), 400)
 
+    if is_async(payload):
+        return submit_job(
+            'latests',
+            lambda payload, progress: return_latests_pdf(payload, progress=progress),
+            payload
+        )
+
     pdfs = return_latests_pdf(payload)
 
     # Error propagation
@@ -756,6 +1017,12 @@ def columns_arguments():
             {'name': 'classification', 'type': 'string', 'doc': 'Fink inferred classification. See https://fink-portal.org/api/v1/classes'},
             {'name': 'g-r', 'type': 'double', 'doc': 'Last g-r measurement for this object.'},
             {'name': 'rate(g-r)', 'type': 'double', 'doc': 'g-r rate in mag/day (between last and first available g-r measurements).'},
+            {'name': 'dg', 'type': 'double', 'doc': 'Difference of DC magnitude with the previous measurement in the g band.'},
+            {'name': 'rate(dg)', 'type': 'double', 'doc': 'dg rate in mag/day.'},
+            {'name': 'dr', 'type': 'double', 'doc': 'Difference of DC magnitude with the previous measurement in the r band.'},
+            {'name': 'rate(dr)', 'type': 'double', 'doc': 'dr rate in mag/day.'},
+            {'name': 'dcmag', 'type': 'double', 'doc': 'DC magnitude of the alert. Only computed when explicitly requested.'},
+            {'name': 'dcmag_err', 'type': 'double', 'doc': 'Error on the DC magnitude of the alert. Only computed when explicitly requested.'},
             {'name': 'lastdate', 'type': 'string', 'doc': 'Human readable datetime for the alert (from the i:jd field).'},
             {'name': 'firstdate', 'type': 'string', 'doc': 'Human readable datetime for the first detection of the object (from the i:jdstarthist field).'},
             {'name': 'lapse', 'type': 'string', 'doc': 'Number of days between first and last detection.'},
@@ -794,10 +1061,15 @@ def return_sso(payload=None):
     if payload is None:
         payload = request.json
 
+    # Conditional request: nothing new since the client last fetched it
+    etag = sso_etag(payload)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+
     pdf = return_sso_pdf(payload)
 
     output_format = payload.get('output-format', 'json')
-    return send_data(pdf, output_format)
+    return with_etag(send_data(pdf, output_format), etag)
 
 @api_bp.route('/api/v1/ssocand', methods=['GET'])
 def return_ssocand_arguments():
@@ -895,11 +1167,140 @@ def xmatch_arguments():
 def xmatch_user(payload=None):
     """ Xmatch with user uploaded catalog
     """
+    # Catalog uploaded as a file
+    if payload is None and 'catalog' in request.files:
+        return xmatch_upload()
+
     # get payload from the JSON
     if payload is None:
         payload = request.json
 
-    return perform_xmatch(payload)
+    error = check_required_args(payload, args_xmatch)
+    if error is not None:
+        return error
+
+    if is_async(payload):
+        return submit_job('xmatch', perform_xmatch, payload)
+
+    pdf = perform_xmatch(payload)
+
+    # Error propagation
+    if isinstance(pdf, Response):
+        return pdf
+
+    output_format = payload.get('output-format', 'json')
+    return send_data(pdf, output_format)
+
+def xmatch_upload():
+    """ Xmatch with a catalog uploaded as a file (multipart/form-data)
+
+    The catalog (CSV or parquet) is read and crossmatched by chunks of rows,
+    and the matches of each chunk are streamed back as soon as they are ready.
+    Other arguments are form fields.
+    """
+    payload = request.form.to_dict()
+    payload['catalog'] = request.files['catalog']
+
+    error = check_required_args(payload, args_xmatch)
+    if error is not None:
+        return error
+
+    if is_async(payload):
+        rep = {
+            'status': 'error',
+            'text': "Uploaded catalogs are streamed, and cannot be crossmatched asynchronously. Send the catalog in the JSON payload instead.\n"
+        }
+        return Response(str(rep), 400)
+
+    output_format = payload.get('output-format', 'json')
+    if output_format not in FRAME_STREAMERS:
+        rep = {
+            'status': 'error',
+            'text': "Output format `{}` is not supported for uploaded catalogs. Choose among {}\n".format(
+                output_format, ', '.join(FRAME_STREAMERS.keys())
+            )
+        }
+        return Response(str(rep), 400)
+
+    args = parse_xmatch_args(payload)
+    if isinstance(args, Response):
+        return args
+
+    # Errors in the first chunk are reported as usual. Later errors
+    # interrupt the response, which has already started.
+    frames = stream_xmatch(payload['catalog'].stream, *args)
+    try:
+        first = next(frames)
+    except ValueError as e:
+        rep = {
+            'status': 'error',
+            'text': e
+        }
+        return Response(str(rep), 400)
+
+    serializer, mimetype = FRAME_STREAMERS[output_format]
+    return Response(
+        stream_with_context(serializer(itertools.chain([first], frames))),
+        mimetype=mimetype
+    )
+
+@api_bp.route('/api/v1/jobs/<jobid>', methods=['GET'])
+def job_status(jobid):
+    """ Status and progress of an asynchronous query
+    """
+    status = job_manager.status(jobid)
+    if status is None:
+        rep = {
+            'status': 'error',
+            'text': "Job `{}` does not exist, or has expired.\n".format(jobid)
+        }
+        return Response(str(rep), 404)
+
+    if status['status'] == 'done':
+        status['result'] = '{}/api/v1/jobs/{}/result'.format(APIURL, jobid)
+
+    return jsonify(status)
+
+@api_bp.route('/api/v1/jobs/<jobid>/result', methods=['GET'])
+def job_result(jobid):
+    """ Result of a finished asynchronous query
+    """
+    status = job_manager.status(jobid)
+    if status is None:
+        rep = {
+            'status': 'error',
+            'text': "Job `{}` does not exist, or has expired.\n".format(jobid)
+        }
+        return Response(str(rep), 404)
+
+    if status['status'] != 'done':
+        rep = {
+            'status': 'error',
+            'text': "Job `{}` is {}: {}\n".format(jobid, status['status'], status['error'] or 'no result yet')
+        }
+        return Response(str(rep), 409)
+
+    output_format = request.args.get('output-format', 'json')
+
+    # The result can expire (or be purged by another process) meanwhile
+    try:
+        if output_format == 'parquet':
+            # Results are stored in parquet: no need to serialize them again
+            path = job_manager.result_path(jobid)
+            if path is not None:
+                return send_file(path, mimetype='application/octet-stream')
+        else:
+            pdf = job_manager.result(jobid)
+            if pdf is not None:
+                return send_data(pdf, output_format)
+    except OSError:
+        pass
+
+    rep = {
+        'status': 'error',
+        'text': "The result of job `{}` has expired.\n".format(jobid)
+    }
+    return Response(str(rep), 410)
 
 @api_bp.route('/api/v1/bayestar', methods=['GET'])
 def query_bayestar_arguments():
@@ -915,6 +1316,11 @@ def query_bayestar_arguments():
 def query_bayestar(payload=None):
     """ Query the Fink database to find alerts inside a GW localization map
     """
+    # Sky map uploaded as a file
+    if payload is None and 'bayestar' in request.files:
+        payload = request.form.to_dict()
+        payload['bayestar'] = request.files['bayestar'].read()
+
     # get payload from the JSON
     if payload is None:
         payload = request.json
@@ -987,3 +1393,109 @@ def return_random(payload=None):
 
     output_format = payload.get('output-format', 'json')
     return send_data(pdf, output_format)
+
+def run_subquery(endpoint: str, payload: dict):
+    """ Run a sub-query of /api/v1/batch
+
+    Parameters
+    ----------
+    endpoint: str
+        Name of the endpoint, see `BATCH_ENDPOINTS`
+    payload: dict
+        Arguments of the endpoint
+
+    Returns
+    ----------
+    out: pd.DataFrame or flask.Response
+        Data, or error response
+    """
+    if endpoint not in BATCH_ENDPOINTS:
+        rep = {
+            'status': 'error',
+            'text': "Endpoint `{}` is not supported in batch. Choose among {}\n".format(endpoint, ', '.join(BATCH_ENDPOINTS))
+        }
+        return Response(str(rep), 400)
+
+    args, function = BATCH_ENDPOINTS[endpoint]
+    error = check_required_args(payload, args)
+    if error is not None:
+        return error
+
+    return function(payload)
+
+def format_subquery(future) -> str:
+    """ JSON result of a sub-query: data as records, or error message
+    """
+    try:
+        result = future.result()
+    except Exception as e:
+        return json.dumps({'status': 'error', 'text': '{}: {}'.format(type(e).__name__, e)})
+
+    if isinstance(result, Response):
+        return json.dumps({'status': 'error', 'text': result.get_data(as_text=True)})
+
+    return '{{"status": "ok", "data": {}}}'.format(result.to_json(orient='records'))
+
+@api_bp.route('/api/v1/batch', methods=['GET'])
+def batch_arguments():
+    """ Obtain information about batch queries
+    """
+    return jsonify({'args': args_batch})
+
+@api_bp.route('/api/v1/batch', methods=['POST'])
+def batch_query(payload=None):
+    """ Run several queries at once, and return their results keyed by id
+    """
+    # get payload from the JSON
+    if payload is None:
+        payload = request.json
+
+    queries = payload.get('queries', None)
+    if not isinstance(queries, list) or len(queries) == 0:
+        rep = {
+            'status': 'error',
+            'text': "`queries` must be a non-empty list of sub-queries. Use GET to check arguments.\n"
+        }
+        return Response(str(rep), 400)
+
+    if len(queries) > BATCH_MAX_QUERIES:
+        rep = {
+            'status': 'error',
+            'text': "At most {} sub-queries per batch ({} given)\n".format(BATCH_MAX_QUERIES, len(queries))
+        }
+        return Response(str(rep), 400)
+
+    if not all([isinstance(query, dict) for query in queries]):
+        rep = {
+            'status': 'error',
+            'text': "Each sub-query must be a dictionary with keys `id`, `endpoint` and `payload`\n"
+        }
+        return Response(str(rep), 400)
+
+    ids = [str(query.get('id', index)) for index, query in enumerate(queries)]
+    if len(set(ids)) != len(ids):
+        rep = {
+            'status': 'error',
+            'text': "Sub-query ids must be unique\n"
+        }
+        return Response(str(rep), 400)
+
+    # Sub-queries run concurrently, each on clients borrowed from the pools
+    futures = [
+        batch_executor.submit(run_subquery, query.get('endpoint'), query.get('payload', {}))
+        for query in queries
+    ]
+
+    def stream():
+        """ Send results in order, as soon as each one is ready
+        """
+        yield '{'
+        for index, (id_, future) in enumerate(zip(ids, futures)):
+            yield '{}{}: {}'.format(
+                ', ' if index > 0 else '',
+                json.dumps(id_),
+                format_subquery(future)
+            )
+        yield '}'
+
+    return Response(stream(), mimetype='application/json')
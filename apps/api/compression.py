@@ -0,0 +1,190 @@
+# Copyright 2022 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Content-negotiated compression of the REST API responses
+
+Streamed responses are compressed on the fly: only the first
+`COMPRESSION_THRESHOLD` bytes are buffered, to decide whether
+compressing is worth it.
+"""
+import gzip
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Responses smaller than this (in bytes) are sent as they are
+COMPRESSION_THRESHOLD = 10 * 1024
+
+# gzip level 6 is the usual speed/ratio trade-off, zstd 3 is its default
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Already compressed payloads
+SKIPPED_MIMETYPES = ['image/png', 'image/jpeg', 'application/gzip']
+
+def available_encodings() -> list:
+    """ Encodings supported by the server, by order of preference
+    """
+    if zstandard is not None:
+        return ['zstd', 'gzip']
+    return ['gzip']
+
+def negotiate_encoding(accept_encoding: str) -> str:
+    """ Choose an encoding from the `Accept-Encoding` header of a request
+
+    Parameters
+    ----------
+    accept_encoding: str
+        Value of the header, e.g. `gzip, deflate, br;q=0.9, zstd`
+
+    Returns
+    ----------
+    encoding: str
+        `zstd` or `gzip`, or None if the client accepts neither
+    """
+    accepted = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        name = parts[0].strip().lower()
+        if name == '':
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+
+    candidates = [
+        encoding for encoding in available_encodings()
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0
+    ]
+    if len(candidates) == 0:
+        return None
+
+    # Highest quality first, server preference for ties
+    return max(
+        candidates,
+        key=lambda encoding: accepted.get(encoding, accepted.get('*', 0.0))
+    )
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """ Compress a payload in one go
+    """
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+def compress_stream(chunks, encoding: str):
+    """ Compress an iterable of bytes on the fly
+
+    Each chunk is flushed, so that the client can decode
+    the data as soon as it arrives.
+
+    Parameters
+    ----------
+    chunks: iterable of bytes
+        Payload
+    encoding: str
+        `zstd` or `gzip`
+
+    Returns
+    ----------
+    out: generator of bytes
+        Compressed payload
+    """
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+    else:
+        # wbits=31: gzip container
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        flush_mode = zlib.Z_SYNC_FLUSH
+
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        out = compressor.compress(chunk) + compressor.flush(flush_mode)
+        if len(out) > 0:
+            yield out
+
+    yield compressor.flush()
+
+def compress_response(response, accept_encoding: str, threshold: int = COMPRESSION_THRESHOLD):
+    """ Compress a Flask response according to the `Accept-Encoding` of the request
+
+    Responses that are not successful, already encoded, sent from
+    files, of an already compressed type, or smaller than `threshold`
+    are returned untouched.
+
+    Parameters
+    ----------
+    response: flask.Response
+        Response to compress
+    accept_encoding: str
+        Value of the `Accept-Encoding` header of the request
+    threshold: int
+        Minimum size in bytes for a response to be compressed
+
+    Returns
+    ----------
+    response: flask.Response
+    """
+    if response.status_code != 200 or response.direct_passthrough:
+        return response
+    if 'Content-Encoding' in response.headers or response.mimetype in SKIPPED_MIMETYPES:
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    encoding = negotiate_encoding(accept_encoding)
+    if encoding is None:
+        return response
+
+    if not response.is_streamed:
+        data = response.get_data()
+        if len(data) < threshold:
+            return response
+        response.set_data(compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    # Streamed: buffer until the threshold is reached, or the stream ends
+    chunks = response.iter_encoded()
+    head = []
+    size = 0
+    for chunk in chunks:
+        head.append(chunk)
+        size += len(chunk)
+        if size >= threshold:
+            break
+    else:
+        # Small stream, entirely read
+        response.set_data(b''.join(head))
+        return response
+
+    def payload():
+        yield from head
+        yield from chunks
+
+    response.response = compress_stream(payload(), encoding)
+    response.headers['Content-Encoding'] = encoding
+    response.headers.pop('Content-Length', None)
+    return response
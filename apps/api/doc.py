@@ -36,9 +36,88 @@ api_doc_summary = """
 | POST/GET | {}/api/v1/bayestar | Cross-match LIGO/Virgo sky map with Fink alert data| &#x2611;&#xFE0F; |
 | POST/GET | {}/api/v1/statistics | Statistics concerning Fink alert data| &#x2611;&#xFE0F; |
 | POST/GET | {}/api/v1/random | Draw random objects from the Fink database| &#x2611;&#xFE0F; |
+| POST/GET | {}/api/v1/batch | Run several queries at once | &#x2611;&#xFE0F; |
 | GET  | {}/api/v1/classes  | Display all Fink derived classification | &#x2611;&#xFE0F; |
 | GET  | {}/api/v1/columns  | Display all available alert fields and their type | &#x2611;&#xFE0F; |
-""".format(APIURL, APIURL, APIURL, APIURL, APIURL, APIURL, APIURL, APIURL, APIURL, APIURL, APIURL, APIURL, APIURL)
+""".format(APIURL, APIURL, APIURL, APIURL, APIURL, APIURL, APIURL, APIURL, APIURL, APIURL, APIURL, APIURL, APIURL, APIURL)
+
+# Not formatted: code examples contain braces
+api_doc_summary += """
+## Compression
+
+Responses larger than 10 kB are compressed if the client accepts it (`Accept-Encoding` header),
+with zstd if available on the server, and gzip otherwise. Most clients (`requests`, `curl --compressed`,
+web browsers) handle it transparently.
+
+## Batch queries
+
+Instead of sending many small queries, you can send them at once to `/api/v1/batch`.
+Sub-queries (objects, explorer, latests, sso, ssocand, tracklet) run concurrently on the server,
+and the results are returned in JSON, keyed by sub-query id. Errors are reported per sub-query:
+
+```python
+r = requests.post(
+  'https://fink-portal.org/api/v1/batch',
+  json={
+    'queries': [
+      {'id': 'obj', 'endpoint': 'objects', 'payload': {'objectId': 'ZTF21aaxtctv', 'columns': 'i:jd,i:magpsf'}},
+      {'id': 'sso', 'endpoint': 'sso', 'payload': {'n_or_d': '8467'}},
+    ]
+  }
+)
+
+out = r.json()
+if out['obj']['status'] == 'ok':
+    pdf = pd.DataFrame(out['obj']['data'])
+```
+
+## Conditional requests
+
+Responses of `/api/v1/objects` and `/api/v1/sso` carry an `ETag` header. If you poll the same objects
+regularly, send it back in the `If-None-Match` header: if the objects did not get new alerts since,
+the server answers `304 Not Modified` with an empty body, and you can keep your previous data:
+
+```python
+r = requests.post('https://fink-portal.org/api/v1/objects', json={'objectId': 'ZTF21aaxtctv'})
+etag = r.headers['ETag']
+
+# later...
+r = requests.post(
+  'https://fink-portal.org/api/v1/objects',
+  json={'objectId': 'ZTF21aaxtctv'},
+  headers={'If-None-Match': etag}
+)
+if r.status_code == 304:
+    # nothing new
+    ...
+```
+
+## Asynchronous queries
+
+Large queries on `/api/v1/latests`, `/api/v1/explorer` and `/api/v1/xmatch` can take a while.
+Add `'async': True` to the arguments to run them in the background: the server immediately
+answers with a job id, and the URL where to follow the job. Results are kept for 24 hours:
+
+```python
+import time
+
+r = requests.post(
+  'https://fink-portal.org/api/v1/latests',
+  json={'class': 'Solar System MPC', 'n': '100000', 'async': True}
+)
+url = r.json()['url']
+
+# status is queued, running, done or failed, and progress goes from 0 to 1
+status = requests.get(url).json()
+while status['status'] in ['queued', 'running']:
+    time.sleep(5)
+    status = requests.get(url).json()
+
+# any output format, e.g. parquet
+r = requests.get(url + '/result', params={'output-format': 'parquet'})
+pdf = pd.read_parquet(io.BytesIO(r.content))
+```
+"""
 
 api_doc_object = """
 ## Retrieve object data
@@ -101,6 +180,45 @@ r = ...
 pd.read_csv(io.BytesIO(r.content))
 ```
 
+Data in `json`, `ndjson`, `csv` and `parquet` is streamed: you start receiving it
+before the whole response is serialized. For large requests, `ndjson` (one
+JSON record per line) lets you process records as they arrive:
+
+```python
+import json
+
+# get data for ZTF21aaxtctv in NDJSON format...
+r = requests.post(
+  'https://fink-portal.org/api/v1/objects',
+  json={
+    'objectId': 'ZTF21aaxtctv',
+    'output-format': 'ndjson'
+  },
+  stream=True
+)
+
+for line in r.iter_lines():
+    alert = json.loads(line)
+```
+
+If you process the data with pandas or pyarrow, prefer the `arrow` format
+(Arrow IPC stream): columns are sent in binary form, and there is no text to parse:
+
+```python
+import pyarrow as pa
+
+# get data for ZTF21aaxtctv in Arrow format...
+r = requests.post(
+  'https://fink-portal.org/api/v1/objects',
+  json={
+    'objectId': 'ZTF21aaxtctv',
+    'output-format': 'arrow'
+  }
+)
+
+pdf = pa.ipc.open_stream(r.content).read_pandas()
+```
+
 You can also get a votable:
 
 ```python
@@ -129,6 +247,21 @@ r = requests.post(
 
 Note that the fields should be comma-separated. Unknown field names are ignored.
 
+Fields added by Fink (`v:` prefix, e.g. `v:classification`, `v:lastdate`, `v:constellation`)
+can be selected as well. They are computed only when requested, from the fields they
+depend on -- which are not returned unless you also ask for them:
+
+```python
+# select only jd, and the Fink classification
+r = requests.post(
+  'https://fink-portal.org/api/v1/objects',
+  json={
+    'objectId': 'ZTF21aaxtctv',
+    'columns': 'i:jd,v:classification'
+  }
+)
+```
+
 ### Upper limits and bad quality data
 
 You can also retrieve upper limits and bad quality data (as defined by Fink quality cuts)
@@ -945,6 +1078,39 @@ Note that in case of several objects matching, the results will be sorted
 according to the column `v:separation_degree`, which is the angular separation
 in degree between the input (ra, dec) and the objects found.
 
+### Large catalogs
+
+Catalogs sent in the JSON payload are limited to 100 MB. Larger catalogs
+can be uploaded as a file, in CSV or parquet format, with the other arguments
+as form fields:
+
+```python
+import io
+import requests
+import pandas as pd
+
+r = requests.post(
+   'https://fink-portal.org/api/v1/xmatch',
+   files={'catalog': open('mycatalog.parquet', 'rb')},
+   data={
+       'header': 'RA,Dec,ID',
+       'radius': 1.5, # in arcsecond
+       'output-format': 'csv'
+   },
+   stream=True
+)
+
+# Format output in a DataFrame
+pdf = pd.read_csv(io.BytesIO(r.content))
+```
+
+The catalog is crossmatched by chunks of rows, and the matches of each chunk are
+sent as soon as they are found: the response starts before the whole catalog is
+processed, and matches follow the order of the catalog. Output formats are `json`
+(default), `ndjson` and `csv`. Use `ndjson` or `csv` to process matches while they
+arrive, e.g. with `r.iter_lines()`. Uploaded catalogs cannot be crossmatched
+asynchronously.
+
 """
 
 api_doc_bayestar = """
@@ -970,11 +1136,10 @@ fn = 'bayestar.fits.gz'
 credible_level = 0.2
 
 # Query Fink
-data = open(fn, 'rb').read()
 r = requests.post(
     'https://fink-portal.org/api/v1/bayestar',
-    json={
-        'bayestar': str(data),
+    files={'bayestar': open(fn, 'rb')},
+    data={
         'credible_level': credible_level,
         'output-format': 'json'
     }
@@ -983,6 +1148,32 @@ r = requests.post(
 pdf = pd.read_json(r.content)
 ```
 
+The sky map can also be sent in the JSON payload, base64 encoded:
+
+```python
+import base64
+
+data = open(fn, 'rb').read()
+r = requests.post(
+    'https://fink-portal.org/api/v1/bayestar',
+    json={
+        'bayestar': base64.b64encode(data).decode(),
+        'credible_level': credible_level,
+        'output-format': 'json'
+    }
+)
+```
+
+The credible levels of a sky map are computed once, and kept in memory: querying
+the same sky map again with another `credible_level` is faster (the `X-Cache`
+header of the response is `HIT`).
+
+The credible region is computed at the resolution of the sky map, and only alerts
+inside it are returned. To find them, the region is covered with pixels of different
+sizes: large pixels inside the region, and small ones on its boundary. The headers
+`X-Rows-Scanned` and `X-Rows-Returned` of the response give the number of rows read
+in the pixel index tables, and the number of alerts returned.
+
 You will get a Pandas DataFrame as usual, with all alerts inside the region (within `[-1 day, +6 day]`).
 Here are some statistics on this specific event:
 
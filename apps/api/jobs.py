@@ -0,0 +1,268 @@
+# Copyright 2022 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Asynchronous execution of heavy API queries
+
+A job runs in a bounded pool of background threads, and its result is
+stored on local disk as parquet. The status of each job is a small JSON
+file next to the result, so that any server process can answer a poll,
+whichever process runs the job.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import threading
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+# Job ids are uuid4 hex strings
+JOB_ID_PATTERN = re.compile('^[0-9a-f]{32}$')
+
+# Minimum delay between two progress updates written on disk, in seconds
+PROGRESS_INTERVAL = 1.0
+
+class JobManager:
+    """ Run functions returning a DataFrame in the background
+
+    Parameters
+    ----------
+    directory: str
+        Folder where status and results are stored
+    nthreads: int
+        Number of jobs run concurrently by this process
+    max_pending: int
+        Maximum number of jobs queued or running in this process.
+        Further submissions are rejected.
+    ttl: float
+        Time during which a finished job is kept, in seconds.
+        Its status and result are deleted afterwards.
+
+    Examples
+    ----------
+    >>> import tempfile
+    >>> manager = JobManager(tempfile.mkdtemp(), nthreads=1, ttl=60)
+    >>> jobid = manager.submit('test', lambda progress: pd.DataFrame({'a': [1, 2]}))
+    >>> manager.wait(jobid)
+    >>> status = manager.status(jobid)
+    >>> status['status'], status['progress'], status['nrows']
+    ('done', 1.0, 2)
+    >>> manager.result(jobid)['a'].tolist()
+    [1, 2]
+    >>> manager.remove(jobid)
+    >>> manager.status(jobid) is None, manager.result(jobid) is None
+    (True, True)
+    >>> manager.status('0' * 32) is None
+    True
+    """
+    def __init__(self, directory: str, nthreads: int = 2, max_pending: int = 16, ttl: float = 24 * 3600):
+        self.directory = directory
+        self.max_pending = max_pending
+        self.ttl = ttl
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.executor = ThreadPoolExecutor(max_workers=nthreads, thread_name_prefix='job')
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def path(self, jobid: str, extension: str) -> str:
+        """ Path of the status (json) or result (parquet) file of a job
+        """
+        return os.path.join(self.directory, '{}.{}'.format(jobid, extension))
+
+    def write_status(self, jobid: str, status: dict):
+        """ Atomically write the status of a job
+        """
+        filename = self.path(jobid, 'json')
+        tmp = '{}.{}.tmp'.format(filename, threading.get_ident())
+        with open(tmp, 'w') as f:
+            json.dump(status, f)
+        os.replace(tmp, filename)
+
+    def status(self, jobid: str) -> dict:
+        """ Status of a job, or None if the job does not exist (or expired)
+
+        Returns
+        ----------
+        out: dict
+            `id`, `kind`, `status` (queued, running, done, failed),
+            `progress` (between 0 and 1), `created`, `started`, `finished`,
+            `expires` (unix times), `nrows` and `error`
+        """
+        if not JOB_ID_PATTERN.match(str(jobid)):
+            return None
+        try:
+            with open(self.path(jobid, 'json')) as f:
+                status = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if status['expires'] < time.time():
+            self.remove(jobid)
+            return None
+        return status
+
+    def update(self, jobid: str, **kwargs) -> dict:
+        """ Update fields of the status of a job
+        """
+        status = self.status(jobid)
+        if status is None:
+            return None
+        status.update(kwargs)
+        self.write_status(jobid, status)
+        return status
+
+    def submit(self, kind: str, function, *args) -> str:
+        """ Queue a job
+
+        Parameters
+        ----------
+        kind: str
+            Name of the query (e.g. the endpoint)
+        function: callable
+            Called as `function(progress, *args)`, where `progress(fraction)`
+            reports the progress of the job. It returns a DataFrame,
+            or a flask.Response in case of error.
+
+        Returns
+        ----------
+        jobid: str
+            Identifier of the job, or None if too many jobs are pending
+        """
+        self.purge()
+
+        with self.lock:
+            pending = [future for future in self.futures.values() if not future.done()]
+            if len(pending) >= self.max_pending:
+                return None
+
+            jobid = uuid.uuid4().hex
+            now = time.time()
+            self.write_status(
+                jobid,
+                {
+                    'id': jobid,
+                    'kind': kind,
+                    'status': 'queued',
+                    'progress': 0.0,
+                    'created': now,
+                    'started': None,
+                    'finished': None,
+                    'expires': now + self.ttl,
+                    'nrows': None,
+                    'error': None,
+                }
+            )
+            self.futures[jobid] = self.executor.submit(self.run, jobid, function, *args)
+
+        return jobid
+
+    def run(self, jobid: str, function, *args):
+        """ Execute a job, and store its result
+        """
+        self.update(jobid, status='running', started=time.time())
+
+        last_update = [0.0]
+
+        def progress(fraction: float):
+            """ Report progress, at most every `PROGRESS_INTERVAL` seconds
+            """
+            now = time.time()
+            if now - last_update[0] > PROGRESS_INTERVAL:
+                last_update[0] = now
+                self.update(jobid, progress=round(min(max(fraction, 0.0), 0.99), 3))
+
+        try:
+            pdf = function(progress, *args)
+
+            # Errors are returned as flask.Response by the API functions
+            if not isinstance(pdf, pd.DataFrame):
+                error = pdf.get_data(as_text=True) if hasattr(pdf, 'get_data') else str(pdf)
+                self.finish(jobid, status='failed', error=error)
+                return
+
+            pdf.to_parquet(self.path(jobid, 'parquet'), index=False)
+        except Exception as e:
+            traceback.print_exc()
+            self.finish(jobid, status='failed', error='{}: {}'.format(type(e).__name__, e))
+            return
+
+        self.finish(jobid, status='done', progress=1.0, nrows=len(pdf))
+
+    def finish(self, jobid: str, **kwargs):
+        """ Mark a job as finished: it is kept `ttl` seconds from now
+        """
+        now = time.time()
+        self.update(jobid, finished=now, expires=now + self.ttl, **kwargs)
+
+    def wait(self, jobid: str):
+        """ Block until a job submitted by this process is finished
+        """
+        future = self.futures.get(jobid)
+        if future is not None:
+            future.result()
+
+    def result_path(self, jobid: str) -> str:
+        """ Path of the parquet result of a finished job, or None
+        """
+        status = self.status(jobid)
+        if status is None or status['status'] != 'done':
+            return None
+        return self.path(jobid, 'parquet')
+
+    def result(self, jobid: str) -> pd.DataFrame:
+        """ Result of a finished job, or None
+        """
+        path = self.result_path(jobid)
+        if path is None:
+            return None
+        return pd.read_parquet(path)
+
+    def remove(self, jobid: str):
+        """ Delete the status and result of a job
+        """
+        for extension in ['json', 'parquet']:
+            try:
+                os.remove(self.path(jobid, extension))
+            except OSError:
+                pass
+
+        with self.lock:
+            self.futures.pop(jobid, None)
+
+    def purge(self):
+        """ Delete expired jobs, including the ones of other processes
+        """
+        now = time.time()
+        for filename in os.listdir(self.directory):
+            jobid, extension = os.path.splitext(filename)
+            if extension != '.json' or not JOB_ID_PATTERN.match(jobid):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    expires = json.load(f)['expires']
+            except (OSError, ValueError, KeyError):
+                continue
+            if expires < now:
+                self.remove(jobid)
+
+        # Forget finished jobs of this process
+        with self.lock:
+            for jobid in [k for k, v in self.futures.items() if v.done()]:
+                self.futures.pop(jobid)
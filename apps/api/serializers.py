@@ -0,0 +1,188 @@
+# Copyright 2022 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Streaming serializers for the REST API
+
+Each serializer is a generator yielding the response by chunks of rows,
+so that the serialized copy of a DataFrame never exceeds one chunk.
+Frame serializers do the same for a sequence of DataFrames that are
+computed while the response is sent (e.g. a catalog crossmatched by chunks).
+"""
+import pandas as pd
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Number of rows serialized at once when streaming a response
+STREAM_CHUNKSIZE = 10000
+
+def stream_json(pdf: pd.DataFrame, chunksize: int = STREAM_CHUNKSIZE):
+    """ Serialize a DataFrame as a JSON array of records, by chunks of rows
+
+    The concatenation of the chunks is identical to
+    `pdf.to_json(orient='records')`.
+    """
+    yield '['
+    for index, start in enumerate(range(0, len(pdf), chunksize)):
+        chunk = pdf.iloc[start: start + chunksize].to_json(orient='records')
+        # Strip the enclosing brackets
+        yield (',' if index > 0 else '') + chunk[1:-1]
+    yield ']'
+
+def stream_ndjson(pdf: pd.DataFrame, chunksize: int = STREAM_CHUNKSIZE):
+    """ Serialize a DataFrame as newline-delimited JSON, by chunks of rows
+    """
+    for start in range(0, len(pdf), chunksize):
+        chunk = pdf.iloc[start: start + chunksize].to_json(orient='records', lines=True)
+        yield chunk if chunk.endswith('\n') else chunk + '\n'
+
+def stream_csv(pdf: pd.DataFrame, chunksize: int = STREAM_CHUNKSIZE):
+    """ Serialize a DataFrame as CSV, by chunks of rows
+
+    The concatenation of the chunks is identical to `pdf.to_csv(index=False)`.
+    """
+    if len(pdf) == 0:
+        yield pdf.to_csv(index=False)
+        return
+
+    for start in range(0, len(pdf), chunksize):
+        yield pdf.iloc[start: start + chunksize].to_csv(index=False, header=(start == 0))
+
+class ChunkSink:
+    """ Write-only file-like object whose content is drained by the caller
+
+    Position is tracked internally, so that writers relying on `tell`
+    (e.g. parquet footers) remain correct after draining.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        out = b''.join(self.chunks)
+        self.chunks = []
+        return out
+
+def stream_parquet(pdf: pd.DataFrame, chunksize: int = STREAM_CHUNKSIZE):
+    """ Serialize a DataFrame as parquet, one row group per chunk of rows
+
+    The index is kept as `pdf.to_parquet` does: a RangeIndex is stored in
+    the metadata, other indices as columns.
+    """
+    schema = pa.Schema.from_pandas(pdf, preserve_index=None)
+
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema)
+    for start in range(0, len(pdf), chunksize):
+        table = pa.Table.from_pandas(
+            pdf.iloc[start: start + chunksize],
+            schema=schema,
+            preserve_index=None
+        )
+        writer.write_table(table)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+def stream_arrow(pdf: pd.DataFrame, chunksize: int = STREAM_CHUNKSIZE):
+    """ Serialize a DataFrame as an Arrow IPC stream, one record batch per chunk of rows
+
+    Columns are converted directly to Arrow buffers, without text copy.
+    The index is not written. Read it with `pyarrow.ipc.open_stream`.
+    """
+    schema = pa.Schema.from_pandas(pdf, preserve_index=False)
+
+    sink = ChunkSink()
+    writer = pa.ipc.new_stream(pa.PythonFile(sink, mode='w'), schema)
+    for start in range(0, len(pdf), chunksize):
+        batch = pa.RecordBatch.from_pandas(
+            pdf.iloc[start: start + chunksize],
+            schema=schema,
+            preserve_index=False
+        )
+        writer.write_batch(batch)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+# output-format -> (serializer, mimetype)
+STREAMERS = {
+    'json': (stream_json, 'application/json'),
+    'ndjson': (stream_ndjson, 'application/x-ndjson'),
+    'csv': (stream_csv, 'text/csv'),
+    'parquet': (stream_parquet, 'application/octet-stream'),
+    'arrow': (stream_arrow, 'application/vnd.apache.arrow.stream'),
+}
+
+def stream_json_frames(frames):
+    """ Serialize a sequence of DataFrames as a single JSON array of records
+    """
+    yield '['
+    first = True
+    for pdf in frames:
+        if pdf.empty:
+            continue
+        chunk = pdf.to_json(orient='records')
+        yield ('' if first else ',') + chunk[1:-1]
+        first = False
+    yield ']'
+
+def stream_ndjson_frames(frames):
+    """ Serialize a sequence of DataFrames as newline-delimited JSON
+    """
+    for pdf in frames:
+        yield from stream_ndjson(pdf, chunksize=max(len(pdf), 1))
+
+def stream_csv_frames(frames):
+    """ Serialize a sequence of DataFrames as a single CSV
+
+    Columns are those of the first non-empty DataFrame. If all
+    DataFrames are empty, only the header of the last one is written.
+    """
+    columns = None
+    last = None
+    for pdf in frames:
+        last = pdf
+        if pdf.empty:
+            continue
+        if columns is None:
+            columns = pdf.columns
+            yield pdf.to_csv(index=False)
+        else:
+            yield pdf.reindex(columns=columns).to_csv(index=False, header=False)
+
+    if columns is None and last is not None:
+        yield last.to_csv(index=False)
+
+# output-format -> (serializer, mimetype), for sequences of DataFrames
+FRAME_STREAMERS = {
+    'json': (stream_json_frames, 'application/json'),
+    'ndjson': (stream_ndjson_frames, 'application/x-ndjson'),
+    'csv': (stream_csv_frames, 'text/csv'),
+}
@@ -14,8 +14,7 @@
 # limitations under the License.
 import io
 import java
-import gzip
-import requests
+import hashlib
 
 import pandas as pd
 import numpy as np
@@ -24,30 +23,210 @@ import healpy as hp
 from PIL import Image as im
 from matplotlib import cm
 
-import astropy.units as u
-from astropy.coordinates import SkyCoord
 from astropy.time import Time, TimeDelta
-from astropy.io import fits, votable
+from astropy.io import votable
 from astropy.table import Table
 
 from app import client
 from app import clientU, clientUV
 from app import clientP128, clientP4096, clientP131072
+from app import clientP128N, clientP4096N, clientP131072N, PIXEL_ORDERING
+from app import SCAN_THREADS
+from app import SKYMAP_MAX_ORDER, BAYESTAR_OVERFETCH, BAYESTAR_MAX_SPLIT
 from app import clientT, clientTNS, clientS, clientSSO, clientTRCK
 from app import clientSSOCAND, clientSSOORB
 from app import clientStats
-from app import nlimit
-from app import APIURL
+from app import object_cache, skymap_cache
+
+from apps.hbase import multi_scan, range_scan, hbase_to_pandas
+from apps.healpix import disc_ranges, range_keys, multi_order_ranges
+from apps.coordinates import parse_coordinates, angular_separation
+from apps.skymap import decode_skymap, skymap_hash, credible_levels, credible_region
 
 from apps.utils import get_miriade_data
-from apps.utils import format_hbase_output
+from apps.utils import format_hbase_output, select_columns
 from apps.utils import extract_cutouts
-from apps.utils import hbase_type_converter
+
+from apps.api.serializers import STREAMERS, STREAM_CHUNKSIZE
 
 from apps.plotting import legacy_normalizer, convolve, sigmoid_normalizer
 
 from flask import Response
 from flask import send_file
+from flask import g, has_request_context
+
+def record_scan_timings(timings: list):
+    """ Attach scan timings to the current request
+
+    Timings are sent back to the user in the `Server-Timing` header
+    (see `apps.api.api.add_server_timing`).
+
+    Parameters
+    ----------
+    timings: list of dict
+        Timings returned by `apps.hbase.multi_scan`
+    """
+    if not has_request_context():
+        return
+    if 'scan_timings' not in g:
+        g.scan_timings = []
+    g.scan_timings.extend(timings)
+
+def record_cache_status(status: str):
+    """ Store the cache status of the current request
+
+    It is sent back to the user in the `X-Cache` header
+    (see `apps.api.api.add_cache_status`).
+
+    Parameters
+    ----------
+    status: str
+        `hit`, `miss` or `stale`, see `apps.cache.ResultCache`
+    """
+    if not has_request_context():
+        return
+    g.cache_status = status
+
+def record_row_counts(scanned: int, returned: int):
+    """ Store the number of index rows read, and of rows sent back
+
+    They are sent back to the user in the `X-Rows-Scanned` and
+    `X-Rows-Returned` headers (see `apps.api.api.add_row_counts`).
+    """
+    if not has_request_context():
+        return
+    g.rows_scanned = scanned
+    g.rows_returned = returned
+
+def object_keys(payload: dict) -> list:
+    """ Row-key prefixes of the objects of a /api/v1/objects payload
+    """
+    if ',' in payload['objectId']:
+        # multi-objects search
+        splitids = payload['objectId'].split(',')
+        objectids = ['key:key:{}'.format(i.strip()) for i in splitids]
+    else:
+        # single object search
+        objectids = ["key:key:{}".format(payload['objectId'])]
+
+    return objectids
+
+def sso_keys(payload: dict) -> list:
+    """ Row-key prefixes of the objects of a /api/v1/sso payload
+    """
+    if ',' in payload['n_or_d']:
+        # multi-objects search
+        splitids = payload['n_or_d'].replace(' ', '').split(',')
+
+        # Note the trailing _ to avoid mixing e.g. 91 and 915 in the same query
+        names = ['key:key:{}_'.format(i.strip()) for i in splitids]
+    else:
+        # single object search
+        # Note the trailing _ to avoid mixing e.g. 91 and 915 in the same query
+        names = ["key:key:{}_".format(payload['n_or_d'].replace(' ', ''))]
+
+    return names
+
+def probe_tables(pools: list, keys: list) -> tuple:
+    """ Cheap signature of rows: latest row key of each prefix, per table
+
+    Rows are only ever added, and row keys end with the alert jd: the
+    latest row key of an object changes when it gets a new alert. It is
+    read with a reversed range scan returning a single row per prefix.
+    Within a request, each probe is done only once.
+
+    Parameters
+    ----------
+    pools: list of HBaseClientPool
+        Tables to probe
+    keys: list of str
+        Row-key prefixes, e.g. ['key:key:ZTF21abfmbix', ...]
+
+    Returns
+    ----------
+    signature: tuple
+        Sorted latest row keys, for each table probed
+    """
+    memo_key = (tuple([pool.tablename for pool in pools]), tuple(keys))
+    if has_request_context():
+        if 'probes' not in g:
+            g.probes = {}
+        if memo_key in g.probes:
+            return g.probes[memo_key]
+
+    # All row keys starting with the prefix ('~' sorts after key characters)
+    bounds = ['{},{}~'.format(key, key) for key in keys]
+
+    signature = []
+    for pool in pools:
+        results, timings = range_scan(
+            pool, bounds, 'i:jd', ifkey=False, iftime=False,
+            nthreads=SCAN_THREADS, limit=1, reverse=True
+        )
+        record_scan_timings(timings)
+        signature.append(tuple([str(key) for key in results.keySet().toArray()]))
+    signature = tuple(signature)
+
+    if has_request_context():
+        g.probes[memo_key] = signature
+
+    return signature
+
+def probe_objects(objectids: list, withupperlim: bool = False) -> tuple:
+    """ Cheap signature of the alerts of objects, see `probe_tables`
+
+    Parameters
+    ----------
+    objectids: list of str
+        Row-key prefixes, e.g. ['key:key:ZTF21abfmbix', ...]
+    withupperlim: bool
+        If True, probe the upper limit tables as well
+
+    Returns
+    ----------
+    signature: tuple
+        Latest row keys, for each table probed
+    """
+    pools = [client]
+    if withupperlim:
+        pools += [clientU, clientUV]
+
+    return probe_tables(pools, objectids)
+
+def compute_etag(endpoint: str, payload: dict, signature: tuple) -> str:
+    """ Entity tag of a response, from the request and the signature of the data
+
+    The payload covers the column selection, output format and options.
+
+    Parameters
+    ----------
+    endpoint: str
+        Name of the endpoint, e.g. `objects`
+    payload: dict
+        Arguments of the request
+    signature: tuple
+        Signature of the data, see `probe_tables`
+
+    Returns
+    ----------
+    etag: str
+    """
+    arguments = sorted([(str(k), str(v)) for k, v in dict(payload).items()])
+    content = repr((endpoint, arguments, signature))
+    return hashlib.sha1(content.encode()).hexdigest()
+
+def object_etag(payload: dict) -> str:
+    """ Entity tag of a /api/v1/objects response, see `compute_etag`
+    """
+    withupperlim = str(payload.get('withupperlim', False)) == 'True'
+    signature = probe_objects(object_keys(payload), withupperlim)
+    return compute_etag('objects', payload, signature)
+
+def sso_etag(payload: dict) -> str:
+    """ Entity tag of a /api/v1/sso response, see `compute_etag`
+    """
+    signature = probe_tables([clientSSO], sso_keys(payload))
+    return compute_etag('sso', payload, signature)
 
 def return_object_pdf(payload: dict) -> pd.DataFrame:
     """ Extract data returned by HBase and format it in a Pandas dataframe
@@ -68,13 +247,7 @@ def return_object_pdf(payload: dict) -> pd.DataFrame:
     else:
         cols = '*'
 
-    if ',' in payload['objectId']:
-        # multi-objects search
-        splitids = payload['objectId'].split(',')
-        objectids = ['key:key:{}'.format(i.strip()) for i in splitids]
-    else:
-        # single object search
-        objectids = ["key:key:{}".format(payload['objectId'])]
+    objectids = object_keys(payload)
 
     if 'withcutouts' in payload and str(payload['withcutouts']) == 'True':
         withcutouts = True
@@ -91,76 +264,128 @@ def return_object_pdf(payload: dict) -> pd.DataFrame:
     else:
         truncated = True
 
-    # Get data from the main table
-    results = java.util.TreeMap()
-    for to_evaluate in objectids:
-        result = client.scan(
-            "",
-            to_evaluate,
-            cols,
-            0, True, True
-        )
-        results.putAll(result)
+    # Derived columns are replaced by the columns needed to compute them
+    cols, columns = select_columns(cols)
 
-    schema_client = client.schema()
+    def compute():
+        # Get data from the main table
+        results, timings = multi_scan(client, objectids, cols)
+        record_scan_timings(timings)
 
-    # reset the limit in case it has been changed above
-    client.setLimit(nlimit)
+        dtypes = client.dtypes()
 
-    pdf = format_hbase_output(
-        results, schema_client, group_alerts=False, truncated=truncated
-    )
+        pdf = format_hbase_output(
+            results, dtypes, group_alerts=False, truncated=truncated,
+            columns=columns
+        )
 
-    if withcutouts:
-        pdf = extract_cutouts(pdf, client)
+        if withcutouts:
+            pdf = extract_cutouts(pdf, client)
 
-    if withupperlim:
-        # upper limits
-        resultsU = java.util.TreeMap()
-        for to_evaluate in objectids:
-            resultU = clientU.scan(
-                "",
-                to_evaluate,
-                "*",
-                0, False, False
+        if withupperlim:
+            # upper limits
+            resultsU, timings = multi_scan(
+                clientU, objectids, "*", ifkey=False, iftime=False
             )
-            resultsU.putAll(resultU)
+            record_scan_timings(timings)
 
-        # bad quality
-        resultsUP = java.util.TreeMap()
-        for to_evaluate in objectids:
-            resultUP = clientUV.scan(
-                "",
-                to_evaluate,
-                "*",
-                0, False, False
+            # bad quality
+            resultsUP, timings = multi_scan(
+                clientUV, objectids, "*", ifkey=False, iftime=False
             )
-            resultsUP.putAll(resultUP)
+            record_scan_timings(timings)
 
-        pdfU = pd.DataFrame.from_dict(resultsU, orient='index')
-        pdfUP = pd.DataFrame.from_dict(resultsUP, orient='index')
+            pdfU = hbase_to_pandas(resultsU)
+            pdfUP = hbase_to_pandas(resultsUP)
 
-        pdf['d:tag'] = 'valid'
-        pdfU['d:tag'] = 'upperlim'
-        pdfUP['d:tag'] = 'badquality'
+            pdf['d:tag'] = 'valid'
+            pdfU['d:tag'] = 'upperlim'
+            pdfUP['d:tag'] = 'badquality'
 
-        if 'i:jd' in pdfUP.columns:
-            # workaround -- see https://github.com/astrolabsoftware/fink-science-portal/issues/216
-            mask = np.array([False if float(i) in pdf['i:jd'].values else True for i in pdfUP['i:jd'].values])
-            pdfUP = pdfUP[mask]
+            if 'i:jd' in pdfUP.columns:
+                # workaround -- see https://github.com/astrolabsoftware/fink-science-portal/issues/216
+                mask = np.array([False if float(i) in pdf['i:jd'].values else True for i in pdfUP['i:jd'].values])
+                pdfUP = pdfUP[mask]
 
-        pdf_ = pd.concat((pdf, pdfU, pdfUP), axis=0)
+            pdf_ = pd.concat((pdf, pdfU, pdfUP), axis=0)
 
-        # replace
-        if 'i:jd' in pdf_.columns:
-            pdf_['i:jd'] = pdf_['i:jd'].astype(float)
-            pdf = pdf_.sort_values('i:jd', ascending=False)
-        else:
-            pdf = pdf_
+            # replace
+            if 'i:jd' in pdf_.columns:
+                pdf_['i:jd'] = pdf_['i:jd'].astype(float)
+                pdf = pdf_.sort_values('i:jd', ascending=False)
+            else:
+                pdf = pdf_
+
+        return pdf
+
+    # Alerts never change: serve the cached result
+    # if the objects did not get new alerts since
+    key = (tuple(objectids), cols, tuple(columns or []), withupperlim, withcutouts)
+    pdf, status = object_cache.get_or_compute(
+        key,
+        lambda: probe_objects(objectids, withupperlim),
+        compute
+    )
+    record_cache_status(status)
 
     return pdf
 
-def return_explorer_pdf(payload: dict, user_group: int) -> pd.DataFrame:
+def select_output_columns(payload: dict, required: list) -> tuple:
+    """ Columns to fetch for a user projection, including the ones needed internally
+
+    Parameters
+    ----------
+    payload: dict
+        Arguments of the request, with an optional `columns` entry
+    required: list of str
+        Columns needed to process the alerts (grouping, sorting, ...),
+        fetched even if the user did not ask for them
+
+    Returns
+    ----------
+    cols: str
+        Comma-separated list of columns to pass to `HBaseClient.scan`
+    fetched: list of str
+        Columns to pass to `format_hbase_output`, None for all columns
+    columns: list of str
+        Columns requested by the user, None for all columns
+    """
+    cols, columns = select_columns(payload.get('columns', '*').replace(" ", ""))
+    if columns is None:
+        return cols, None, None
+
+    fetched = columns + [col for col in required if col not in columns]
+    cols, fetched = select_columns(','.join(fetched))
+    return cols, fetched, columns
+
+def fetch_alerts(pdf: pd.DataFrame, cols: str = '*'):
+    """ Get alerts from the main table, given their objectId and jd
+
+    Rows are fetched by batches of keys, and batches run concurrently
+    (see `apps.hbase.multi_scan`), instead of one scan per alert.
+
+    Parameters
+    ----------
+    pdf: pd.DataFrame
+        Alerts to fetch, with columns `oid` and `jd`
+        (as found in the pixel index tables)
+    cols: str
+        Comma-separated list of columns to fetch. Default is all columns.
+
+    Returns
+    ----------
+    results: java.util.TreeMap
+    """
+    keys = [
+        "key:key:{}_{}".format(oid, jd)
+        for oid, jd in zip(pdf['oid'].values, pdf['jd'].values)
+    ]
+    results, timings = multi_scan(client, keys, cols, nthreads=SCAN_THREADS)
+    record_scan_timings(timings)
+
+    return results
+
+def return_explorer_pdf(payload: dict, user_group: int, progress=None) -> pd.DataFrame:
     """ Extract data returned by HBase and format it in a Pandas dataframe
 
     Data is from /api/v1/explorer
@@ -169,28 +394,31 @@ def return_explorer_pdf(payload: dict, user_group: int) -> pd.DataFrame:
     ----------
     payload: dict
         See https://fink-portal.org/api/v1/explorer
+    user_group: int
+        0 for objectId search, 1 for conesearch, 2 for date search
+    progress: callable, optional
+        Called with the fraction of the work done
 
     Return
     ----------
     out: pandas dataframe
     """
-    if user_group == 0:
-        results = java.util.TreeMap()
-        for oid in payload['objectId'].split(','):
-            # objectId search
-            to_evaluate = "key:key:{}".format(oid.strip())
-            result = client.scan(
-                "",
-                to_evaluate,
-                "*",
-                0, True, True
-            )
-            results.putAll(result)
+    # Alerts are grouped by object, and conesearch results sorted by distance
+    required = ['i:objectId', 'i:jd']
+    if user_group == 1:
+        required += ['i:ra', 'i:dec']
+    cols, fetched, columns = select_output_columns(payload, required)
 
-        # reset the limit in case it has been changed above
-        client.setLimit(nlimit)
+    if user_group == 0:
+        # objectId search
+        objectids = [
+            "key:key:{}".format(oid.strip())
+            for oid in payload['objectId'].split(',')
+        ]
+        results, timings = multi_scan(client, objectids, cols)
+        record_scan_timings(timings)
 
-        schema_client = client.schema()
+        dtypes = client.dtypes()
     if user_group == 1:
         # Interpret user input
         ra, dec = payload['ra'], payload['dec']
@@ -213,12 +441,7 @@ def return_explorer_pdf(payload: dict, user_group: int) -> pd.DataFrame:
             return Response(str(rep), 400)
 
         try:
-            if 'h' in str(ra):
-                coord = SkyCoord(ra, dec, frame='icrs')
-            elif ':' in str(ra) or ' ' in str(ra):
-                coord = SkyCoord(ra, dec, frame='icrs', unit=(u.hourangle, u.deg))
-            else:
-                coord = SkyCoord(ra, dec, frame='icrs', unit='deg')
+            ras, decs = parse_coordinates([ra], [dec])
         except ValueError as e:
             rep = {
                 'status': 'error',
@@ -226,34 +449,22 @@ def return_explorer_pdf(payload: dict, user_group: int) -> pd.DataFrame:
             }
             return Response(str(rep), 400)
 
-        ra = coord.ra.deg
-        dec = coord.dec.deg
+        ra, dec = ras[0], decs[0]
         radius_deg = float(radius) / 3600.
 
-        # angle to vec conversion
-        vec = hp.ang2vec(np.pi / 2.0 - np.pi / 180.0 * dec, np.pi / 180.0 * ra)
-
         # Send request
         if float(radius) <= 30.:
             nside = 131072
             clientP_ = clientP131072
+            clientPN_ = clientP131072N
         elif (float(radius) > 30.) & (float(radius) <= 1000.):
             nside = 4096
             clientP_ = clientP4096
+            clientPN_ = clientP4096N
         else:
             nside = 128
             clientP_ = clientP128
-
-        pixs = hp.query_disc(
-            nside,
-            vec,
-            np.pi / 180 * radius_deg,
-            inclusive=True
-        )
-
-        # For the future: we could set clientP_.setRangeScan(True)
-        # and pass directly the time boundaries here instead of
-        # grouping by later.
+            clientPN_ = clientP128N
 
         # Filter by time - logic to be improved...
         if startdate is not None:
@@ -264,32 +475,52 @@ def return_explorer_pdf(payload: dict, user_group: int) -> pd.DataFrame:
             else:
                 jdstart = Time(startdate, format='mjd').jd
             jdend = jdstart + window_days
+        else:
+            jdstart, jdend = None, None
+
+        if PIXEL_ORDERING == 'nested':
+            # One range scan per run of consecutive pixels,
+            # or one time-bounded scan per pixel
+            ranges = disc_ranges(ra, dec, radius_deg, nside)
+            results, timings = range_scan(
+                clientPN_, range_keys(ranges, nside, jdstart, jdend),
+                'i:objectId', nthreads=SCAN_THREADS
+            )
+            record_scan_timings(timings)
+        else:
+            # angle to vec conversion
+            vec = hp.ang2vec(np.pi / 2.0 - np.pi / 180.0 * dec, np.pi / 180.0 * ra)
+
+            pixs = hp.query_disc(
+                nside,
+                vec,
+                np.pi / 180 * radius_deg,
+                inclusive=True
+            )
 
-            clientP_.setRangeScan(True)
-            results = java.util.TreeMap()
-            for pix in pixs:
-                to_search = "key:key:{}_{},key:key:{}_{}".format(pix, jdstart, pix, jdend)
-                result = clientP_.scan(
+            if startdate is not None:
+                # One time-bounded range scan per pixel, run concurrently
+                bounds = [
+                    "key:key:{}_{},key:key:{}_{}".format(pix, jdstart, pix, jdend)
+                    for pix in pixs
+                ]
+                results, timings = range_scan(
+                    clientP_, bounds, 'i:objectId', nthreads=SCAN_THREADS
+                )
+                record_scan_timings(timings)
+            else:
+                to_evaluate = ",".join(
+                    [
+                        'key:key:{}'.format(i) for i in pixs
+                    ]
+                )
+                # Get matches in the pixel index table
+                results = clientP_.scan(
                     "",
-                    to_search,
-                    "*",
+                    to_evaluate,
+                    "i:objectId",
                     0, True, True
                 )
-                results.putAll(result)
-            clientP_.setRangeScan(False)
-        else:
-            to_evaluate = ",".join(
-                [
-                    'key:key:{}'.format(i) for i in pixs
-                ]
-            )
-            # Get matches in the pixel index table
-            results = clientP_.scan(
-                "",
-                to_evaluate,
-                "*",
-                0, True, True
-            )
 
         # extract objectId and times
         objectids = [i[1]['i:objectId'] for i in results.items()]
@@ -302,20 +533,12 @@ def return_explorer_pdf(payload: dict, user_group: int) -> pd.DataFrame:
 
         # groupby and keep only the last alert per objectId
         pdf_ = pdf_.loc[pdf_.groupby('oid')['jd'].idxmax()]
+        if progress is not None:
+            progress(0.3)
 
         # Get data from the main table
-        results = java.util.TreeMap()
-        for oid, jd in zip(pdf_['oid'].values, pdf_['jd'].values):
-            to_evaluate = "key:key:{}_{}".format(oid, jd)
-
-            result = client.scan(
-                "",
-                to_evaluate,
-                "*",
-                0, True, True
-            )
-            results.putAll(result)
-        schema_client = client.schema()
+        results = fetch_alerts(pdf_, cols)
+        dtypes = client.dtypes()
     elif user_group == 2:
         if int(payload['window']) > 180:
             rep = {
@@ -328,35 +551,32 @@ def return_explorer_pdf(payload: dict, user_group: int) -> pd.DataFrame:
         jd_end = jd_start + TimeDelta(int(payload['window']) * 60, format='sec').jd
 
         # Send the request. RangeScan.
-        clientT.setRangeScan(True)
         to_evaluate = "key:key:{},key:key:{}".format(jd_start, jd_end)
         results = clientT.scan(
             "",
             to_evaluate,
-            "*",
-            0, True, True
+            cols,
+            0, True, True,
+            range_scan=True
         )
-        schema_client = clientT.schema()
+        dtypes = clientT.dtypes()
 
-    # reset the limit in case it has been changed above
-    client.setLimit(nlimit)
+    if progress is not None:
+        progress(0.6)
 
     pdfs = format_hbase_output(
         results,
-        schema_client,
+        dtypes,
         group_alerts=True,
-        extract_color=False
+        extract_color=False,
+        columns=fetched
     )
 
     # For conesearch, sort by distance
     if (user_group == 1) and (len(pdfs) > 0):
-        sep = coord.separation(
-            SkyCoord(
-                pdfs['i:ra'],
-                pdfs['i:dec'],
-                unit='deg'
-            )
-        ).deg
+        sep = angular_separation(
+            ra, dec, pdfs['i:ra'].values, pdfs['i:dec'].values
+        )
 
         pdfs['v:separation_degree'] = sep
         pdfs = pdfs.sort_values('v:separation_degree', ascending=True)
@@ -364,9 +584,13 @@ def return_explorer_pdf(payload: dict, user_group: int) -> pd.DataFrame:
         mask = pdfs['v:separation_degree'] > radius_deg
         pdfs = pdfs[~mask]
 
+    # Drop the columns only needed internally
+    if columns is not None:
+        pdfs = pdfs[[col for col in columns + ['v:separation_degree'] if col in pdfs.columns]]
+
     return pdfs
 
-def return_latests_pdf(payload: dict, return_raw: bool = False) -> pd.DataFrame:
+def return_latests_pdf(payload: dict, return_raw: bool = False, progress=None) -> pd.DataFrame:
     """ Extract data returned by HBase and format it in a Pandas dataframe
 
     Data is from /api/v1/latests
@@ -377,6 +601,8 @@ def return_latests_pdf(payload: dict, return_raw: bool = False) -> pd.DataFrame:
         See https://fink-portal.org/api/v1/latests
     return_raw: bool
         If True, return the HBase output, else pandas DataFrame. Default is False.
+    progress: callable, optional
+        Called with the fraction of the work done
 
     Return
     ----------
@@ -408,14 +634,14 @@ def return_latests_pdf(payload: dict, return_raw: bool = False) -> pd.DataFrame:
     else:
         truncated = True
 
+    # Derived columns are replaced by the columns needed to compute them
+    cols, columns = select_columns(cols)
+
     # Search for latest alerts for a specific class
     tns_classes = pd.read_csv('assets/tns_types.csv', header=None)[0].values
     is_tns = payload['class'].startswith('(TNS)') and (payload['class'].split('(TNS) ')[1] in tns_classes)
     if is_tns:
         classname = payload['class'].split('(TNS) ')[1]
-        clientTNS.setLimit(nalerts)
-        clientTNS.setRangeScan(True)
-        clientTNS.setReversed(True)
 
         results = clientTNS.scan(
             "",
@@ -425,21 +651,17 @@ def return_latests_pdf(payload: dict, return_raw: bool = False) -> pd.DataFrame:
                 classname,
                 jd_stop
             ),
-            cols, 0, True, True
+            cols, 0, True, True,
+            limit=nalerts, range_scan=True, reverse=True
         )
-        schema_client = clientTNS.schema()
+        dtypes = clientTNS.dtypes()
         group_alerts = True
-        clientTNS.setLimit(nlimit)
     elif payload['class'].startswith('(SIMBAD)') or payload['class'] != 'allclasses':
         if payload['class'].startswith('(SIMBAD)'):
             classname = payload['class'].split('(SIMBAD) ')[1]
         else:
             classname = payload['class']
 
-        clientS.setLimit(nalerts)
-        clientS.setRangeScan(True)
-        clientS.setReversed(True)
-
         results = clientS.scan(
             "",
             "key:key:{}_{},key:key:{}_{}".format(
@@ -448,40 +670,38 @@ def return_latests_pdf(payload: dict, return_raw: bool = False) -> pd.DataFrame:
                 classname,
                 jd_stop
             ),
-            cols, 0, False, False
+            cols, 0, False, False,
+            limit=nalerts, range_scan=True, reverse=True
         )
-        schema_client = clientS.schema()
+        dtypes = clientS.dtypes()
         group_alerts = False
-        clientS.setLimit(nlimit)
     elif payload['class'] == 'allclasses':
-        clientT.setLimit(nalerts)
-        clientT.setRangeScan(True)
-        clientT.setReversed(True)
-
         to_evaluate = "key:key:{},key:key:{}".format(jd_start, jd_stop)
         results = clientT.scan(
             "",
             to_evaluate,
             cols,
-            0, True, True
+            0, True, True,
+            limit=nalerts, range_scan=True, reverse=True
         )
-        schema_client = clientT.schema()
+        dtypes = clientT.dtypes()
         group_alerts = False
 
-        # Restore default limits
-        clientT.setLimit(nlimit)
-
     if return_raw:
         return results
 
+    if progress is not None:
+        progress(0.6)
+
     # We want to return alerts
     # color computation is disabled
     pdfs = format_hbase_output(
-        results, schema_client,
+        results, dtypes,
         group_alerts=group_alerts,
         extract_color=False,
         truncated=truncated,
-        with_constellation=True
+        with_constellation=True,
+        columns=columns
     )
 
     return pdfs
@@ -510,39 +730,24 @@ def return_sso_pdf(payload: dict) -> pd.DataFrame:
     else:
         truncated = True
 
-    if ',' in payload['n_or_d']:
-        # multi-objects search
-        splitids = payload['n_or_d'].replace(' ', '').split(',')
+    # Derived columns are replaced by the columns needed to compute them
+    cols, columns = select_columns(cols)
 
-        # Note the trailing _ to avoid mixing e.g. 91 and 915 in the same query
-        names = ['key:key:{}_'.format(i.strip()) for i in splitids]
-    else:
-        # single object search
-        # Note the trailing _ to avoid mixing e.g. 91 and 915 in the same query
-        names = ["key:key:{}_".format(payload['n_or_d'].replace(' ', ''))]
+    names = sso_keys(payload)
 
     # Get data from the main table
-    results = java.util.TreeMap()
-    for to_evaluate in names:
-        result = clientSSO.scan(
-            "",
-            to_evaluate,
-            cols,
-            0, True, True
-        )
-        results.putAll(result)
+    results, timings = multi_scan(clientSSO, names, cols)
+    record_scan_timings(timings)
 
-    schema_client = clientSSO.schema()
-
-    # reset the limit in case it has been changed above
-    clientSSO.setLimit(nlimit)
+    dtypes = clientSSO.dtypes()
 
     pdf = format_hbase_output(
         results,
-        schema_client,
+        dtypes,
         group_alerts=False,
         truncated=truncated,
-        extract_color=False
+        extract_color=False,
+        columns=columns
     )
 
     if 'withEphem' in payload:
@@ -574,6 +779,8 @@ def return_ssocand_pdf(payload: dict) -> pd.DataFrame:
 
     payload_name = payload['kind']
 
+    evaluation = None
+    range_scan = False
     if payload_name == 'orbParams':
         gen_client = clientSSOORB
 
@@ -594,10 +801,10 @@ def return_ssocand_pdf(payload: dict) -> pd.DataFrame:
         else:
             stop_date = Time.now().jd
 
-        gen_client.setRangeScan(True)
+        range_scan = True
 
         if trajectory_id is not None:
-            gen_client.setEvaluation("ssoCandId.equals('{}')".format(trajectory_id))
+            evaluation = "ssoCandId.equals('{}')".format(trajectory_id)
 
         to_evaluate = "key:key:{}_,key:key:{}_".format(start_date, stop_date)
 
@@ -605,25 +812,17 @@ def return_ssocand_pdf(payload: dict) -> pd.DataFrame:
         "",
         to_evaluate,
         '*',
-        0, False, False
+        0, False, False,
+        range_scan=range_scan, evaluation=evaluation
     )
 
-    schema_client = gen_client.schema()
-
-    # reset the limit in case it has been changed above
-    gen_client.setLimit(nlimit)
-    gen_client.setEvaluation("")
+    dtypes = gen_client.dtypes()
 
     if results.isEmpty():
         return pd.DataFrame({})
 
-    # Construct the dataframe
-    pdf = pd.DataFrame.from_dict(results, orient='index')
-
-    # Type conversion
-    pdf = pdf.astype(
-        {i: hbase_type_converter[schema_client.type(i)] for i in pdf.columns}
-    )
+    # Construct the dataframe, with type conversion
+    pdf = hbase_to_pandas(results, dtypes=dtypes)
 
     return pdf
 
@@ -651,6 +850,9 @@ def return_tracklet_pdf(payload: dict) -> pd.DataFrame:
     else:
         truncated = True
 
+    # Derived columns are replaced by the columns needed to compute them
+    cols, columns = select_columns(cols)
+
     if 'date' in payload:
         designation = payload['date']
     else:
@@ -672,17 +874,15 @@ def return_tracklet_pdf(payload: dict) -> pd.DataFrame:
         0, True, True
     )
 
-    schema_client = clientTRCK.schema()
-
-    # reset the limit in case it has been changed above
-    clientTRCK.setLimit(nlimit)
+    dtypes = clientTRCK.dtypes()
 
     pdf = format_hbase_output(
         results,
-        schema_client,
+        dtypes,
         group_alerts=False,
         truncated=truncated,
-        extract_color=False
+        extract_color=False,
+        columns=columns
     )
 
     return pdf
@@ -731,9 +931,9 @@ def format_and_send_cutout(payload: dict) -> pd.DataFrame:
     )
 
     # Format the results
-    schema_client = client.schema()
+    dtypes = client.dtypes()
     pdf = format_hbase_output(
-        results, schema_client,
+        results, dtypes,
         group_alerts=False,
         truncated=True,
         extract_color=False
@@ -816,237 +1016,127 @@ def format_and_send_cutout(payload: dict) -> pd.DataFrame:
         as_attachment=True,
         attachment_filename=filename)
 
-def perform_xmatch(payload: dict) -> pd.DataFrame:
+def return_bayestar_pdf(payload: dict) -> pd.DataFrame:
     """ Extract data returned by HBase and jsonify it
 
-    Data is from /api/v1/xmatch
+    Data is from /api/v1/bayestar
 
     Parameters
     ----------
     payload: dict
-        See https://fink-portal.org/api/v1/xmatch
+        See https://fink-portal.org/api/v1/bayestar
 
     Return
     ----------
     out: pandas dataframe
     """
-    df = pd.read_csv(io.StringIO(payload['catalog']))
-
-    radius = float(payload['radius'])
-    if radius > 18000.:
-        rep = {
-            'status': 'error',
-            'text': "`radius` cannot be bigger than 18,000 arcseconds (5 degrees).\n"
-        }
-        return Response(str(rep), 400)
-
-    header = payload['header']
+    # Interpret user input
+    credible_level_threshold = float(payload['credible_level'])
 
-    header = [i.strip() for i in header.split(',')]
-    if len(header) == 3:
-        raname, decname, idname = header
-    elif len(header) == 4:
-        raname, decname, idname, timename = header
-    else:
+    try:
+        raw = decode_skymap(payload['bayestar'])
+        key = skymap_hash(raw)
+        (pixels, levels, order, jd), status = skymap_cache.get_or_compute(
+            key,
+            lambda: None,
+            lambda: credible_levels(raw, max_order=SKYMAP_MAX_ORDER)
+        )
+    except (ValueError, OSError, KeyError, IndexError) as e:
         rep = {
             'status': 'error',
-            'text': "Header should contain 3 or 4 entries from your catalog. E.g. RA,DEC,ID or RA,DEC,ID,Time\n"
+            'text': "Sky map cannot be read: {}\n".format(e)
         }
         return Response(str(rep), 400)
+    record_cache_status(status)
 
-    if 'window' in payload:
-        window_days = payload['window']
-    else:
-        window_days = None
-
-    # Fink columns of interest
-    colnames = [
-        'i:objectId', 'i:ra', 'i:dec', 'i:jd', 'd:cdsxmatch', 'i:ndethist'
-    ]
+    # TODO: use that to define the max skyfrac (in conjunction with level)
+    # skyfrac = len(region) * hp.nside2pixarea(2**order, degrees=True)
 
-    colnames_added_values = [
-        'd:cdsxmatch',
-        'd:roid',
-        'd:mulens_class_1',
-        'd:mulens_class_2',
-        'd:snn_snia_vs_nonia',
-        'd:snn_sn_vs_all',
-        'd:rf_snia_vs_nonia',
-        'i:ndethist',
-        'i:drb',
-        'i:classtar',
-        'd:rf_kn_vs_nonkn',
-        'i:jdstarthist'
-    ]
+    region = credible_region(pixels, levels, credible_level_threshold)
 
-    unique_cols = np.unique(colnames + colnames_added_values).tolist()
+    # 1 day before the event, to 6 days after the event
+    jdstart = jd - 1
+    jdend = jdstart + 6
 
-    # check units
-    ra0 = df[raname].values[0]
-    if 'h' in str(ra0):
-        coords = [
-            SkyCoord(ra, dec, frame='icrs')
-            for ra, dec in zip(df[raname].values, df[decname].values)
-        ]
-    elif ':' in str(ra0) or ' ' in str(ra0):
-        coords = [
-            SkyCoord(ra, dec, frame='icrs', unit=(u.hourangle, u.deg))
-            for ra, dec in zip(df[raname].values, df[decname].values)
+    if PIXEL_ORDERING == 'nested':
+        # Coarsest table keeping the over-fetch below the target, per region.
+        # Each cell is read with its own time-bounded scan.
+        cells, _ = multi_order_ranges(
+            region, order,
+            max_overfetch=BAYESTAR_OVERFETCH, max_cells=BAYESTAR_MAX_SPLIT
+        )
+        tables = {7: clientP128N, 12: clientP4096N, 17: clientP131072N}
+        scans = [
+            (tables[order_], range_keys(ranges, 2**order_, jdstart, jdend))
+            for order_, ranges in cells
         ]
     else:
-        coords = [
-            SkyCoord(ra, dec, frame='icrs', unit='deg')
-            for ra, dec in zip(df[raname].values, df[decname].values)
+        # Keys are not ordered by pixel: one time-bounded scan per pixel128
+        cells, _ = multi_order_ranges(region, order, orders=(7,))
+        pixs = [
+            pix for _, ranges in cells
+            for start, stop in ranges for pix in range(start, stop)
         ]
-    ras = [coord.ra.deg for coord in coords]
-    decs = [coord.dec.deg for coord in coords]
-    ids = df[idname].values
-
-    if len(header) == 4:
-        times = df[timename].values
-    else:
-        times = np.zeros_like(ras)
-
-    pdfs = pd.DataFrame(columns=unique_cols + [idname] + ['v:classification'])
-    for oid, ra, dec, time_start in zip(ids, ras, decs, times):
-        if len(header) == 4:
-            payload_data = {
-                'ra': ra,
-                'dec': dec,
-                'radius': radius,
-                'startdate_conesearch': time_start,
-                'window_days_conesearch': window_days
+        bounds = [
+            "key:key:{}_{},key:key:{}_{}".format(pix, jdstart, pix, jdend)
+            for pix in hp.nest2ring(128, np.array(pixs, dtype=np.int64))
+        ]
+        scans = [(clientP128, bounds)]
 
-            }
-        else:
-            payload_data = {
-                'ra': ra,
-                'dec': dec,
-                'radius': radius
-            }
-        r = requests.post(
-            '{}/api/v1/explorer'.format(APIURL),
-            json=payload_data
+    pdfs_ = [pd.DataFrame({'oid': [], 'jd': []})]
+    for pool, bounds in scans:
+        results, timings = range_scan(
+            pool, bounds, 'i:objectId', nthreads=SCAN_THREADS
         )
-        pdf = pd.read_json(r.content)
-
-        # Loop over results and construct the dataframe
-        if not pdf.empty:
-            pdf[idname] = [oid] * len(pdf)
-            if 'd:rf_kn_vs_nonkn' not in pdf.columns:
-                pdf['d:rf_kn_vs_nonkn'] = np.zeros(len(pdf), dtype=float)
-            pdfs = pd.concat((pdfs, pdf), ignore_index=True)
-
-    # Final join
-    join_df = pd.merge(
-        pdfs,
-        df,
-        on=idname
-    )
-
-    # reorganise columns order
-    no_duplicate = np.where(pdfs.columns != idname)[0]
-    cols = list(df.columns) + list(pdfs.columns[no_duplicate])
-    join_df = join_df[cols]
-
-    return join_df.to_json(orient='records')
-
-def return_bayestar_pdf(payload: dict) -> pd.DataFrame:
-    """ Extract data returned by HBase and jsonify it
-
-    Data is from /api/v1/bayestar
-
-    Parameters
-    ----------
-    payload: dict
-        See https://fink-portal.org/api/v1/bayestar
-
-    Return
-    ----------
-    out: pandas dataframe
-    """
-    # Interpret user input
-    bayestar_data = payload['bayestar']
-    credible_level_threshold = float(payload['credible_level'])
-
-    with gzip.open(io.BytesIO(eval(bayestar_data)), 'rb') as f:
-        with fits.open(io.BytesIO(f.read())) as hdul:
-            data = hdul[1].data
-            header = hdul[1].header
-
-    hpx = data['PROB']
-    if header['ORDERING'] == 'NESTED':
-        hpx = hp.reorder(hpx, n2r=True)
-
-    i = np.flipud(np.argsort(hpx))
-    sorted_credible_levels = np.cumsum(hpx[i])
-    credible_levels = np.empty_like(sorted_credible_levels)
-    credible_levels[i] = sorted_credible_levels
-
-    # TODO: use that to define the max skyfrac (in conjunction with level)
-    # npix = len(hpx)
-    # nside = hp.npix2nside(npix)
-    # skyfrac = np.sum(credible_levels <= 0.1) * hp.nside2pixarea(nside, degrees=True)
-
-    credible_levels_128 = hp.ud_grade(credible_levels, 128)
-
-    pixs = np.where(credible_levels_128 <= credible_level_threshold)[0]
-
-    # make a condition as well on the number of pixels?
-    # print(len(pixs), pixs)
-
-    # For the future: we could set clientP128.setRangeScan(True)
-    # and pass directly the time boundaries here instead of
-    # grouping by later.
+        record_scan_timings(timings)
 
-    # 1 day before the event, to 6 days after the event
-    jdstart = Time(header['DATE-OBS']).jd - 1
-    jdend = jdstart + 6
-
-    clientP128.setRangeScan(True)
-    results = java.util.TreeMap()
-    for pix in pixs:
-        to_search = "key:key:{}_{},key:key:{}_{}".format(pix, jdstart, pix, jdend)
-        result = clientP128.scan(
-            "",
-            to_search,
-            "*",
-            0, True, True
+        # extract objectId and times
+        pdfs_.append(
+            pd.DataFrame(
+                {
+                    'oid': [i[1]['i:objectId'] for i in results.items()],
+                    'jd': [float(i[1]['key:key'].split('_')[1]) for i in results.items()]
+                }
+            )
         )
-        results.putAll(result)
-
-    # extract objectId and times
-    objectids = [i[1]['i:objectId'] for i in results.items()]
-    times = [float(i[1]['key:key'].split('_')[1]) for i in results.items()]
-    pdf_ = pd.DataFrame({'oid': objectids, 'jd': times})
+    pdf_ = pd.concat(pdfs_, ignore_index=True)
+    nscanned = len(pdf_)
 
-    # Filter by time - logic to be improved...
+    # Filter by time
     pdf_ = pdf_[(pdf_['jd'] >= jdstart) & (pdf_['jd'] < jdend)]
 
     # groupby and keep only the last alert per objectId
     pdf_ = pdf_.loc[pdf_.groupby('oid')['jd'].idxmax()]
 
     # Get data from the main table
-    results = java.util.TreeMap()
-    for oid, jd in zip(pdf_['oid'].values, pdf_['jd'].values):
-        to_evaluate = "key:key:{}_{}".format(oid, jd)
-
-        result = client.scan(
-            "",
-            to_evaluate,
-            "*",
-            0, True, True
-        )
-        results.putAll(result)
-    schema_client = client.schema()
+    cols, fetched, columns = select_output_columns(
+        payload, ['i:objectId', 'i:jd', 'i:ra', 'i:dec']
+    )
+    results = fetch_alerts(pdf_, cols)
+    dtypes = client.dtypes()
 
     pdfs = format_hbase_output(
         results,
-        schema_client,
+        dtypes,
         group_alerts=True,
-        extract_color=False
+        extract_color=False,
+        columns=fetched
     )
 
+    # Cells are larger than the region on its boundary
+    if not pdfs.empty:
+        ipix = hp.ang2pix(
+            2**order, pdfs['i:ra'].values, pdfs['i:dec'].values,
+            nest=True, lonlat=True
+        )
+        pdfs = pdfs[np.isin(ipix, region)]
+
+    record_row_counts(nscanned, len(pdfs))
+
+    # Drop the columns only needed internally
+    if columns is not None:
+        pdfs = pdfs[[col for col in columns if col in pdfs.columns]]
+
     return pdfs
 
 def return_statistics_pdf(payload: dict) -> pd.DataFrame:
@@ -1079,17 +1169,32 @@ def return_statistics_pdf(payload: dict) -> pd.DataFrame:
         0, True, True
     )
 
-    pdf = pd.DataFrame.from_dict(results, orient='index')
+    pdf = hbase_to_pandas(results)
 
     return pdf
 
-def send_data(pdf, output_format):
-    """
+def send_data(pdf, output_format, chunksize: int = STREAM_CHUNKSIZE):
+    """ Send a DataFrame to the user in the requested format
+
+    json, ndjson, csv, parquet and arrow are streamed: rows are serialized
+    by chunks of `chunksize`, and sent as soon as they are ready.
+
+    Parameters
+    ----------
+    pdf: pd.DataFrame
+        Data to send
+    output_format: str
+        json, ndjson, csv, parquet, arrow, or votable
+    chunksize: int
+        Number of rows serialized at once
+
+    Returns
+    ----------
+    out: flask.Response
     """
-    if output_format == 'json':
-        return pdf.to_json(orient='records')
-    elif output_format == 'csv':
-        return pdf.to_csv(index=False)
+    if output_format in STREAMERS:
+        serializer, mimetype = STREAMERS[output_format]
+        return Response(serializer(pdf, chunksize), mimetype=mimetype)
     elif output_format == 'votable':
         f = io.BytesIO()
         table = Table.from_pandas(pdf)
@@ -1097,15 +1202,10 @@ def send_data(pdf, output_format):
         votable.writeto(vt, f)
         f.seek(0)
         return f.read()
-    elif output_format == 'parquet':
-        f = io.BytesIO()
-        pdf.to_parquet(f)
-        f.seek(0)
-        return f.read()
 
     rep = {
         'status': 'error',
-        'text': "Output format `{}` is not supported. Choose among json, csv, or parquet\n".format(output_format)
+        'text': "Output format `{}` is not supported. Choose among json, ndjson, csv, parquet, arrow, or votable\n".format(output_format)
     }
     return Response(str(rep), 400)
 
@@ -1138,6 +1238,9 @@ def return_random_pdf(payload: dict) -> pd.DataFrame:
     else:
         truncated = True
 
+    # Derived columns are replaced by the columns needed to compute them
+    cols, columns = select_columns(cols)
+
     if int(payload['n']) > 16:
         number = 16
     else:
@@ -1149,9 +1252,6 @@ def return_random_pdf(payload: dict) -> pd.DataFrame:
 
     # logic
     results = []
-    clientT.setLimit(1000)
-    clientT.setRangeScan(True)
-
     jd_low = Time('2019-11-02 03:00:00.0').jd
     jd_high = Time.now().jd
 
@@ -1176,7 +1276,8 @@ def return_random_pdf(payload: dict) -> pd.DataFrame:
             results = clientT.scan(
                 "",
                 "key:key:{},key:key:{}".format(jdstart, jdstop),
-                "", 0, False, False
+                "", 0, False, False,
+                limit=1000, range_scan=True
             )
 
     oids = list(dict(results).keys())
@@ -1185,23 +1286,19 @@ def return_random_pdf(payload: dict) -> pd.DataFrame:
     index_oid = np.random.randint(0, len(oids), number)
     oid = oids[index_oid]
 
-    client.setLimit(2000)
     # Get data from the main table
-    results = java.util.TreeMap()
-    for oid_ in oid:
-        result = client.scan(
-            "",
-            "key:key:{}".format(oid_),
-            "{}".format(cols),
-            0, False, False
-        )
-        results.putAll(result)
+    results, timings = multi_scan(
+        client,
+        ["key:key:{}".format(oid_) for oid_ in oid],
+        "{}".format(cols),
+        ifkey=False, iftime=False,
+        limit=2000
+    )
+    record_scan_timings(timings)
 
     pdf = format_hbase_output(
-        results, client.schema(), group_alerts=False, truncated=truncated
+        results, client.dtypes(), group_alerts=False, truncated=truncated,
+        columns=columns
     )
 
-    clientT.setLimit(nlimit)
-    client.setLimit(nlimit)
-
     return pdf
@@ -0,0 +1,461 @@
+# Copyright 2022 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Crossmatch of a user catalog with the Fink alerts
+
+All sources are matched at once, instead of one conesearch per source:
+
+1. the pixels of the index table overlapping each source are computed,
+2. each pixel touched by the catalog is read once from the index table,
+3. (source, alert) candidates are formed by a join on pixels, and the
+   latest alert per (source, object) is kept,
+4. candidate alerts are fetched from the main table by batches,
+5. separations are computed on arrays, and candidates beyond the
+   radius are dropped.
+
+Catalogs uploaded as files are read and crossmatched by chunks of rows
+(`stream_xmatch`), so that memory does not grow with the catalog size.
+"""
+import io
+
+import numpy as np
+import pandas as pd
+import healpy as hp
+import pyarrow.parquet as pq
+
+from astropy.time import Time
+
+from flask import Response
+
+from app import client
+from app import clientP128, clientP4096, clientP131072
+from app import SCAN_THREADS, XMATCH_CHUNKSIZE
+
+from apps.hbase import multi_scan, range_scan, hbase_to_pandas
+from apps.utils import format_hbase_output
+from apps.coordinates import parse_coordinates, angular_separation
+from apps.api.utils import fetch_alerts, record_scan_timings
+
+def index_table(radius_deg: float) -> tuple:
+    """ Pixel index table used for a given radius, as for /api/v1/explorer
+
+    Returns
+    ----------
+    nside: int
+    pool: apps.hbase.HBaseClientPool
+    """
+    radius = radius_deg * 3600.
+    if radius <= 30.:
+        return 131072, clientP131072
+    elif radius <= 1000.:
+        return 4096, clientP4096
+    return 128, clientP128
+
+def source_pixels(ras, decs, radius_deg: float, nside: int) -> pd.DataFrame:
+    """ Pixels (RING) overlapping the disc around each source
+
+    Parameters
+    ----------
+    ras, decs: array of float
+        Positions of the sources, in degree
+    radius_deg: float
+        Crossmatch radius, in degree
+    nside: int
+        Resolution of the pixel index table
+
+    Returns
+    ----------
+    out: pd.DataFrame
+        Columns `source` (position in the catalog) and `pixel`
+
+    Examples
+    ----------
+    >>> out = source_pixels([10., 10.], [20., 20.], 1. / 3600, 4096)
+    >>> sorted(out['source'].unique().tolist())
+    [0, 1]
+    """
+    vecs = hp.ang2vec(np.asarray(ras, dtype=float), np.asarray(decs, dtype=float), lonlat=True)
+    vecs = np.atleast_2d(vecs)
+    radius = np.radians(radius_deg)
+
+    pixels = [hp.query_disc(nside, vec, radius, inclusive=True) for vec in vecs]
+    sizes = [len(pixs) for pixs in pixels]
+
+    return pd.DataFrame(
+        {
+            'source': np.repeat(np.arange(len(vecs)), sizes),
+            'pixel': np.concatenate(pixels) if len(pixels) > 0 else np.array([], dtype=np.int64),
+        }
+    )
+
+def read_index(pool, pixels: pd.DataFrame, jdstarts=None, jdends=None) -> pd.DataFrame:
+    """ Read once every pixel touched by the catalog in a pixel index table
+
+    Parameters
+    ----------
+    pool: apps.hbase.HBaseClientPool
+        Pixel index table
+    pixels: pd.DataFrame
+        Output of `source_pixels`
+    jdstarts, jdends: np.ndarray, optional
+        Time window of each source. A pixel is read over the union
+        of the windows of the sources overlapping it.
+
+    Returns
+    ----------
+    out: pd.DataFrame
+        Columns `pixel`, `oid`, `jd` (float) and `key` (main table row key)
+    """
+    if jdstarts is None:
+        keys = ['key:key:{}'.format(pix) for pix in np.unique(pixels['pixel'].values)]
+        results, timings = multi_scan(pool, keys, 'i:objectId', nthreads=SCAN_THREADS)
+    else:
+        windows = pd.DataFrame(
+            {
+                'pixel': pixels['pixel'].values,
+                'jdstart': jdstarts[pixels['source'].values],
+                'jdend': jdends[pixels['source'].values],
+            }
+        ).groupby('pixel').agg({'jdstart': 'min', 'jdend': 'max'})
+        bounds = [
+            'key:key:{}_{},key:key:{}_{}'.format(pix, start, pix, end)
+            for pix, start, end in zip(windows.index, windows['jdstart'], windows['jdend'])
+        ]
+        results, timings = range_scan(pool, bounds, 'i:objectId', nthreads=SCAN_THREADS)
+    record_scan_timings(timings)
+
+    pdf = hbase_to_pandas(results)
+    if pdf.empty:
+        return pd.DataFrame(
+            {
+                'pixel': np.array([], dtype=np.int64),
+                'oid': np.array([], dtype=object),
+                'jd': np.array([], dtype=float),
+                'key': np.array([], dtype=object),
+            }
+        )
+
+    # Row keys are {pixel}_{jd}
+    parts = pd.Series(pdf.index).str.split('_', n=1, expand=True)
+    oids = pdf['i:objectId'].values
+
+    return pd.DataFrame(
+        {
+            'pixel': parts[0].astype(np.int64).values,
+            'oid': oids,
+            'jd': parts[1].astype(float).values,
+            # Main table row keys are {objectId}_{jd}, jd as written in the index
+            'key': [oid + '_' + jd for oid, jd in zip(oids, parts[1].values)],
+        }
+    )
+
+def crossmatch(ras, decs, radius_deg: float, jdstarts=None, jdends=None, progress=None) -> pd.DataFrame:
+    """ Find the latest alert of each object around each source
+
+    Parameters
+    ----------
+    ras, decs: array of float
+        Positions of the sources, in degree
+    radius_deg: float
+        Crossmatch radius, in degree
+    jdstarts, jdends: array of float, optional
+        Time window of each source: alerts with `jdstart <= jd < jdend`
+    progress: callable, optional
+        Called with the fraction of the work done
+
+    Returns
+    ----------
+    out: pd.DataFrame
+        One row per (source, object) match: `source` (position in the
+        catalog), all the alert columns, and `v:separation_degree`.
+        Sorted by source, then by separation.
+    """
+    ras = np.asarray(ras, dtype=float)
+    decs = np.asarray(decs, dtype=float)
+
+    nside, pool = index_table(radius_deg)
+    pixels = source_pixels(ras, decs, radius_deg, nside)
+    if progress is not None:
+        progress(0.1)
+
+    index = read_index(pool, pixels, jdstarts, jdends)
+    if progress is not None:
+        progress(0.4)
+
+    # (source, alert) candidates sharing a pixel
+    candidates = pd.merge(pixels, index, on='pixel')
+    if jdstarts is not None:
+        mask = (candidates['jd'] >= jdstarts[candidates['source'].values]) & \
+            (candidates['jd'] < jdends[candidates['source'].values])
+        candidates = candidates[mask]
+
+    # latest alert per object around each source
+    candidates = candidates.loc[candidates.groupby(['source', 'oid'])['jd'].idxmax()]
+    if len(candidates) == 0:
+        return pd.DataFrame({'source': []})
+
+    # Alerts are fetched once, even if they match several sources
+    alerts = candidates.drop_duplicates('key')
+    results = fetch_alerts(
+        pd.DataFrame(
+            {
+                'oid': alerts['oid'].values,
+                'jd': [key.split('_', 1)[1] for key in alerts['key'].values]
+            }
+        )
+    )
+    if progress is not None:
+        progress(0.8)
+
+    pdf = format_hbase_output(
+        results,
+        client.dtypes(),
+        group_alerts=False,
+        extract_color=False
+    )
+    if pdf.empty:
+        return pd.DataFrame({'source': []})
+
+    # index of the formatted alerts is the main table row key
+    matches = pd.merge(
+        candidates[['source', 'key']],
+        pdf,
+        left_on='key',
+        right_index=True
+    ).drop(columns=['key'])
+
+    sep = angular_separation(
+        ras[matches['source'].values], decs[matches['source'].values],
+        matches['i:ra'].values, matches['i:dec'].values
+    )
+    matches['v:separation_degree'] = sep
+    matches = matches[sep <= radius_deg]
+
+    return matches.sort_values(['source', 'v:separation_degree'], kind='mergesort')
+
+def to_jd(times) -> np.ndarray:
+    """ Convert times in UTC (iso, jd, or MJD) to jd, as /api/v1/explorer does
+    """
+    times = np.asarray(times).astype(str)
+    out = np.empty(len(times), dtype=float)
+
+    iso = np.char.find(times, ':') >= 0
+    jd = ~iso & (np.char.startswith(times, '24'))
+    mjd = ~iso & ~jd
+
+    if iso.any():
+        out[iso] = Time(list(times[iso])).jd
+    if jd.any():
+        out[jd] = times[jd].astype(float)
+    if mjd.any():
+        out[mjd] = Time(times[mjd].astype(float), format='mjd').jd
+
+    return out
+
+def parse_xmatch_args(payload: dict):
+    """ Check the arguments of /api/v1/xmatch
+
+    Parameters
+    ----------
+    payload: dict
+        See https://fink-portal.org/api/v1/xmatch
+
+    Returns
+    ----------
+    out: tuple or flask.Response
+        (radius in arcsecond, column names, time window in days).
+        Column names are RA, Dec, ID and optionally Time.
+        Error response if an argument is invalid.
+    """
+    radius = float(payload['radius'])
+    if radius > 18000.:
+        rep = {
+            'status': 'error',
+            'text': "`radius` cannot be bigger than 18,000 arcseconds (5 degrees).\n"
+        }
+        return Response(str(rep), 400)
+
+    header = [i.strip() for i in payload['header'].split(',')]
+    if len(header) not in [3, 4]:
+        rep = {
+            'status': 'error',
+            'text': "Header should contain 3 or 4 entries from your catalog. E.g. RA,DEC,ID or RA,DEC,ID,Time\n"
+        }
+        return Response(str(rep), 400)
+
+    if 'window' in payload and payload['window'] is not None:
+        window_days = float(payload['window'])
+    else:
+        window_days = 1.0
+
+    return radius, header, window_days
+
+def xmatch_catalog(df: pd.DataFrame, radius: float, header: list, window_days: float, progress=None) -> pd.DataFrame:
+    """ Crossmatch a user catalog, and join the matches to it
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        User catalog
+    radius: float
+        Crossmatch radius, in arcsecond
+    header: list of str
+        Names of the RA, Dec, ID and optionally Time columns
+    window_days: float
+        Time window in days, used if the Time column is given
+    progress: callable, optional
+        Called with the fraction of the work done
+
+    Returns
+    ----------
+    out: pd.DataFrame
+        Columns of the catalog, and of the matching alerts,
+        in the order of the catalog
+
+    Raises
+    ----------
+    ValueError
+        If coordinates cannot be parsed
+    """
+    ras, decs = parse_coordinates(df[header[0]].values, df[header[1]].values)
+
+    if len(header) == 4:
+        jdstarts = to_jd(df[header[3]].values)
+        jdends = jdstarts + window_days
+    else:
+        jdstarts, jdends = None, None
+
+    matches = crossmatch(
+        ras, decs, radius / 3600.,
+        jdstarts=jdstarts, jdends=jdends, progress=progress
+    )
+
+    if 'd:rf_kn_vs_nonkn' not in matches.columns and not matches.empty:
+        matches['d:rf_kn_vs_nonkn'] = np.zeros(len(matches), dtype=float)
+
+    # Final join, in the order of the catalog
+    catalog = df.reset_index(drop=True)
+    catalog['source'] = np.arange(len(catalog))
+    if matches.empty:
+        return catalog.iloc[:0].drop(columns=['source'])
+
+    join_df = pd.merge(
+        catalog,
+        matches,
+        on='source',
+        suffixes=('', '_fink')
+    ).drop(columns=['source'])
+
+    return join_df
+
+def perform_xmatch(payload: dict, progress=None) -> pd.DataFrame:
+    """ Extract data returned by HBase and format it in a Pandas dataframe
+
+    Data is from /api/v1/xmatch
+
+    Parameters
+    ----------
+    payload: dict
+        See https://fink-portal.org/api/v1/xmatch
+    progress: callable, optional
+        Called with the fraction of the work done,
+        see `apps.api.jobs.JobManager`
+
+    Return
+    ----------
+    out: pandas dataframe
+    """
+    df = pd.read_csv(io.StringIO(payload['catalog']))
+
+    args = parse_xmatch_args(payload)
+    if isinstance(args, Response):
+        return args
+
+    try:
+        return xmatch_catalog(df, *args, progress=progress)
+    except ValueError as e:
+        rep = {
+            'status': 'error',
+            'text': e
+        }
+        return Response(str(rep), 400)
+
+def read_catalog_chunks(stream, chunksize: int = XMATCH_CHUNKSIZE):
+    """ Read an uploaded catalog by chunks of rows
+
+    Parameters
+    ----------
+    stream: file-like object
+        Seekable binary stream, in CSV or parquet format.
+        Parquet is recognised by its magic number, and read one
+        row group at a time.
+    chunksize: int
+        Number of rows per chunk
+
+    Returns
+    ----------
+    out: generator of pd.DataFrame
+
+    Examples
+    ----------
+    >>> stream = io.BytesIO(b'ID,RA,Dec\\na,10.,20.\\nb,11.,21.\\nc,12.,22.\\n')
+    >>> [len(df) for df in read_catalog_chunks(stream, chunksize=2)]
+    [2, 1]
+    """
+    magic = stream.read(4)
+    stream.seek(0)
+
+    if magic == b'PAR1':
+        # Row groups are read one at a time, and split into chunks
+        parquet = pq.ParquetFile(stream)
+        for index in range(parquet.num_row_groups):
+            table = parquet.read_row_group(index)
+            for start in range(0, table.num_rows, chunksize):
+                yield table.slice(start, chunksize).to_pandas()
+    else:
+        for df in pd.read_csv(stream, chunksize=chunksize):
+            yield df
+
+def stream_xmatch(stream, radius: float, header: list, window_days: float, chunksize: int = XMATCH_CHUNKSIZE):
+    """ Crossmatch an uploaded catalog, one chunk of rows at a time
+
+    Only one chunk of the catalog, and its matches, are in memory at once.
+
+    Parameters
+    ----------
+    stream: file-like object
+        Catalog in CSV or parquet format, see `read_catalog_chunks`
+    radius, header, window_days:
+        See `parse_xmatch_args`
+    chunksize: int
+        Number of rows of the catalog crossmatched at once
+
+    Returns
+    ----------
+    out: generator of pd.DataFrame
+        Matches of each chunk, see `xmatch_catalog`. At least one
+        (possibly empty) DataFrame is generated.
+
+    Raises
+    ----------
+    ValueError
+        If a chunk cannot be read, or its coordinates cannot be parsed
+    """
+    empty = True
+    for df in read_catalog_chunks(stream, chunksize):
+        empty = False
+        yield xmatch_catalog(df, radius, header, window_days)
+
+    if empty:
+        yield pd.DataFrame()
@@ -0,0 +1,206 @@
+# Copyright 2022 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Bounded LRU cache of query results, revalidated by a cheap probe
+
+Alerts stored in HBase never change: an object only gains new alerts.
+A cached result therefore stays valid as long as a signature of the
+underlying rows (e.g. the latest row key of each object) is unchanged,
+and this signature is much cheaper to obtain than the full result.
+"""
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+def estimate_size(value) -> int:
+    """ Approximate memory footprint of a cached value, in bytes
+    """
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True, index=True).sum())
+    elif isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    elif isinstance(value, (list, tuple)):
+        return sum([estimate_size(i) for i in value])
+    return sys.getsizeof(value)
+
+def copy_value(value):
+    """ Copy DataFrames, so that callers modifying them do not alter the cache
+
+    A shallow copy shares its column data with the cached frame, and
+    in-place writes to existing columns would reach the cache: DataFrames
+    are copied entirely. Arrays are returned as they are (cached arrays
+    are made read-only, see `apps.skymap.credible_levels`).
+
+    Examples
+    ----------
+    >>> pdf = pd.DataFrame({'a': [1, 2]})
+    >>> out = copy_value((pdf, 1))
+    >>> out[0].loc[0, 'a'] = 10
+    >>> pdf['a'].tolist()
+    [1, 2]
+    """
+    if isinstance(value, pd.DataFrame):
+        return value.copy(deep=True)
+    elif isinstance(value, tuple):
+        return tuple([copy_value(i) for i in value])
+    elif isinstance(value, list):
+        return [copy_value(i) for i in value]
+    return value
+
+class ResultCache:
+    """ Thread-safe LRU cache with entry- and memory-based eviction
+
+    Each entry stores a value and the signature it was computed for.
+    On lookup, the signature is computed again (cheap probe): the entry
+    is served if it matches, and recomputed otherwise.
+
+    Parameters
+    ----------
+    max_entries: int
+        Maximum number of entries
+    max_bytes: int
+        Maximum memory used by the cached values, in bytes
+    name: str
+        Name used in reports
+
+    Examples
+    ----------
+    >>> cache = ResultCache(max_entries=2, max_bytes=10**6)
+    >>> value, status = cache.get_or_compute('a', lambda: 1, lambda: [1, 2])
+    >>> status
+    'miss'
+    >>> value, status = cache.get_or_compute('a', lambda: 1, lambda: [1, 2])
+    >>> status
+    'hit'
+    >>> value, status = cache.get_or_compute('a', lambda: 2, lambda: [1, 2, 3])
+    >>> status, value
+    ('stale', [1, 2, 3])
+    >>> cache.report()['hit_ratio']
+    0.3333333333333333
+    """
+    def __init__(self, max_entries: int = 256, max_bytes: int = 512 * 1024**2, name: str = 'cache'):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.name = name
+
+        # key -> (signature, value, size)
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+
+    def get_or_compute(self, key, signature, compute) -> tuple:
+        """ Return the cached value for key if still valid, compute it otherwise
+
+        Parameters
+        ----------
+        key: hashable
+            Cache key
+        signature: callable
+            Return the current signature of the data (cheap probe)
+        compute: callable
+            Return the value (expensive)
+
+        Returns
+        ----------
+        value: Any
+            Cached or computed value
+        status: str
+            `hit`, `miss` (no entry) or `stale` (entry recomputed)
+        """
+        current = signature()
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == current:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self.bytes_saved += entry[2]
+                return copy_value(entry[1]), 'hit'
+
+        value = compute()
+        status = 'miss' if entry is None else 'stale'
+        self.put(key, current, value, status)
+
+        return copy_value(value), status
+
+    def put(self, key, signature, value, status: str = 'miss'):
+        """ Store a value, evicting least recently used entries if needed
+        """
+        size = estimate_size(value)
+
+        with self.lock:
+            if status == 'stale':
+                self.stale += 1
+            else:
+                self.misses += 1
+
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[2]
+
+            # Values larger than the cache itself are not stored
+            if size > self.max_bytes:
+                return
+
+            self.entries[key] = (signature, value, size)
+            self.nbytes += size
+
+            while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+                _, (_, _, size_) = self.entries.popitem(last=False)
+                self.nbytes -= size_
+                self.evictions += 1
+
+    def clear(self):
+        """ Remove all entries (statistics are kept)
+        """
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def report(self) -> dict:
+        """ Statistics of the cache
+        """
+        with self.lock:
+            nlookups = self.hits + self.misses + self.stale
+            return {
+                'name': self.name,
+                'entries': len(self.entries),
+                'bytes': self.nbytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / nlookups if nlookups > 0 else 0.0,
+                'bytes_saved': self.bytes_saved,
+            }
+
+    def format_report(self) -> str:
+        """ Human readable statistics of the cache
+        """
+        report = self.report()
+        return '{}: {} entries ({:.1f} MB), hit ratio {:.1%} ({} hits, {} misses, {} stale), {:.1f} MB saved'.format(
+            report['name'], report['entries'], report['bytes'] / 1024**2,
+            report['hit_ratio'], report['hits'], report['misses'], report['stale'],
+            report['bytes_saved'] / 1024**2
+        )
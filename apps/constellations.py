@@ -0,0 +1,174 @@
+# Copyright 2022 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Constellation lookup based on a precomputed HEALPix map
+
+Constellation boundaries are fixed, so instead of calling
+astropy `get_constellation` for each alert, we evaluate it once
+at the centre of every pixel of a HEALPix map. Pixels close
+to a boundary are flagged, and positions falling in them are
+resolved exactly with `get_constellation`.
+"""
+import os
+import zipfile
+import tempfile
+import threading
+
+import healpy as hp
+import numpy as np
+
+from astropy.coordinates import SkyCoord, get_constellation
+
+# ~13.7 arcmin pixels, 786,432 pixels in total
+NSIDE = 256
+
+# nside -> (names, index, boundary)
+CONSTELLATION_MAPS = {}
+
+# Only one thread of a process builds (or loads) a map
+CONSTELLATION_MAPS_LOCK = threading.Lock()
+
+def build_constellation_map(nside: int = NSIDE) -> tuple:
+    """ Evaluate constellations at the centre of all HEALPix pixels (RING)
+
+    Parameters
+    ----------
+    nside: int
+        HEALPix resolution
+
+    Returns
+    ----------
+    names: np.array of str
+        Constellation names
+    index: np.array of uint8
+        For each pixel, the index of its constellation in `names`
+    boundary: np.array of bool
+        True for pixels that are (or touch a pixel that is)
+        next to a pixel in another constellation
+    """
+    npix = hp.nside2npix(nside)
+    ra, dec = hp.pix2ang(nside, np.arange(npix), lonlat=True)
+
+    values = get_constellation(SkyCoord(ra, dec, unit='deg'))
+    names, index = np.unique(values, return_inverse=True)
+    index = index.astype(np.uint8)
+
+    # (8, npix), -1 when a neighbour does not exist
+    neighbours = hp.get_all_neighbours(nside, np.arange(npix))
+
+    boundary = np.zeros(npix, dtype=bool)
+    for ring in neighbours:
+        valid = ring >= 0
+        boundary[valid] |= index[ring[valid]] != index[valid]
+
+    # Widen by one pixel to catch boundary corners
+    # that do not reach the centre of any neighbour
+    widened = boundary.copy()
+    for ring in neighbours:
+        valid = ring >= 0
+        widened[valid] |= boundary[ring[valid]]
+
+    return names, index, widened
+
+def load_constellation_map(nside: int = NSIDE, path: str = None) -> tuple:
+    """ Load the constellation map, building it on first use
+
+    The map is kept in memory, and stored on disk so that
+    other workers (or the next start) do not rebuild it.
+
+    Parameters
+    ----------
+    nside: int
+        HEALPix resolution
+    path: str
+        Location of the map on disk. Default is
+        the temporary directory of the system.
+
+    Returns
+    ----------
+    out: tuple
+        (names, index, boundary), see `build_constellation_map`
+    """
+    if nside in CONSTELLATION_MAPS:
+        return CONSTELLATION_MAPS[nside]
+
+    with CONSTELLATION_MAPS_LOCK:
+        # Built by another thread meanwhile
+        if nside in CONSTELLATION_MAPS:
+            return CONSTELLATION_MAPS[nside]
+
+        if path is None:
+            path = os.path.join(
+                tempfile.gettempdir(),
+                'fink_constellations_nside{}.npz'.format(nside)
+            )
+
+        out = None
+        if os.path.exists(path):
+            try:
+                with np.load(path) as data:
+                    out = data['names'], data['index'], data['boundary']
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+                # e.g. truncated file -- rebuild and overwrite it
+                print('Constellation map on disk cannot be read: {}'.format(e))
+
+        if out is None:
+            out = build_constellation_map(nside)
+            try:
+                # write aside first, so that a reader never sees a partial file
+                tmp = '{}.{}.{}'.format(path, os.getpid(), threading.get_ident())
+                with open(tmp, 'wb') as f:
+                    np.savez(f, names=out[0], index=out[1], boundary=out[2])
+                os.replace(tmp, path)
+            except OSError as e:
+                print('Constellation map not stored on disk: {}'.format(e))
+
+        CONSTELLATION_MAPS[nside] = out
+    return out
+
+def lookup_constellation(ra, dec, nside: int = NSIDE) -> np.array:
+    """ Constellation names for arrays of positions (ICRS, degree)
+
+    Agrees with astropy `get_constellation`: positions in pixels
+    close to a boundary are resolved with it directly.
+
+    Parameters
+    ----------
+    ra: array-like
+        Right ascension, in degree
+    dec: array-like
+        Declination, in degree
+    nside: int
+        HEALPix resolution of the lookup map
+
+    Returns
+    ----------
+    out: np.array of str
+        Constellation names (full names, as `get_constellation`)
+    """
+    names, index, boundary = load_constellation_map(nside)
+
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+
+    ipix = hp.ang2pix(nside, ra, dec, lonlat=True)
+    out = names[index[ipix]]
+
+    mask = boundary[ipix]
+    if np.any(mask):
+        out[mask] = get_constellation(
+            SkyCoord(ra[mask], dec[mask], unit='deg')
+        )
+
+    return out
@@ -0,0 +1,247 @@
+# Copyright 2022 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Vectorized parsing of user coordinates (single positions or catalogs)
+
+The format of a column is detected once, from its first value, as for a
+single position: RA containing `h`, `:` or spaces is in hours, otherwise
+in degree. Decimal values and sexagesimal strings (`12:55:17.2`,
+`12 55 17.2`, `12h55m17.2s`, `+02d53m50.3s`) are parsed on whole arrays.
+Values that cannot be parsed this way are handed over to astropy, which
+either understands them or raises the usual ValueError.
+"""
+import io
+
+import numpy as np
+import pandas as pd
+
+import astropy.units as u
+from astropy.coordinates import Angle
+
+# Separators of sexagesimal strings (signs are handled separately)
+SEPARATORS = str.maketrans({char: ' ' for char in '+-hdms:\'"°'})
+
+def is_hourangle(value) -> bool:
+    """ Whether a Right Ascension value is expressed in hours
+
+    Examples
+    ----------
+    >>> is_hourangle('12h55m17.218s'), is_hourangle('12:55:17.2'), is_hourangle('12 55 17.2')
+    (True, True, True)
+    >>> is_hourangle(193.822), is_hourangle('193d49m18.267s')
+    (False, False)
+    """
+    value = str(value).strip()
+    return ('h' in value) or (':' in value) or (' ' in value)
+
+def is_decimal(value) -> bool:
+    """ Whether an angle is a decimal number
+
+    Examples
+    ----------
+    >>> is_decimal('193.822'), is_decimal('-1e-3'), is_decimal('12:55:17.2')
+    (True, True, False)
+    """
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+def parse_sexagesimal(text: np.ndarray) -> np.ndarray:
+    """ Sum the components of sexagesimal strings: a + b / 60 + c / 3600
+
+    All strings are parsed at once by the C parser of pandas,
+    after turning separators into spaces.
+
+    Parameters
+    ----------
+    text: np.ndarray of str
+        Stripped sexagesimal strings, with at most three components
+
+    Returns
+    ----------
+    out: np.ndarray of float64
+        Values in the unit of the first component. NaN for
+        the strings that could not be parsed.
+    """
+    out = np.full(len(text), np.nan)
+    sign = np.where(np.char.startswith(text, '-'), -1., 1.)
+
+    content = '\n'.join(text.tolist()).translate(SEPARATORS)
+    try:
+        parts = pd.read_csv(
+            io.StringIO(content), sep=r'\s+', header=None,
+            names=[0, 1, 2, 3], skip_blank_lines=False, dtype=str
+        )
+    except (ValueError, pd.errors.ParserError):
+        return out
+    if len(parts) != len(text):
+        return out
+
+    # More than three components: not sexagesimal
+    extra = parts[3].notnull().values
+
+    parts = parts[[0, 1, 2]].apply(pd.to_numeric, errors='coerce').values.astype(np.float64)
+    parts[extra, 0] = np.nan
+
+    # Missing trailing components are 0, but not the leading one
+    parts[:, 1:] = np.where(
+        np.isnan(parts[:, 1:]) & ~np.isnan(parts[:, :1]), 0., parts[:, 1:]
+    )
+
+    return sign * (parts[:, 0] + parts[:, 1] / 60. + parts[:, 2] / 3600.)
+
+def parse_angles(values, hourangle: bool = False) -> np.ndarray:
+    """ Convert an array of angles to degree
+
+    Parameters
+    ----------
+    values: array of float or str
+        Decimal or sexagesimal angles
+    hourangle: bool
+        If True, values are in hours (and converted to degree)
+
+    Returns
+    ----------
+    out: np.ndarray of float64
+        Angles in degree
+
+    Examples
+    ----------
+    >>> parse_angles(['12:55:17.218', '-00:30:00', '12'], hourangle=True).round(6).tolist()
+    [193.821742, -7.5, 180.0]
+    >>> parse_angles(['+02d53m50.35s', '2.5']).round(6).tolist()
+    [2.897319, 2.5]
+    >>> parse_angles(['2.5', '+02d53m50.35s']).round(6).tolist()
+    [2.5, 2.897319]
+    >>> try:
+    ...     parse_angles(['kfdlkj'])
+    ... except ValueError:
+    ...     print('invalid')
+    invalid
+    """
+    values = np.asarray(values)
+    factor = 15. if hourangle else 1.
+
+    if values.dtype.kind in 'iuf':
+        return values.astype(np.float64) * factor
+
+    text = np.char.strip(values.astype(str))
+    if len(text) == 0:
+        return np.array([], dtype=np.float64)
+
+    # The format is detected from the first value
+    if is_decimal(text[0]):
+        out = pd.to_numeric(pd.Series(text), errors='coerce').values.astype(np.float64)
+    else:
+        out = parse_sexagesimal(text)
+
+    out *= factor
+
+    # Anything else: let astropy parse it, or raise
+    unit = u.hourangle if hourangle else u.deg
+    for position in np.where(np.isnan(out))[0]:
+        out[position] = Angle(str(values[position]), unit=unit).deg
+
+    return out
+
+def parse_coordinates(ras, decs) -> tuple:
+    """ Convert arrays of user coordinates (ICRS) to degree
+
+    The format is detected once from the first Right Ascension.
+    Right Ascensions are wrapped into [0, 360).
+
+    Parameters
+    ----------
+    ras, decs: array of float or str
+        Right Ascension and Declination
+
+    Returns
+    ----------
+    ra, dec: np.ndarray of float64
+        Coordinates in degree
+
+    Raises
+    ----------
+    ValueError
+        If a value cannot be parsed, is not finite, or if a
+        Declination is outside [-90, 90] degrees
+
+    Examples
+    ----------
+    >>> ra, dec = parse_coordinates(['12h55m17.218s'], ['+02d53m50.35s'])
+    >>> float(round(ra[0], 5)), float(round(dec[0], 5))
+    (193.82174, 2.89732)
+    >>> ra, dec = parse_coordinates([193.822, 10.], [2.89732, -5.])
+    >>> ra.tolist(), dec.tolist()
+    ([193.822, 10.0], [2.89732, -5.0])
+    >>> ra, dec = parse_coordinates(['370', '-10'], ['0', '0'])
+    >>> ra.tolist()
+    [10.0, 350.0]
+    >>> try:
+    ...     parse_coordinates(['370'], ['95'])
+    ... except ValueError as e:
+    ...     print(e)
+    Latitude angle(s) must be within -90 deg <= angle <= 90 deg, got 95.0 deg
+    """
+    ras = np.atleast_1d(np.asarray(ras))
+    decs = np.atleast_1d(np.asarray(decs))
+
+    if len(ras) == 0:
+        return np.array([], dtype=np.float64), np.array([], dtype=np.float64)
+
+    hourangle = ras.dtype.kind not in 'iuf' and is_hourangle(ras[0])
+
+    ra = parse_angles(ras, hourangle=hourangle)
+    dec = parse_angles(decs)
+
+    if not (np.all(np.isfinite(ra)) and np.all(np.isfinite(dec))):
+        raise ValueError('Coordinates must be finite numbers')
+
+    outside = np.abs(dec) > 90.
+    if np.any(outside):
+        raise ValueError(
+            'Latitude angle(s) must be within -90 deg <= angle <= 90 deg, got {} deg'.format(
+                dec[outside][0]
+            )
+        )
+
+    return np.mod(ra, 360.), dec
+
+def angular_separation(ra1, dec1, ra2, dec2) -> np.ndarray:
+    """ Angular separation between positions, in degree (Vincenty formula)
+
+    Parameters
+    ----------
+    ra1, dec1, ra2, dec2: array of float
+        Positions in degree
+
+    Returns
+    ----------
+    sep: np.ndarray
+
+    Examples
+    ----------
+    >>> angular_separation(np.array([10., 0.]), np.array([0., 89.]), np.array([11., 180.]), np.array([0., 89.]))
+    array([1., 2.])
+    """
+    ra1, dec1, ra2, dec2 = [np.radians(np.asarray(i, dtype=float)) for i in [ra1, dec1, ra2, dec2]]
+    dra = ra2 - ra1
+
+    num1 = np.cos(dec2) * np.sin(dra)
+    num2 = np.cos(dec1) * np.sin(dec2) - np.sin(dec1) * np.cos(dec2) * np.cos(dra)
+    denominator = np.sin(dec1) * np.sin(dec2) + np.cos(dec1) * np.cos(dec2) * np.cos(dra)
+
+    return np.degrees(np.arctan2(np.hypot(num1, num2), denominator))
@@ -0,0 +1,744 @@
+# Copyright 2022 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+import queue
+import bisect
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import jpype
+
+import numpy as np
+import pandas as pd
+
+# Python types corresponding to HBase schema types
+hbase_type_converter = {
+    'integer': int,
+    'long': int,
+    'float': float,
+    'double': float,
+    'string': str,
+    'fits/image': str
+}
+
+# Limit of clients of pools without limit, once a scan was limited
+# (the Lomikel default cannot be read back)
+NO_LIMIT = 2**31 - 1
+
+
+class HBaseClientPool:
+    """ Thread-safe pool of HBase clients connected to the same table
+
+    `com.Lomikel.HBaser.HBaseClient` instances are stateful (limit, range
+    scan, reversed order, evaluation). Sharing one instance between
+    concurrent requests leaks the scan settings of one request into
+    another. Instead, each request borrows its own client from the pool:
+    scan settings are applied when the client is handed over, and reset
+    to their defaults when it is returned.
+
+    Examples
+    ----------
+    >>> pool = HBaseClientPool('localhost', 2181, 'test_sp', 'schema_2.2_2.0.0') # doctest: +SKIP
+    >>> with pool.borrow(limit=10, range_scan=True) as client: # doctest: +SKIP
+    ...     results = client.scan("", "key:key:a,key:key:b", "*", 0, True, True)
+    """
+    def __init__(
+            self, host: str, port: int, tablename: str, schema_version: str,
+            size: int = 4, limit: int = None, timeout: float = None,
+            executor: ThreadPoolExecutor = None):
+        """ Clients are connected on demand: no connection is made
+        until the first client is borrowed.
+
+        Parameters
+        ----------
+        host: str
+            HBase (ZooKeeper) IP
+        port: int
+            ZooKeeper port
+        tablename: str
+            Name of the HBase table
+        schema_version: str
+            Version of the schema stored in the table
+        size: int
+            Maximum number of clients simultaneously connected. Default is 4.
+        limit: int
+            Default limit on the number of rows returned by a scan. If None,
+            the Lomikel default is kept.
+        timeout: float
+            Time in seconds to wait for a client to be released when all
+            clients are in use. Default is None (wait forever).
+        executor: ThreadPoolExecutor
+            Worker threads running the concurrent scans of `multi_scan`
+            and `range_scan`. Default is a new executor with `size` workers.
+        """
+        self.host = host
+        self.port = port
+        self.tablename = tablename
+        self.schema_version = schema_version
+        self.size = size
+        self.limit = limit
+        self.timeout = timeout
+
+        # Workers are long-lived: they attach to the JVM once (see `borrow`)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=size)
+        self.executor = executor
+
+        self._clients = queue.LifoQueue()
+        self._nclients = 0
+        self._lock = threading.Lock()
+
+        # Time in seconds spent to connect each client
+        self.connection_times = []
+
+        # Schema of the table, loaded once
+        self._schema = None
+        self._dtypes = None
+
+    @property
+    def connected(self) -> bool:
+        """ True if at least one client has been connected to the table
+        """
+        return len(self.connection_times) > 0
+
+    def _connect(self):
+        """ Instantiate a new client, and connect it to the table
+        """
+        t0 = time.time()
+        HBaseClient = jpype.JClass('com.Lomikel.HBaser.HBaseClient')
+        client = HBaseClient(self.host, self.port)
+        client.connect(self.tablename, self.schema_version)
+        self._reset(client)
+        with self._lock:
+            self.connection_times.append(time.time() - t0)
+        return client
+
+    def _reset(self, client):
+        """ Restore default scan settings of a client
+        """
+        if self.limit is not None:
+            client.setLimit(self.limit)
+        client.setRangeScan(False)
+        client.setReversed(False)
+        client.setEvaluation("")
+
+    def _acquire(self):
+        """ Get an idle client, or connect a new one if the pool is not full
+        """
+        try:
+            return self._clients.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = self._nclients < self.size
+            if create:
+                self._nclients += 1
+
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._nclients -= 1
+                raise
+
+        return self._clients.get(timeout=self.timeout)
+
+    def _release(self, client, limited: bool = False):
+        """ Reset a client, and put it back in the pool
+
+        If `limited` is True, a limit was set on a client of a pool
+        without limit: it is lifted.
+        """
+        try:
+            self._reset(client)
+            if limited and self.limit is None:
+                client.setLimit(NO_LIMIT)
+        except Exception:
+            # The client is in an unknown state -- drop it
+            with self._lock:
+                self._nclients -= 1
+            return
+        self._clients.put(client)
+
+    @contextmanager
+    def borrow(
+            self, limit: int = None, range_scan: bool = False,
+            reverse: bool = False, evaluation: str = None):
+        """ Borrow a client from the pool, with the given scan settings
+
+        Settings are reset when leaving the context.
+
+        Parameters
+        ----------
+        limit: int
+            Maximum number of rows returned by a scan. Default is the
+            limit of the pool.
+        range_scan: bool
+            If True, the keys are interpreted as boundaries of a range.
+        reverse: bool
+            If True, rows are returned in reverse order.
+        evaluation: str
+            Server-side filter expression (e.g. "ssoCandId.equals('x')")
+
+        Returns
+        ----------
+        client: com.Lomikel.HBaser.HBaseClient
+        """
+        if not jpype.isThreadAttachedToJVM():
+            jpype.attachThreadToJVM()
+
+        client = self._acquire()
+        try:
+            if limit is not None:
+                client.setLimit(limit)
+            if range_scan:
+                client.setRangeScan(True)
+            if reverse:
+                client.setReversed(True)
+            if evaluation is not None:
+                client.setEvaluation(evaluation)
+            yield client
+        finally:
+            self._release(client, limited=limit is not None)
+
+    def scan(self, *args, **settings):
+        """ Scan the table using a borrowed client
+
+        Positional arguments are passed to `HBaseClient.scan`, and keyword
+        arguments to `HBaseClientPool.borrow`.
+        """
+        with self.borrow(**settings) as client:
+            return client.scan(*args)
+
+    def schema(self):
+        """ Return the schema of the table
+
+        The schema is fetched once, and cached until `invalidate_schema`
+        is called.
+        """
+        if self._schema is None:
+            with self.borrow() as client:
+                self._schema = client.schema()
+        return self._schema
+
+    def dtypes(self) -> dict:
+        """ Return the mapping column name -> Python type for the table
+
+        Returns
+        ----------
+        out: dict
+            e.g. {'i:jd': float, 'i:fid': int, 'i:objectId': str, ...}
+        """
+        if self._dtypes is None:
+            schema = self.schema()
+            dtypes = {}
+            for name in schema.columnNames():
+                kind = str(schema.type(name))
+                if kind in hbase_type_converter:
+                    dtypes[str(name)] = hbase_type_converter[kind]
+            self._dtypes = dtypes
+        return self._dtypes
+
+    def invalidate_schema(self):
+        """ Forget the cached schema (e.g. after a change of SCHEMAVER)
+        """
+        self._schema = None
+        self._dtypes = None
+
+    def warmup(self):
+        """ Connect one client to the table, if not yet connected
+        """
+        with self.borrow():
+            pass
+
+
+def rows_over_limit(rows: list, keys: list, limit: int) -> list:
+    """ Rows beyond the first `limit` rows of each row-key prefix
+
+    Parameters
+    ----------
+    rows: list of str
+        Sorted row keys returned by a scan
+    keys: list of str
+        Row-key prefixes of the scan, e.g. ['key:key:ZTF21abfmbix', ...]
+    limit: int
+        Maximum number of rows per prefix
+
+    Returns
+    ----------
+    out: list of str
+        Row keys to drop
+
+    Examples
+    ----------
+    >>> rows_over_limit(['a_1', 'a_2', 'a_3', 'b_1'], ['key:key:a', 'key:key:b'], 2)
+    ['a_3']
+    >>> rows_over_limit(['a_1', 'ab_1', 'ab_2'], ['key:key:a', 'key:key:ab'], 1)
+    ['ab_2']
+    """
+    prefixes = sorted(key.replace('key:key:', '', 1) for key in keys)
+
+    counts = {}
+    out = []
+    for row in rows:
+        row = str(row)
+
+        # Longest prefix of the row
+        index = bisect.bisect_right(prefixes, row) - 1
+        while index >= 0 and not row.startswith(prefixes[index]):
+            index -= 1
+        if index < 0:
+            continue
+
+        counts[index] = counts.get(index, 0) + 1
+        if counts[index] > limit:
+            out.append(row)
+    return out
+
+def multi_scan(
+        pool: HBaseClientPool, keys: list, columns: str = '*',
+        ifkey: bool = True, iftime: bool = True, batch_size: int = 100,
+        nthreads: int = None, limit: int = None):
+    """ Scan several row-key prefixes using a bounded number of scans
+
+    Keys are sent by batches of `batch_size` in a single comma-separated
+    scan, instead of one scan per key. Batches are dispatched concurrently
+    on the worker threads of the pool, each with a client borrowed
+    from the pool.
+
+    Parameters
+    ----------
+    pool: HBaseClientPool
+        Pool of clients connected to the table to scan
+    keys: list of str
+        Row-key prefixes, e.g. ['key:key:ZTF21abfmbix', ...]
+    columns: str
+        Comma-separated columns to return. Default is all ('*').
+    ifkey: bool
+        If True, return the `key:key` column. Default is True.
+    iftime: bool
+        If True, return the `key:time` column. Default is True.
+    batch_size: int
+        Maximum number of keys per scan. Default is 100.
+    nthreads: int
+        Maximum number of concurrent scans. Default is the size of the pool.
+    limit: int
+        Maximum number of rows returned per key, as for individual
+        scans. Default is the limit of the pool.
+
+    Returns
+    ----------
+    results: java.util.TreeMap
+        Merged results of all scans
+    timings: list of dict
+        For each batch: table name, number of keys, number of rows
+        returned, duration in seconds.
+    """
+    if nthreads is None:
+        nthreads = pool.size
+
+    if limit is None:
+        limit = pool.limit
+
+    batches = [keys[i: i + batch_size] for i in range(0, len(keys), batch_size)]
+
+    def scan_batch(batch):
+        t0 = time.time()
+        if limit is not None:
+            # Total of the per-key limits: the scan stops there
+            limit_ = limit * len(batch)
+        else:
+            limit_ = None
+        result = pool.scan(
+            "",
+            ",".join(batch),
+            columns,
+            0, ifkey, iftime,
+            limit=limit_
+        )
+        if limit is not None and len(batch) > 1:
+            if result.size() >= limit_:
+                # Keys at the end of the batch may have been cut:
+                # scan each key on its own, with the per-key limit
+                result = jpype.JClass('java.util.TreeMap')()
+                for key in batch:
+                    result.putAll(
+                        pool.scan("", key, columns, 0, ifkey, iftime, limit=limit)
+                    )
+            elif result.size() > limit:
+                # A key may have used the budget of the others
+                for row in rows_over_limit(result.keySet().toArray(), batch, limit):
+                    result.remove(row)
+        timing = {
+            'table': pool.tablename,
+            'nkeys': len(batch),
+            'nrows': result.size(),
+            'duration': time.time() - t0
+        }
+        return result, timing
+
+    def scan_batches(group):
+        return [scan_batch(batch) for batch in group]
+
+    nthreads = min(nthreads, len(batches))
+    if nthreads > 1:
+        # At most `nthreads` concurrent scans for this call
+        groups = [batches[i::nthreads] for i in range(nthreads)]
+        outputs = [
+            output
+            for outputs_ in pool.executor.map(scan_batches, groups)
+            for output in outputs_
+        ]
+    else:
+        outputs = scan_batches(batches)
+
+    results = jpype.JClass('java.util.TreeMap')()
+    timings = []
+    for result, timing in outputs:
+        results.putAll(result)
+        timings.append(timing)
+
+    return results, timings
+
+def range_scan(
+        pool: HBaseClientPool, bounds: list, columns: str = '*',
+        ifkey: bool = True, iftime: bool = True, nthreads: int = None,
+        limit: int = None, reverse: bool = False):
+    """ Read several ranges of row keys, one range scan each
+
+    Scans are dispatched on `nthreads` worker threads of the pool. Each worker borrows
+    one client from the pool for its lifetime, and takes the next range
+    as soon as it is done with the previous one. Results are merged as
+    they arrive.
+
+    Parameters
+    ----------
+    pool: HBaseClientPool
+        Pool of clients connected to the table to scan
+    bounds: list of str
+        Boundaries of each range, e.g. ['key:key:000003,key:key:000006', ...]
+    columns: str
+        Comma-separated columns to return. Default is all ('*').
+    ifkey: bool
+        If True, return the `key:key` column. Default is True.
+    iftime: bool
+        If True, return the `key:time` column. Default is True.
+    nthreads: int
+        Maximum number of concurrent scans. Default is the size of the pool.
+    limit: int
+        Maximum number of rows returned per range. Default is the limit
+        of the pool.
+    reverse: bool
+        If True, each range is read from its end (e.g. with `limit=1`,
+        only its last row is returned). Default is False.
+
+    Returns
+    ----------
+    results: java.util.TreeMap
+        Merged results of all scans
+    timings: list of dict
+        For each range: table name, number of keys (1), number of rows
+        returned, duration in seconds.
+    """
+    if nthreads is None:
+        nthreads = pool.size
+    nthreads = max(1, min(nthreads, pool.size, len(bounds)))
+
+    todo = queue.Queue()
+    for bound in bounds:
+        todo.put(bound)
+    done = queue.Queue()
+
+    def worker():
+        """ Scan ranges with a single client, until there is none left
+        """
+        try:
+            with pool.borrow(limit=limit, range_scan=True, reverse=reverse) as client:
+                while True:
+                    try:
+                        bound = todo.get_nowait()
+                    except queue.Empty:
+                        break
+                    t0 = time.time()
+                    result = client.scan("", bound, columns, 0, ifkey, iftime)
+                    timing = {
+                        'table': pool.tablename,
+                        'nkeys': 1,
+                        'nrows': result.size(),
+                        'duration': time.time() - t0
+                    }
+                    done.put((result, timing, None))
+        except Exception as e:
+            done.put((None, None, e))
+
+    results = jpype.JClass('java.util.TreeMap')()
+    timings = []
+    if len(bounds) == 0:
+        return results, timings
+
+    for _ in range(nthreads):
+        pool.executor.submit(worker)
+
+    # Merge results as they arrive
+    for _ in range(len(bounds)):
+        result, timing, error = done.get()
+        if error is not None:
+            # Let the other workers stop
+            while True:
+                try:
+                    todo.get_nowait()
+                except queue.Empty:
+                    break
+            raise error
+        results.putAll(result)
+        timings.append(timing)
+
+    return results, timings
+
+def _to_column(values, dtype=None) -> np.array:
+    """ Convert a sequence of cells into a (typed) column
+
+    Parameters
+    ----------
+    values: sequence
+        Cell values, as returned by HBase (str). Missing cells are NaN.
+    dtype: type
+        Target type (int, float, str). If None, values are kept as is.
+
+    Returns
+    ----------
+    out: np.array
+
+    Examples
+    ----------
+    >>> _to_column(['1', '2.0'], int)
+    array([1, 2])
+    >>> _to_column(['1', np.nan], int)
+    array([ 1., nan])
+    >>> _to_column(['1.5', np.nan], float)
+    array([1.5, nan])
+    """
+    if dtype is None or dtype is str:
+        out = np.array(values, dtype=object)
+        if dtype is str:
+            missing = pd.isnull(out)
+            if missing.any():
+                out[missing] = 'nan'
+        return out
+    try:
+        return np.array(values, dtype=dtype)
+    except (ValueError, TypeError):
+        # e.g. '1.0' for integer, or missing values
+        out = pd.to_numeric(pd.Series(values, dtype=object)).values
+        if dtype is int and not np.isnan(out).any():
+            return out.astype(int)
+        # Integer columns with missing values are kept as float
+        return out.astype(float)
+
+def hbase_to_pandas(results, dtypes: dict = None) -> pd.DataFrame:
+    """ Transfer the output of `HBaseClient.scan` to a pandas DataFrame
+
+    Instead of walking through every cell of the Java map with JPype
+    proxies (as `pd.DataFrame.from_dict` does), the row keys and the cells
+    of each row are transferred in bulk as Java String arrays. The
+    DataFrame is then built column by column, and columns are typed
+    in the same pass.
+
+    Cells are stored row by row on the Java side, and the JDK offers no
+    call to transpose them: a column-wise transfer would need a helper
+    class on the JVM, which the FinkBrowser jar does not provide.
+
+    Parameters
+    ----------
+    results: java.util.TreeMap
+        Output of `HBaseClient.scan` (row key -> {column: value})
+    dtypes: dict
+        Optional mapping column -> type (int, float, str). Columns
+        not in the mapping are kept as returned by HBase.
+
+    Returns
+    ----------
+    pdf: pd.DataFrame
+        One row per HBase row, indexed by row key.
+    """
+    if results.isEmpty():
+        return pd.DataFrame({})
+
+    if dtypes is None:
+        dtypes = {}
+
+    empty = jpype.JArray(jpype.JClass('java.lang.String'))(0)
+
+    index = list(results.keySet().toArray(empty))
+
+    # Two JNI calls per row: column names and values.
+    names = []
+    cells = []
+    for row in results.values().toArray():
+        names.append(tuple(row.keySet().toArray(empty)))
+        cells.append(list(row.values().toArray(empty)))
+
+    columns = names[0]
+    if all(name == columns for name in names):
+        # All rows have the same columns -- transpose directly
+        data = dict(zip(columns, zip(*cells)))
+    else:
+        # Some cells are missing (e.g. `d:tracklet`)
+        columns = list(dict.fromkeys(col for name in names for col in name))
+        data = {col: [np.nan] * len(index) for col in columns}
+        for position, (name, cell) in enumerate(zip(names, cells)):
+            for col, value in zip(name, cell):
+                data[col][position] = value
+
+    pdf = pd.DataFrame(
+        {col: _to_column(data[col], dtypes.get(col)) for col in columns},
+        index=index
+    )
+
+    return pdf
+
+class HBaseRegistry:
+    """ Registry of HBase tables, connected lazily
+
+    A pool of clients is declared for each table, but a table is
+    only connected the first time it is used (or explicitly warmed up).
+
+    Examples
+    ----------
+    >>> registry = HBaseRegistry('localhost', 2181, 'schema_2.2_2.0.0')
+    >>> pool = registry['test_sp.jd']
+    >>> pool.connected
+    False
+
+    Row limits can be given per table
+    >>> registry = HBaseRegistry('localhost', 2181, 'schema_2.2_2.0.0', limits={'test_sp': 10000})
+    >>> registry['test_sp'].limit, registry['test_sp.pixel128'].limit
+    (10000, None)
+    """
+    def __init__(
+            self, host: str, port: int, schema_version: str,
+            size: int = 4, limit: int = None, limits: dict = None,
+            nthreads: int = 16):
+        """
+        Parameters
+        ----------
+        host: str
+            HBase (ZooKeeper) IP
+        port: int
+            ZooKeeper port
+        schema_version: str
+            Version of the schema stored in the tables
+        size: int
+            Maximum number of clients per table. Default is 4.
+        limit: int
+            Default limit on the number of rows returned by a scan,
+            for tables not in `limits`. Default is None (no limit).
+        limits: dict
+            Limit on the number of rows returned by a scan, per table name
+        nthreads: int
+            Number of worker threads running concurrent scans, shared
+            by all tables. Default is 16.
+        """
+        self.host = host
+        self.port = port
+        self.schema_version = schema_version
+        self.size = size
+        self.limit = limit
+        self.limits = limits or {}
+
+        # Threads are started on demand, and reused by all scans
+        self.executor = ThreadPoolExecutor(max_workers=nthreads)
+
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, tablename: str) -> HBaseClientPool:
+        """ Return the pool of clients for `tablename` (without connecting)
+        """
+        with self._lock:
+            if tablename not in self._pools:
+                self._pools[tablename] = HBaseClientPool(
+                    self.host, self.port,
+                    tablename, self.schema_version,
+                    size=self.size,
+                    limit=self.limits.get(tablename, self.limit),
+                    executor=self.executor
+                )
+            return self._pools[tablename]
+
+    def warmup(self, tablenames: list):
+        """ Connect the tables `tablenames` upfront
+
+        Parameters
+        ----------
+        tablenames: list of str
+            Names of the tables to connect
+        """
+        for tablename in tablenames:
+            self[tablename].warmup()
+
+    def invalidate_schemas(self):
+        """ Forget the cached schemas of all tables
+        """
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.invalidate_schema()
+
+    def report(self) -> list:
+        """ Connection cost per table
+
+        Returns
+        ----------
+        out: list of dict
+            For each declared table: name, number of connected clients,
+            time to connect the first client, and total connection time
+            (in seconds).
+        """
+        with self._lock:
+            pools = list(self._pools.values())
+
+        out = []
+        for pool in pools:
+            times = list(pool.connection_times)
+            out.append(
+                {
+                    'table': pool.tablename,
+                    'nclients': len(times),
+                    'first_connection': times[0] if len(times) > 0 else None,
+                    'total_connection': sum(times)
+                }
+            )
+        return out
+
+    def format_report(self) -> str:
+        """ Human readable version of `report`
+        """
+        lines = ['{:<30} {:>8} {:>10} {:>10}'.format('table', 'clients', 'first [s]', 'total [s]')]
+        for entry in self.report():
+            if entry['nclients'] == 0:
+                first = 'lazy'
+            else:
+                first = '{:.3f}'.format(entry['first_connection'])
+            lines.append(
+                '{:<30} {:>8} {:>10} {:>10.3f}'.format(
+                    entry['table'], entry['nclients'],
+                    first, entry['total_connection']
+                )
+            )
+        return '\n'.join(lines)
@@ -0,0 +1,257 @@
+# Copyright 2022 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Range scans over the HEALPix pixel index tables
+
+In NESTED ordering, pixels close on the sky have close indices, and a
+disc is covered by a few runs of consecutive pixels. If the pixel index
+is zero-padded in the row keys (`{ipix:0Nd}_{jd}`), the lexicographic
+order of the keys is the numerical order of the pixels, and each run
+is read with a single range scan instead of one key per pixel.
+
+Regions of arbitrary shape (e.g. GW credible regions) are covered with
+cells of the three index tables (multi-order coverage): large cells
+inside the region, and smaller ones on its boundary.
+
+See docs/pixel_index_migration.md for the layout of the tables.
+"""
+import numpy as np
+import healpy as hp
+
+# HEALPix orders of the pixel index tables (nside 128, 4096 and 131072)
+TABLE_ORDERS = (7, 12, 17)
+
+def key_width(nside: int) -> int:
+    """ Number of digits of the largest pixel index at `nside`
+
+    Examples
+    ----------
+    >>> key_width(128), key_width(4096), key_width(131072)
+    (6, 9, 12)
+    """
+    return len(str(12 * nside**2 - 1))
+
+def format_pixel(ipix: int, nside: int) -> str:
+    """ Zero-padded pixel index, as stored in the row keys of the nested tables
+
+    Examples
+    ----------
+    >>> format_pixel(42, 128)
+    '000042'
+    """
+    return '{:0{}d}'.format(int(ipix), key_width(nside))
+
+def pixel_ranges(pixs) -> np.ndarray:
+    """ Merge pixel indices into runs of consecutive pixels
+
+    Parameters
+    ----------
+    pixs: array of int
+        Pixel indices, in any order, possibly duplicated
+
+    Returns
+    ----------
+    ranges: np.ndarray of shape (nranges, 2)
+        First pixel and last pixel + 1 of each run
+
+    Examples
+    ----------
+    >>> pixel_ranges([7, 3, 4, 5, 9, 10]).tolist()
+    [[3, 6], [7, 8], [9, 11]]
+    >>> pixel_ranges([]).shape
+    (0, 2)
+    """
+    pixs = np.unique(np.asarray(pixs, dtype=np.int64))
+    if len(pixs) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    # Positions where a new run starts
+    breaks = np.where(np.diff(pixs) != 1)[0] + 1
+    starts = pixs[np.concatenate(([0], breaks))]
+    stops = pixs[np.concatenate((breaks - 1, [len(pixs) - 1]))] + 1
+
+    return np.stack([starts, stops], axis=1)
+
+def disc_ranges(ra: float, dec: float, radius_deg: float, nside: int) -> np.ndarray:
+    """ Runs of NESTED pixels overlapping a disc
+
+    Parameters
+    ----------
+    ra, dec: float
+        Center of the disc, in degree
+    radius_deg: float
+        Radius of the disc, in degree
+    nside: int
+        Resolution of the pixel index table
+
+    Returns
+    ----------
+    ranges: np.ndarray of shape (nranges, 2)
+        See `pixel_ranges`
+
+    Examples
+    ----------
+    >>> ranges = disc_ranges(193.82, 2.90, 1.0, 128)
+    >>> pixs = hp.query_disc(128, hp.ang2vec(193.82, 2.90, lonlat=True), np.radians(1.0), inclusive=True)
+    >>> len(ranges) < len(pixs)
+    True
+    >>> int(np.sum(ranges[:, 1] - ranges[:, 0])) == len(pixs)
+    True
+    """
+    vec = hp.ang2vec(ra, dec, lonlat=True)
+    pixs = hp.query_disc(
+        nside,
+        vec,
+        np.radians(radius_deg),
+        inclusive=True,
+        nest=True
+    )
+    return pixel_ranges(pixs)
+
+def range_keys(ranges: np.ndarray, nside: int, jdstart: float = None, jdend: float = None) -> list:
+    """ Boundaries of the range scans covering runs of pixels
+
+    Keys of a run `[start, stop)` lie between `start` and `stop`, since
+    `{stop}` sorts before any `{stop}_{jd}`. If a time window is given,
+    keys of different pixels are not contiguous: each pixel of a run is
+    read with its own scan, restricted to the window on the server side.
+
+    Parameters
+    ----------
+    ranges: np.ndarray of shape (nranges, 2)
+        Runs of pixels, see `pixel_ranges`
+    nside: int
+        Resolution of the pixel index table
+    jdstart, jdend: float, optional
+        Time window
+
+    Returns
+    ----------
+    keys: list of str
+        One `key:key:lower,key:key:upper` string per range scan
+
+    Examples
+    ----------
+    >>> range_keys(np.array([[3, 6], [7, 8]]), 128)
+    ['key:key:000003,key:key:000006', 'key:key:000007,key:key:000008']
+    >>> range_keys(np.array([[6, 8]]), 128, 2459800.5, 2459801.5)
+    ['key:key:000006_2459800.5,key:key:000006_2459801.5', 'key:key:000007_2459800.5,key:key:000007_2459801.5']
+    """
+    keys = []
+    for start, stop in ranges:
+        if jdstart is not None:
+            for ipix in range(start, stop):
+                pix = format_pixel(ipix, nside)
+                keys.append(
+                    'key:key:{}_{},key:key:{}_{}'.format(pix, jdstart, pix, jdend)
+                )
+        else:
+            keys.append(
+                'key:key:{},key:key:{}'.format(
+                    format_pixel(start, nside), format_pixel(stop, nside)
+                )
+            )
+    return keys
+
+def multi_order_ranges(pixels, order: int, max_overfetch: float = 0.2, max_cells: int = None, orders: tuple = TABLE_ORDERS) -> tuple:
+    """ Cover a region with cells of the pixel index tables
+
+    A cell of the coarsest table is kept if the fraction of its area
+    outside the region is at most `max_overfetch`, or if its part of the
+    region would need more than `max_cells` cells of the next table.
+    Other cells are split into cells of the next table, and so on. Cells
+    of a table finer than the region, and cells of the finest table, are
+    always kept.
+
+    Parameters
+    ----------
+    pixels: array of int
+        NESTED pixels of the region
+    order: int
+        HEALPix order of `pixels`
+    max_overfetch: float
+        Maximum fraction of a cell outside the region, between 0 and 1
+    max_cells: int, optional
+        Maximum number of cells a cell can be split into. Each cell being
+        read with its own scan when queries are bounded in time, this
+        bounds the number of scans. Default is no limit.
+    orders: tuple of int
+        Orders of the tables, from the coarsest to the finest
+
+    Returns
+    ----------
+    out: list of (int, np.ndarray)
+        For each table used, its order, and the runs of NESTED cells
+        covering the region (see `pixel_ranges`)
+    overfetch: float
+        Fraction of the covered area outside the region
+
+    Examples
+    ----------
+    >>> # 15 of the 16 order-9 pixels of the order-7 cell 0, and 1 pixel of cell 1
+    >>> pixels = list(range(15)) + [16]
+    >>> out, overfetch = multi_order_ranges(pixels, 9, max_overfetch=0.1)
+    >>> [(order, ranges.tolist()) for order, ranges in out]
+    [(7, [[0, 1]]), (12, [[1024, 1088]])]
+    >>> round(overfetch, 3)
+    0.059
+    >>> out, overfetch = multi_order_ranges(pixels, 9, max_overfetch=1.)
+    >>> [(order, ranges.tolist()) for order, ranges in out], round(overfetch, 3)
+    ([(7, [[0, 2]])], 0.5)
+    >>> # The pixel of cell 1 is 64 cells of order 12
+    >>> out, overfetch = multi_order_ranges(pixels, 9, max_overfetch=0.1, max_cells=16)
+    >>> [(order, ranges.tolist()) for order, ranges in out]
+    [(7, [[0, 2]])]
+    """
+    remaining = np.unique(np.asarray(pixels, dtype=np.int64))
+    npix = len(remaining)
+
+    out = []
+    covered = 0
+    for index, order_ in enumerate(orders):
+        if len(remaining) == 0:
+            break
+
+        if order_ >= order:
+            # Cells are inside pixels of the region
+            out.append((order_, pixel_ranges(remaining) * 4**(order_ - order)))
+            covered += len(remaining)
+            break
+
+        shift = 2 * (order - order_)
+        cells, counts = np.unique(remaining >> shift, return_counts=True)
+        if index == len(orders) - 1:
+            keep = np.ones(len(cells), dtype=bool)
+        else:
+            keep = 1. - counts / 4**(order - order_) <= max_overfetch
+
+            if max_cells is not None:
+                # Number of cells of the next table, per cell
+                next_order = orders[index + 1]
+                if next_order >= order:
+                    nsplit = counts * 4**(next_order - order)
+                else:
+                    subcells = np.unique(remaining >> 2 * (order - next_order))
+                    _, nsplit = np.unique(
+                        subcells >> 2 * (next_order - order_), return_counts=True
+                    )
+                keep |= nsplit > max_cells
+
+        if keep.any():
+            out.append((order_, pixel_ranges(cells[keep])))
+            covered += int(keep.sum()) * 4**(order - order_)
+            remaining = remaining[~np.isin(remaining >> shift, cells[keep])]
+
+    overfetch = 1. - npix / covered if covered > 0 else 0.
+    return out, overfetch
@@ -33,9 +33,10 @@ import dash_mantine_components as dmc
 from dash_iconify import DashIconify
 
 from apps.utils import convert_jd, readstamp, _data_stretch, convolve
-from apps.utils import apparent_flux, dc_mag
+from apps.utils import apparent_flux, get_dc_mag
 from apps.utils import sine_fit
 from apps.utils import class_colors
+from apps.hbase import hbase_to_pandas
 from apps.statistics import dic_names
 from app import APIURL
 
@@ -452,23 +453,13 @@ def plot_variable_star(nterms_base, nterms_band, manual_period, n_clicks, object
             'i:jd', 'i:magpsf', 'i:sigmapsf', 'i:fid',
             'i:magnr', 'i:sigmagnr', 'i:magzpsci', 'i:isdiffpos', 'i:objectId'
         ]
+        # DC magnitudes are cached only if the store was filled with them
+        cols += [col for col in ['v:dcmag', 'v:dcmag_err'] if col in pdf_.columns]
         pdf = pdf_.loc[:, cols]
         pdf['i:fid'] = pdf['i:fid'].astype(str)
         pdf = pdf.sort_values('i:jd', ascending=False)
 
-        mag_dc, err_dc = np.transpose(
-            [
-                dc_mag(*args) for args in zip(
-                    pdf['i:fid'].astype(int).values,
-                    pdf['i:magpsf'].astype(float).values,
-                    pdf['i:sigmapsf'].astype(float).values,
-                    pdf['i:magnr'].astype(float).values,
-                    pdf['i:sigmagnr'].astype(float).values,
-                    pdf['i:magzpsci'].astype(float).values,
-                    pdf['i:isdiffpos'].values
-                )
-            ]
-        )
+        mag_dc, err_dc = get_dc_mag(pdf)
 
         jd = pdf['i:jd']
         fit_period = False if manual_period is not None else True
@@ -609,7 +600,7 @@ def plot_classbar(object_data, is_mobile):
 
     # descending date values
     top_labels = pdf['v:classification'].values[::-1]
-    customdata = pdf['i:jd'].apply(lambda x: convert_jd(float(x), to='iso')).values[::-1]
+    customdata = convert_jd(pdf['i:jd'])[::-1]
     x_data = [[1] * len(top_labels)]
     y_data = top_labels
 
@@ -722,10 +713,12 @@ def draw_lightcurve(switch: int, pathname: str, object_data, object_upper, objec
         'i:jd', 'i:magpsf', 'i:sigmapsf', 'i:fid',
         'i:magnr', 'i:sigmagnr', 'i:magzpsci', 'i:isdiffpos', 'i:candid'
     ]
+    # DC magnitudes are cached only if the store was filled with them
+    cols += [col for col in ['v:dcmag', 'v:dcmag_err'] if col in pdf_.columns]
     pdf = pdf_.loc[:, cols]
 
     # type conversion
-    dates = pdf['i:jd'].apply(lambda x: convert_jd(float(x), to='iso'))
+    dates = convert_jd(pdf['i:jd'])
 
     # shortcuts
     mag = pdf['i:magpsf']
@@ -735,35 +728,19 @@ def draw_lightcurve(switch: int, pathname: str, object_data, object_upper, objec
         layout_lightcurve['yaxis']['autorange'] = 'reversed'
     elif switch == "DC magnitude":
         # inplace replacement
-        mag, err = np.transpose(
-            [
-                dc_mag(*args) for args in zip(
-                    pdf['i:fid'].values,
-                    mag.astype(float).values,
-                    err.astype(float).values,
-                    pdf['i:magnr'].astype(float).values,
-                    pdf['i:sigmagnr'].astype(float).values,
-                    pdf['i:magzpsci'].astype(float).values,
-                    pdf['i:isdiffpos'].values
-                )
-            ]
-        )
+        mag, err = get_dc_mag(pdf)
         layout_lightcurve['yaxis']['title'] = 'Apparent DC magnitude'
         layout_lightcurve['yaxis']['autorange'] = 'reversed'
     elif switch == "DC apparent flux":
         # inplace replacement
-        mag, err = np.transpose(
-            [
-                apparent_flux(*args) for args in zip(
-                    pdf['i:fid'].astype(int).values,
-                    mag.astype(float).values,
-                    err.astype(float).values,
-                    pdf['i:magnr'].astype(float).values,
-                    pdf['i:sigmagnr'].astype(float).values,
-                    pdf['i:magzpsci'].astype(float).values,
-                    pdf['i:isdiffpos'].values
-                )
-            ]
+        mag, err = apparent_flux(
+            pdf['i:fid'].astype(int).values,
+            mag.astype(float).values,
+            err.astype(float).values,
+            pdf['i:magnr'].astype(float).values,
+            pdf['i:sigmagnr'].astype(float).values,
+            pdf['i:magzpsci'].astype(float).values,
+            pdf['i:isdiffpos'].values
         )
         layout_lightcurve['yaxis']['title'] = 'Apparent DC flux'
         layout_lightcurve['yaxis']['autorange'] = True
@@ -826,7 +803,7 @@ def draw_lightcurve(switch: int, pathname: str, object_data, object_upper, objec
         <extra></extra>
         """
         if not pdf_upper.empty:
-            dates2 = pdf_upper['i:jd'].apply(lambda x: convert_jd(float(x), to='iso'))
+            dates2 = convert_jd(pdf_upper['i:jd'])
             figure['data'].append(
                 {
                     'x': dates2[pdf_upper['i:fid'] == 1],
@@ -864,7 +841,7 @@ def draw_lightcurve(switch: int, pathname: str, object_data, object_upper, objec
         <extra></extra>
         """
         if not pdf_upperv.empty:
-            dates2 = pdf_upperv['i:jd'].apply(lambda x: convert_jd(float(x), to='iso'))
+            dates2 = convert_jd(pdf_upperv['i:jd'])
             mask = np.array([False if i in pdf['i:jd'].values else True for i in pdf_upperv['i:jd'].values])
             dates2 = dates2[mask]
             pdf_upperv = pdf_upperv[mask]
@@ -935,28 +912,18 @@ def draw_lightcurve_sn(pathname: str, object_data, object_upper, object_upperval
         'i:jd', 'i:magpsf', 'i:sigmapsf', 'i:fid',
         'i:magnr', 'i:sigmagnr', 'i:magzpsci', 'i:isdiffpos', 'i:candid'
     ]
+    # DC magnitudes are cached only if the store was filled with them
+    cols += [col for col in ['v:dcmag', 'v:dcmag_err'] if col in pdf_.columns]
     pdf = pdf_.loc[:, cols]
 
     # type conversion
-    dates = pdf['i:jd'].apply(lambda x: convert_jd(float(x), to='iso'))
+    dates = convert_jd(pdf['i:jd'])
 
     # shortcuts
     mag = pdf['i:magpsf']
     err = pdf['i:sigmapsf']
     # inplace replacement
-    mag, err = np.transpose(
-        [
-            dc_mag(*args) for args in zip(
-                pdf['i:fid'].values,
-                mag.astype(float).values,
-                err.astype(float).values,
-                pdf['i:magnr'].astype(float).values,
-                pdf['i:sigmagnr'].astype(float).values,
-                pdf['i:magzpsci'].astype(float).values,
-                pdf['i:isdiffpos'].values
-            )
-        ]
-    )
+    mag, err = get_dc_mag(pdf)
     layout_lightcurve['yaxis']['title'] = 'Apparent DC magnitude'
     layout_lightcurve['yaxis']['autorange'] = 'reversed'
 
@@ -1043,7 +1010,7 @@ def draw_lightcurve_preview(name) -> dict:
     pdf = pdf[mask]
 
     # type conversion
-    dates = pdf['i:jd'].apply(lambda x: convert_jd(float(x), to='iso'))
+    dates = convert_jd(pdf['i:jd'])
 
     # shortcuts
     mag = pdf['i:magpsf']
@@ -1125,7 +1092,7 @@ def draw_scores(object_data) -> dict:
     pdf = pd.read_json(object_data)
 
     # type conversion
-    dates = pdf['i:jd'].apply(lambda x: convert_jd(float(x), to='iso'))
+    dates = convert_jd(pdf['i:jd'])
 
     hovertemplate = """
     <b>%{customdata[0]}</b>: %{y:.2f}<br>
@@ -1342,7 +1309,7 @@ def draw_color(object_data) -> dict:
     pdf = pd.read_json(object_data)
 
     # type conversion
-    dates = pdf['i:jd'].apply(lambda x: convert_jd(float(x), to='iso'))
+    dates = convert_jd(pdf['i:jd'])
 
     hovertemplate = """
     <b>%{customdata[0]}</b>: %{y:.3f}<br>
@@ -1434,7 +1401,7 @@ def draw_color_rate(object_data) -> dict:
     pdf = pd.read_json(object_data)
 
     # type conversion
-    dates = pdf['i:jd'].apply(lambda x: convert_jd(float(x), to='iso'))
+    dates = convert_jd(pdf['i:jd'])
 
     hovertemplate_rate = """
     <b>%{customdata[0]} in mag/day</b>: %{y:.3f}<br>
@@ -1538,11 +1505,12 @@ def extract_cutout(object_data, time0, kind):
         position = np.where(jds == jd0)[0][0]
 
     # Grab the cutout data
-    cutout = readstamp(
-        client.repository().get(
-            pdfs['b:cutout{}_stampData'.format(kind.capitalize())].values[position]
+    with client.borrow() as client_:
+        cutout = readstamp(
+            client_.repository().get(
+                pdfs['b:cutout{}_stampData'.format(kind.capitalize())].values[position]
+            )
         )
-    )
     return cutout
 
 @app.callback(
@@ -1805,23 +1773,13 @@ def plot_mulens(n_clicks, object_data):
             'i:jd', 'i:magpsf', 'i:sigmapsf', 'i:fid', 'i:ra', 'i:dec',
             'i:magnr', 'i:sigmagnr', 'i:magzpsci', 'i:isdiffpos', 'i:objectId'
         ]
+        # DC magnitudes are cached only if the store was filled with them
+        cols += [col for col in ['v:dcmag', 'v:dcmag_err'] if col in pdf_.columns]
         pdf = pdf_.loc[:, cols]
         pdf['i:fid'] = pdf['i:fid'].astype(str)
         pdf = pdf.sort_values('i:jd', ascending=False)
 
-        mag_dc, err_dc = np.transpose(
-            [
-                dc_mag(*args) for args in zip(
-                    pdf['i:fid'].astype(int).values,
-                    pdf['i:magpsf'].astype(float).values,
-                    pdf['i:sigmapsf'].astype(float).values,
-                    pdf['i:magnr'].astype(float).values,
-                    pdf['i:sigmagnr'].astype(float).values,
-                    pdf['i:magzpsci'].astype(float).values,
-                    pdf['i:isdiffpos'].values
-                )
-            ]
-        )
+        mag_dc, err_dc = get_dc_mag(pdf)
 
         current_event = event.Event()
         current_event.name = pdf['i:objectId'].values[0]
@@ -1875,7 +1833,7 @@ def plot_mulens(n_clicks, object_data):
 
         if '1' in np.unique(pdf['i:fid'].values):
             plot_filt1 = {
-                'x': [convert_jd(t, to='iso') for t in normalised_lightcurves[0][:, 0]],
+                'x': convert_jd(normalised_lightcurves[0][:, 0]),
                 'y': normalised_lightcurves[0][:, 1],
                 'error_y': {
                     'type': 'data',
@@ -1885,7 +1843,7 @@ def plot_mulens(n_clicks, object_data):
                 },
                 'mode': 'markers',
                 'name': 'g band',
-                'text': [convert_jd(t, to='iso') for t in normalised_lightcurves[0][:, 0]],
+                'text': convert_jd(normalised_lightcurves[0][:, 0]),
                 'marker': {
                     'size': 12,
                     'color': COLORS_ZTF[0],
@@ -1901,7 +1859,7 @@ def plot_mulens(n_clicks, object_data):
             else:
                 index = 1
             plot_filt2 = {
-                'x': [convert_jd(t, to='iso') for t in normalised_lightcurves[index][:, 0]],
+                'x': convert_jd(normalised_lightcurves[index][:, 0]),
                 'y': normalised_lightcurves[index][:, 1],
                 'error_y': {
                     'type': 'data',
@@ -1911,7 +1869,7 @@ def plot_mulens(n_clicks, object_data):
                 },
                 'mode': 'markers',
                 'name': 'r band',
-                'text': [convert_jd(t, to='iso') for t in normalised_lightcurves[index][:, 0]],
+                'text': convert_jd(normalised_lightcurves[index][:, 0]),
                 'marker': {
                     'size': 12,
                     'color': COLORS_ZTF[1],
@@ -1921,7 +1879,7 @@ def plot_mulens(n_clicks, object_data):
             plot_filt2 = {}
 
         fit_filt = {
-            'x': [convert_jd(float(t), to='iso') for t in time],
+            'x': convert_jd(time),
             'y': magnitude,
             'mode': 'lines',
             'name': 'fit',
@@ -2053,7 +2011,7 @@ def draw_sso_lightcurve(pdf) -> dict:
         return html.Div()
 
     # type conversion
-    dates = pdf['i:jd'].apply(lambda x: convert_jd(float(x), to='iso'))
+    dates = convert_jd(pdf['i:jd'])
     pdf['i:fid'] = pdf['i:fid'].apply(lambda x: int(x))
 
     # shortcuts
@@ -2224,7 +2182,7 @@ def draw_sso_residual(pdf) -> dict:
         'customdata': list(
             zip(
                 pdf['i:objectId'][pdf['i:fid'] == 1],
-                pdf['i:jd'].apply(lambda x: convert_jd(float(x), to='iso'))[pdf['i:fid'] == 1],
+                convert_jd(pdf['i:jd'])[pdf['i:fid'] == 1],
             )
         ),
         'hovertemplate': hovertemplate,
@@ -2248,7 +2206,7 @@ def draw_sso_residual(pdf) -> dict:
         'customdata': list(
             zip(
                 pdf['i:objectId'][pdf['i:fid'] == 2],
-                pdf['i:jd'].apply(lambda x: convert_jd(float(x), to='iso'))[pdf['i:fid'] == 2],
+                convert_jd(pdf['i:jd'])[pdf['i:fid'] == 2],
             )
         ),
         'hovertemplate': hovertemplate,
@@ -3040,7 +2998,7 @@ def plot_stat_evolution(pathname, param_name, switch):
     )
 
     # Construct the dataframe
-    pdf = pd.DataFrame.from_dict(results, orient='index')
+    pdf = hbase_to_pandas(results)
     pdf = pdf.fillna(0).astype(int)
 
     pdf['date'] = [
@@ -3386,7 +3344,7 @@ def hist_sci_raw(pathname, dropdown_days):
     )
 
     # Construct the dataframe
-    pdf = pd.DataFrame.from_dict(results, orient='index')
+    pdf = hbase_to_pandas(results)
 
     if dropdown_days is None or dropdown_days == '':
         dropdown_days = pdf.index[-1]
@@ -3426,7 +3384,7 @@ def hist_catalogued(pathname, dropdown_days):
     )
 
     # Construct the dataframe
-    pdf = pd.DataFrame.from_dict(results, orient='index')
+    pdf = hbase_to_pandas(results)
 
     pdf = pdf.rename(columns={'class:Solar System MPC': 'MPC', 'class:simbad_tot': 'SIMBAD'})
 
@@ -3468,7 +3426,7 @@ def hist_classified(pathname, dropdown_days):
     )
 
     # Construct the dataframe
-    pdf = pd.DataFrame.from_dict(results, orient='index')
+    pdf = hbase_to_pandas(results)
 
     # In case class:unknown contains NaN (see https://github.com/astrolabsoftware/fink-utils/issues/25)
     pdf['class:Unknown'] = pdf['class:Unknown'].replace(np.nan, 0)
@@ -3513,7 +3471,7 @@ def hist_candidates(pathname, dropdown_days):
     )
 
     # Construct the dataframe
-    pdf = pd.DataFrame.from_dict(results, orient='index')
+    pdf = hbase_to_pandas(results)
 
     pdf = pdf.rename(
         columns={
@@ -3558,7 +3516,7 @@ def fields_exposures(pathname, dropdown_days):
     )
 
     # Construct the dataframe
-    pdf = pd.DataFrame.from_dict(results, orient='index')
+    pdf = hbase_to_pandas(results)
 
     to_drop = [i for i in pdf.columns if i.startswith('basic:')]
     pdf = pdf.drop(columns=to_drop)
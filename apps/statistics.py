@@ -17,6 +17,8 @@ import dash_bootstrap_components as dbc
 
 from app import app, clientStats
 
+from apps.hbase import hbase_to_pandas
+
 import numpy as np
 import pandas as pd
 
@@ -131,7 +133,7 @@ def store_stat_query(name):
     )
 
     # Construct the dataframe
-    pdf = pd.DataFrame.from_dict(results, orient='index')
+    pdf = hbase_to_pandas(results)
     return pdf.to_json()
 
 @app.callback(
@@ -349,7 +351,7 @@ def generate_night_list():
     )
 
     # Construct the dataframe
-    pdf = pd.DataFrame.from_dict(results, orient='index')
+    pdf = hbase_to_pandas(results)
 
     labels = pdf['key:key'].apply(lambda x: x[4:8] + '-' + x[8:10] + '-' + x[10:12])
 
@@ -414,7 +416,7 @@ def get_data_one_night(night):
     )
 
     # Construct the dataframe
-    pdf = pd.DataFrame.from_dict(results, orient='index')
+    pdf = hbase_to_pandas(results)
 
     return pdf
 
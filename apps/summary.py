@@ -27,6 +27,10 @@ import numpy as np
 import requests
 
 from app import app, client, clientU, clientUV, clientSSO, clientTRCK
+from app import object_cache
+
+from apps.hbase import hbase_to_pandas
+from apps.api.utils import probe_objects
 
 from apps.supernovae.cards import card_sn_scores
 from apps.varstars.cards import card_explanation_variable, card_variable_button
@@ -618,15 +622,25 @@ def store_query(name):
     """
     if not name[1:].startswith('ZTF'):
         raise PreventUpdate
-    results = client.scan("", "key:key:{}".format(name[1:]), "*", 0, True, True)
-    schema_client = client.schema()
-    pdfs = format_hbase_output(results, schema_client, group_alerts=False)
+    def compute():
+        results = client.scan("", "key:key:{}".format(name[1:]), "*", 0, True, True)
+        dtypes = client.dtypes()
+        pdfs = format_hbase_output(results, dtypes, group_alerts=False, with_dcmag=True)
+
+        uppers = clientU.scan("", "key:key:{}".format(name[1:]), "*", 0, True, True)
+        pdfsU = hbase_to_pandas(uppers)
 
-    uppers = clientU.scan("", "key:key:{}".format(name[1:]), "*", 0, True, True)
-    pdfsU = pd.DataFrame.from_dict(uppers, orient='index')
+        uppersV = clientUV.scan("", "key:key:{}".format(name[1:]), "*", 0, True, True)
+        pdfsUV = hbase_to_pandas(uppersV)
 
-    uppersV = clientUV.scan("", "key:key:{}".format(name[1:]), "*", 0, True, True)
-    pdfsUV = pd.DataFrame.from_dict(uppersV, orient='index')
+        return pdfs, pdfsU, pdfsUV
+
+    # Re-use the data if the object did not get new alerts since last time
+    (pdfs, pdfsU, pdfsUV), _ = object_cache.get_or_compute(
+        ('summary', name[1:]),
+        lambda: probe_objects(["key:key:{}".format(name[1:])], withupperlim=True),
+        compute
+    )
 
     payload = pdfs['i:ssnamenr'].values[0]
     is_sso = np.alltrue([i == payload for i in pdfs['i:ssnamenr'].values])
@@ -637,9 +651,9 @@ def store_query(name):
             "*",
             0, True, True
         )
-        schema_client_sso = clientSSO.schema()
+        dtypes_sso = clientSSO.dtypes()
         pdfsso = format_hbase_output(
-            results, schema_client_sso,
+            results, dtypes_sso,
             group_alerts=False, truncated=False, extract_color=False
         )
 
@@ -662,9 +676,9 @@ def store_query(name):
             "*",
             0, True, True
         )
-        schema_client_tracklet = clientTRCK.schema()
+        dtypes_tracklet = clientTRCK.dtypes()
         pdftracklet = format_hbase_output(
-            results, schema_client_tracklet,
+            results, dtypes_tracklet,
             group_alerts=False, truncated=False, extract_color=False
         )
     else:
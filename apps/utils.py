@@ -19,6 +19,7 @@ import gzip
 import io
 import requests
 import base64
+import threading
 
 import qrcode
 from qrcode.image.styledpil import StyledPilImage
@@ -32,7 +33,6 @@ from astropy.convolution import convolve as astropy_convolve
 from astropy.convolution import Gaussian2DKernel
 from astropy.convolution import Box2DKernel
 
-from astropy.coordinates import SkyCoord, get_constellation
 import astropy.units as u
 
 from astropy.visualization import AsymmetricPercentileInterval, simple_norm
@@ -41,14 +41,8 @@ from astropy.time import Time
 from fink_filters.classification import extract_fink_classification_
 from fink_utils.sso.utils import get_miriade_data, query_miriade
 
-hbase_type_converter = {
-    'integer': int,
-    'long': int,
-    'float': float,
-    'double': float,
-    'string': str,
-    'fits/image': str
-}
+from apps.hbase import hbase_to_pandas, hbase_type_converter
+from apps.constellations import lookup_constellation
 
 class_colors = {
         'Early SN Ia candidate': 'red',
@@ -63,17 +57,191 @@ class_colors = {
         'Simbad': 'blue'
     }
 
+CLASSIFICATION_INPUTS = [
+    'd:cdsxmatch', 'd:roid', 'd:mulens', 'd:snn_snia_vs_nonia',
+    'd:snn_sn_vs_all', 'd:rf_snia_vs_nonia', 'i:ndethist', 'i:drb',
+    'i:classtar', 'i:jd', 'i:jdstarthist', 'd:rf_kn_vs_nonkn', 'd:tracklet'
+]
+
+DCMAG_INPUTS = [
+    'i:fid', 'i:magpsf', 'i:sigmapsf', 'i:magnr',
+    'i:sigmagnr', 'i:magzpsci', 'i:isdiffpos'
+]
+
+COLOR_COLUMNS = [
+    'v:g-r', 'v:rate(g-r)', 'v:dg', 'v:rate(dg)', 'v:dr', 'v:rate(dr)'
+]
+
+def derive_classification(pdf: pd.DataFrame) -> dict:
+    """ Fink final classification
+    """
+    if 'd:tracklet' not in pdf.columns:
+        tracklet = pd.Series(np.zeros(len(pdf), dtype='U20'), index=pdf.index)
+    else:
+        tracklet = pdf['d:tracklet']
+
+    classifications = extract_fink_classification_(
+        pdf['d:cdsxmatch'],
+        pdf['d:roid'],
+        pdf['d:mulens'],
+        pdf['d:snn_snia_vs_nonia'],
+        pdf['d:snn_sn_vs_all'],
+        pdf['d:rf_snia_vs_nonia'],
+        pdf['i:ndethist'],
+        pdf['i:drb'],
+        pdf['i:classtar'],
+        pdf['i:jd'],
+        pdf['i:jdstarthist'],
+        pdf['d:rf_kn_vs_nonkn'],
+        tracklet
+    )
+    return {'v:classification': classifications.values}
+
+def derive_dcmag(pdf: pd.DataFrame) -> dict:
+    """ DC magnitude and its error
+    """
+    mag, err = get_dc_mag(pdf)
+    return {'v:dcmag': mag, 'v:dcmag_err': err}
+
+def derive_colors(pdf: pd.DataFrame) -> dict:
+    """ Color evolution
+    """
+    colors = extract_color_evolution(pdf)
+    return {col: colors[col].values for col in colors.columns}
+
+def derive_constellation(pdf: pd.DataFrame) -> dict:
+    """ Constellation of each alert
+    """
+    return {
+        'v:constellation': lookup_constellation(
+            pdf['i:ra'].values,
+            pdf['i:dec'].values
+        )
+    }
+
+# Derived columns: name -> (columns computed together, columns needed, function)
+# Needed columns can themselves be derived -- they are resolved recursively.
+DERIVED_COLUMNS = {}
+for outputs, inputs, func in [
+        (['v:classification'], CLASSIFICATION_INPUTS, derive_classification),
+        (['v:dcmag', 'v:dcmag_err'], DCMAG_INPUTS, derive_dcmag),
+        (
+            COLOR_COLUMNS,
+            ['i:objectId', 'i:nid', 'i:jd', 'i:fid', 'v:dcmag', 'v:dcmag_err'],
+            derive_colors
+        ),
+        (
+            ['v:lastdate'], ['i:jd'],
+            lambda pdf: {'v:lastdate': convert_jd(pdf['i:jd'].values)}
+        ),
+        (
+            ['v:firstdate'], ['i:jdstarthist'],
+            lambda pdf: {'v:firstdate': convert_jd_memo(pdf['i:jdstarthist'].values)}
+        ),
+        (
+            ['v:lapse'], ['i:jd', 'i:jdstarthist'],
+            lambda pdf: {'v:lapse': pdf['i:jd'] - pdf['i:jdstarthist']}
+        ),
+        (['v:constellation'], ['i:ra', 'i:dec'], derive_constellation)]:
+    for col in outputs:
+        DERIVED_COLUMNS[col] = (tuple(outputs), tuple(inputs), func)
+
+def resolve_derivations(columns: list) -> tuple:
+    """ Derivations needed to compute derived columns, with their dependencies
+
+    Parameters
+    ----------
+    columns: list of str
+        Requested columns. Columns that are not derived are ignored.
+
+    Returns
+    ----------
+    derivations: list of tuple
+        (outputs, inputs, function), in the order they must run
+    hbase_columns: list of str
+        HBase columns needed by the derivations
+    """
+    derivations = []
+    hbase_columns = []
+
+    def visit(col):
+        if col not in DERIVED_COLUMNS:
+            if col not in hbase_columns:
+                hbase_columns.append(col)
+            return
+        derivation = DERIVED_COLUMNS[col]
+        if derivation in derivations:
+            return
+        for dep in derivation[1]:
+            visit(dep)
+        derivations.append(derivation)
+
+    for col in columns:
+        if col in DERIVED_COLUMNS:
+            visit(col)
+
+    return derivations, hbase_columns
+
+def select_columns(cols: str) -> tuple:
+    """ HBase columns to scan for a user projection
+
+    Derived (v:) columns are not stored in HBase: they are replaced
+    by the HBase columns needed to compute them.
+
+    Parameters
+    ----------
+    cols: str
+        Comma-separated list of columns, or `*` for all columns
+
+    Returns
+    ----------
+    hbase_cols: str
+        Comma-separated list of columns to pass to `HBaseClient.scan`
+    columns: list of str
+        Requested columns, to pass to `format_hbase_output`.
+        None if all columns are requested.
+    """
+    columns = [col for col in cols.split(',') if col != '']
+    if cols == '*' or len(columns) == 0:
+        return cols, None
+
+    _, needed = resolve_derivations(columns)
+
+    hbase_columns = [col for col in columns if col not in DERIVED_COLUMNS]
+    hbase_columns += [col for col in needed if col not in hbase_columns]
+
+    return ','.join(hbase_columns), columns
+
 def format_hbase_output(
-        hbase_output, schema_client,
+        hbase_output, dtypes: dict,
         group_alerts: bool, truncated: bool = False,
-        extract_color: bool = True, with_constellation: bool = True):
-    """
+        extract_color: bool = True, with_constellation: bool = True,
+        with_dcmag: bool = False, columns: list = None):
+    """ Format the output of `HBaseClient.scan` in a pandas DataFrame
+
+    Parameters
+    ----------
+    hbase_output: java.util.TreeMap
+        Output of `HBaseClient.scan`
+    dtypes: dict
+        Mapping column name -> Python type, as returned by
+        `apps.hbase.HBaseClientPool.dtypes`
+    with_dcmag: bool
+        If True, add the DC magnitude and its error as columns
+        `v:dcmag` and `v:dcmag_err`, so that they are computed once
+        and re-used downstream (see `get_dc_mag`). Default is False.
+    columns: list of str
+        Columns requested by the user (see `select_columns`). Only
+        the derived columns among them are computed, and only these
+        columns are returned. Default is None, meaning all columns:
+        derived columns are then set by `truncated`, `extract_color`,
+        `with_constellation` and `with_dcmag`.
     """
     if hbase_output.isEmpty():
         return pd.DataFrame({})
 
-    # Construct the dataframe
-    pdfs = pd.DataFrame.from_dict(hbase_output, orient='index')
+    # Construct the dataframe, and cast types in the same pass
+    pdfs = hbase_to_pandas(hbase_output, dtypes=dtypes)
 
     # Tracklet cell contains null if there is nothing
     # and so HBase won't transfer data -- ignoring the column
@@ -84,53 +252,34 @@ def format_hbase_output(
     if 'key:key' in pdfs.columns or 'key:time' in pdfs.columns:
         pdfs = pdfs.drop(columns=['key:key', 'key:time'])
 
-    # Type conversion
-    pdfs = pdfs.astype(
-        {i: hbase_type_converter[schema_client.type(i)] for i in pdfs.columns})
-
-    if not truncated:
-        # Fink final classification
-        classifications = extract_fink_classification_(
-            pdfs['d:cdsxmatch'],
-            pdfs['d:roid'],
-            pdfs['d:mulens'],
-            pdfs['d:snn_snia_vs_nonia'],
-            pdfs['d:snn_sn_vs_all'],
-            pdfs['d:rf_snia_vs_nonia'],
-            pdfs['i:ndethist'],
-            pdfs['i:drb'],
-            pdfs['i:classtar'],
-            pdfs['i:jd'],
-            pdfs['i:jdstarthist'],
-            pdfs['d:rf_kn_vs_nonkn'],
-            pdfs['d:tracklet']
-        )
-
-        pdfs['v:classification'] = classifications.values
-
+    if columns is not None:
+        derived = [col for col in columns if col in DERIVED_COLUMNS]
+    elif truncated:
+        derived = []
+    else:
+        derived = ['v:classification']
+        if with_dcmag:
+            derived += ['v:dcmag', 'v:dcmag_err']
         if extract_color:
-            # Extract color evolution
-            pdfs = pdfs.sort_values('i:objectId')
-            pdfs['v:g-r'] = extract_last_g_minus_r_each_object(pdfs, kind='last')
-            pdfs['v:rate(g-r)'] = extract_last_g_minus_r_each_object(pdfs, kind='rate')
-
-            pdfs = pdfs.sort_values('i:jd', ascending=False)
-            pdfs['v:dg'], pdfs['v:rate(dg)'] = extract_delta_color(pdfs, filter_=1)
-            pdfs['v:dr'], pdfs['v:rate(dr)'] = extract_delta_color(pdfs, filter_=2)
+            derived += COLOR_COLUMNS
+        derived += ['v:lastdate', 'v:firstdate', 'v:lapse']
+        if with_constellation:
+            derived += ['v:constellation']
 
-        # Human readable time
-        pdfs['v:lastdate'] = pdfs['i:jd'].apply(convert_jd)
-        pdfs['v:firstdate'] = pdfs['i:jdstarthist'].apply(convert_jd)
-        pdfs['v:lapse'] = pdfs['i:jd'] - pdfs['i:jdstarthist']
+    derivations, _ = resolve_derivations(derived)
+    for _, _, func in derivations:
+        for col, values in func(pdfs).items():
+            pdfs[col] = values
 
-        if with_constellation:
-            coords = SkyCoord(
-                pdfs['i:ra'],
-                pdfs['i:dec'],
-                unit='deg'
-            )
-            constellations = get_constellation(coords)
-            pdfs['v:constellation'] = constellations
+    # Intermediate derived columns, or columns only needed by derivations
+    if columns is not None:
+        pdfs = pdfs[[col for col in pdfs.columns if col in columns]]
+    else:
+        intermediate = [
+            col for col in pdfs.columns
+            if col in DERIVED_COLUMNS and col not in derived
+        ]
+        pdfs = pdfs.drop(columns=intermediate)
 
     # Display only the last alert
     if group_alerts and ('i:jd' in pdfs.columns) and ('i:objectId' in pdfs.columns):
@@ -249,8 +398,8 @@ def extract_cutouts(pdf: pd.DataFrame, client, col=None, return_type='array') ->
     ----------
     pdf: Pandas DataFrame
         DataFrame returned by `format_hbase_output` (see api/api.py)
-    client: com.Lomikel.HBaser.HBaseClient
-        HBase client used to query the database
+    client: apps.hbase.HBaseClientPool
+        Pool of HBase clients used to query the database
     col: str
         Name of the cutouts to be downloaded (e.g. b:cutoutScience_stampData). If None, return all 3
     return_type: str
@@ -264,9 +413,11 @@ def extract_cutouts(pdf: pd.DataFrame, client, col=None, return_type='array') ->
     if col is not None:
         cols = ['b:cutoutScience_stampData', 'b:cutoutTemplate_stampData', 'b:cutoutDifference_stampData']
         assert col in cols
-        pdf[col] = pdf[col].apply(
-            lambda x: readstamp(client.repository().get(x), return_type=return_type)
-        )
+        with client.borrow() as client_:
+            repository = client_.repository()
+            pdf[col] = pdf[col].apply(
+                lambda x: readstamp(repository.get(x), return_type=return_type)
+            )
         return pdf
 
     if 'b:cutoutScience_stampData' not in pdf.columns:
@@ -274,15 +425,17 @@ def extract_cutouts(pdf: pd.DataFrame, client, col=None, return_type='array') ->
         pdf['b:cutoutTemplate_stampData'] = 'binary:' + pdf['i:objectId'] + '_' + pdf['i:jd'].astype('str') + ':cutoutTemplate_stampData'
         pdf['b:cutoutDifference_stampData'] = 'binary:' + pdf['i:objectId'] + '_' + pdf['i:jd'].astype('str') + ':cutoutDifference_stampData'
 
-    pdf['b:cutoutScience_stampData'] = pdf['b:cutoutScience_stampData'].apply(
-        lambda x: readstamp(client.repository().get(x), return_type=return_type)
-    )
-    pdf['b:cutoutTemplate_stampData'] = pdf['b:cutoutTemplate_stampData'].apply(
-        lambda x: readstamp(client.repository().get(x), return_type=return_type)
-    )
-    pdf['b:cutoutDifference_stampData'] = pdf['b:cutoutDifference_stampData'].apply(
-        lambda x: readstamp(client.repository().get(x), return_type=return_type)
-    )
+    with client.borrow() as client_:
+        repository = client_.repository()
+        pdf['b:cutoutScience_stampData'] = pdf['b:cutoutScience_stampData'].apply(
+            lambda x: readstamp(repository.get(x), return_type=return_type)
+        )
+        pdf['b:cutoutTemplate_stampData'] = pdf['b:cutoutTemplate_stampData'].apply(
+            lambda x: readstamp(repository.get(x), return_type=return_type)
+        )
+        pdf['b:cutoutDifference_stampData'] = pdf['b:cutoutDifference_stampData'].apply(
+            lambda x: readstamp(repository.get(x), return_type=return_type)
+        )
     return pdf
 
 def extract_properties(data: str, fieldnames: list):
@@ -294,10 +447,85 @@ def extract_properties(data: str, fieldnames: list):
     else:
         return pdfs
 
+# Memo of already converted dates (e.g. jdstarthist), shared across requests
+# (and threads: accessed under JD_MEMO_LOCK)
+JD_MEMO = {}
+JD_MEMO_SIZE = 200000
+JD_MEMO_LOCK = threading.Lock()
+
 def convert_jd(jd, to='iso'):
     """ Convert Julian Date into ISO date (UTC).
+
+    Parameters
+    ----------
+    jd: float or array-like
+        Julian Date(s)
+    to: str
+        Output format, see astropy.time.Time
+
+    Returns
+    ----------
+    out: str or np.array
+        Single value for scalar input, array otherwise. Arrays
+        are converted in one call, on their unique values only.
     """
-    return Time(jd, format='jd').to_value(to)
+    if np.ndim(jd) == 0:
+        return Time(jd, format='jd').to_value(to)
+
+    jd = np.asarray(jd, dtype=float)
+    if len(jd) == 0:
+        return np.array([], dtype=str)
+
+    uniques, inverse = np.unique(jd, return_inverse=True)
+    return Time(uniques, format='jd').to_value(to)[inverse]
+
+def convert_jd_memo(jd, to='iso', memo=JD_MEMO):
+    """ Convert Julian Dates into ISO dates (UTC), with a memo.
+
+    Useful for columns whose values repeat a lot across
+    alerts and requests, such as `i:jdstarthist`.
+
+    Parameters
+    ----------
+    jd: array-like
+        Julian Dates
+    to: str
+        Output format, see astropy.time.Time
+    memo: dict
+        Memo keyed by (jd, to). Cleared when it
+        exceeds JD_MEMO_SIZE entries. Read and written
+        under JD_MEMO_LOCK.
+
+    Returns
+    ----------
+    out: np.array
+        Converted dates
+    """
+    jd = np.asarray(jd, dtype=float)
+    uniques, inverse = np.unique(jd, return_inverse=True)
+
+    # NaN do not compare equal -- they are converted without memo
+    finite = np.isfinite(uniques)
+    keys = uniques[finite].tolist()
+
+    # Values are taken from the memo once: other threads may clear it
+    with JD_MEMO_LOCK:
+        known = {i: memo[(i, to)] for i in keys if (i, to) in memo}
+
+    missing = [i for i in keys if i not in known]
+    if len(missing) > 0:
+        converted = convert_jd(np.array(missing), to=to)
+        known.update(zip(missing, converted))
+        with JD_MEMO_LOCK:
+            if len(memo) + len(missing) > JD_MEMO_SIZE:
+                memo.clear()
+            memo.update({(i, to): j for i, j in zip(missing, converted)})
+
+    values = np.empty(len(uniques), dtype=object)
+    values[finite] = [known[i] for i in keys]
+    if not np.all(finite):
+        values[~finite] = convert_jd(uniques[~finite], to=to)
+    return values[inverse]
 
 def convolve(image, smooth=3, kernel='gauss'):
     """ Convolve 2D image. Hacked from aplpy
@@ -389,10 +617,29 @@ def mag2fluxcal_snana(magpsf: float, sigmapsf: float):
 
     return fluxcal, fluxcal_err
 
+def reference_zero_point(fid):
+    """ Zero point of the reference images, for each filter
+
+    Parameters
+    ----------
+    fid: int or array of int
+        filter, 1 for green, 2 for red, and 3 for i band
+
+    Returns
+    ----------
+    magzpref: float or array of float
+    """
+    # zero points. Looks like they are fixed.
+    ref_zps = np.array([26.325, 26.275, 25.660])
+    return ref_zps[np.asarray(fid, dtype=int) - 1]
+
 def apparent_flux(fid, magpsf, sigmapsf, magnr, sigmagnr, magzpsci, isdiffpos):
     """ Compute apparent flux from difference magnitude supplied by ZTF
     This was heavily influenced by the computation provided by Lasair:
     https://github.com/lsst-uk/lasair/blob/master/src/alert_stream_ztf/common/mag.py
+
+    All parameters can be scalars or arrays (e.g. full lightcurves).
+
     Paramters
     ---------
     fid
@@ -410,48 +657,52 @@ def apparent_flux(fid, magpsf, sigmapsf, magnr, sigmagnr, magzpsci, isdiffpos):
 
     Returns
     --------
-    dc_flux: float
+    dc_flux: float or array
         Apparent magnitude
-    dc_sigflux: float
+    dc_sigflux: float or array
         Error on apparent magnitude
     """
     if magpsf is None:
         return None, None
-    # zero points. Looks like they are fixed.
-    ref_zps = {1: 26.325, 2: 26.275, 3: 25.660}
-    magzpref = ref_zps[fid]
+
+    magpsf = np.asarray(magpsf, dtype=float)
+    sigmapsf = np.asarray(sigmapsf, dtype=float)
+    magnr = np.asarray(magnr, dtype=float)
+    sigmagnr = np.asarray(sigmagnr, dtype=float)
+    magzpsci = np.asarray(magzpsci, dtype=float)
+
+    magzpref = reference_zero_point(fid)
 
     # reference flux and its error
-    magdiff = magzpref - magnr
-    if magdiff > 12.0:
-        magdiff = 12.0
+    magdiff = np.minimum(magzpref - magnr, 12.0)
     ref_flux = 10**(0.4 * magdiff)
     ref_sigflux = (sigmagnr / 1.0857) * ref_flux
 
     # difference flux and its error
-    if magzpsci == 0.0:
-        magzpsci = magzpref
-    magdiff = magzpsci - magpsf
-    if magdiff > 12.0:
-        magdiff = 12.0
+    magzpsci = np.where(magzpsci == 0.0, magzpref, magzpsci)
+    magdiff = np.minimum(magzpsci - magpsf, 12.0)
     difference_flux = 10**(0.4 * magdiff)
     difference_sigflux = (sigmapsf / 1.0857) * difference_flux
 
     # add or subract difference flux based on isdiffpos
-    if isdiffpos == 't':
-        dc_flux = ref_flux + difference_flux
-    else:
-        dc_flux = ref_flux - difference_flux
+    dc_flux = np.where(
+        np.asarray(isdiffpos) == 't',
+        ref_flux + difference_flux,
+        ref_flux - difference_flux
+    )
 
     # assumes errors are independent. Maybe too conservative.
     dc_sigflux = np.sqrt(difference_sigflux**2 + ref_sigflux**2)
 
-    return dc_flux, dc_sigflux
+    return dc_flux[()], dc_sigflux[()]
 
 def dc_mag(fid, magpsf, sigmapsf, magnr, sigmagnr, magzpsci, isdiffpos):
     """ Compute apparent magnitude from difference magnitude supplied by ZTF
-    Parameters
     Stolen from Lasair.
+
+    All parameters can be scalars or arrays (e.g. full lightcurves).
+
+    Parameters
     ----------
     fid
         filter, 1 for green and 2 for red
@@ -465,179 +716,162 @@ def dc_mag(fid, magpsf, sigmapsf, magnr, sigmagnr, magzpsci, isdiffpos):
     isdiffpos
         t or 1 => candidate is from positive (sci minus ref) subtraction;
         f or 0 => candidate is from negative (ref minus sci) subtraction
+
+    Returns
+    --------
+    dc_mag: float or array
+        Apparent magnitude
+    dc_sigmag: float or array
+        Error on apparent magnitude
     """
-    # zero points. Looks like they are fixed.
-    ref_zps = {1: 26.325, 2: 26.275, 3: 25.660}
-    magzpref = ref_zps[fid]
+    magzpref = reference_zero_point(fid)
 
     # difference flux and its error
     if magzpsci is None:
         magzpsci = magzpref
+    magzpsci = np.asarray(magzpsci, dtype=float)
 
     dc_flux, dc_sigflux = apparent_flux(
         fid, magpsf, sigmapsf, magnr, sigmagnr, magzpsci, isdiffpos
     )
 
     # apparent mag and its error from fluxes
-    if (dc_flux == dc_flux) and dc_flux > 0.0:
-        dc_mag = magzpsci - 2.5 * np.log10(dc_flux)
-        dc_sigmag = dc_sigflux / dc_flux * 1.0857
-    else:
-        dc_mag = magzpsci
-        dc_sigmag = sigmapsf
+    positive = (dc_flux == dc_flux) & (dc_flux > 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dc_mag = np.where(
+            positive,
+            magzpsci - 2.5 * np.log10(dc_flux),
+            magzpsci
+        )
+        dc_sigmag = np.where(
+            positive,
+            dc_sigflux / dc_flux * 1.0857,
+            np.asarray(sigmapsf, dtype=float)
+        )
 
-    return dc_mag, dc_sigmag
+    return dc_mag[()], dc_sigmag[()]
 
-def g_minus_r(fid, mag):
-    """ Compute r-g based on vectors of filters and magnitudes
-    """
-    if len(fid) == 2:
-        # +1 if [g, r]
-        # -1 if [r, g]
-        sign = np.diff(fid)[0]
-    else:
-        # last measurement
-        last_fid = fid[-1]
+def get_dc_mag(pdf: pd.DataFrame):
+    """ DC magnitude and error for each alert of a DataFrame
 
-        # last measurement with different filter
-        # could take the mean
-        index_other = np.where(np.array(fid) != last_fid)[0][-1]
+    Use the cached columns `v:dcmag` and `v:dcmag_err` if available
+    (see `format_hbase_output`), otherwise compute them.
 
-        sign = np.diff([fid[index_other], last_fid])[0]
-        mag = [mag[index_other], mag[-1]]
-
-    return -1 * sign * np.diff(mag)[0]
+    Parameters
+    ----------
+    pdf: pandas DataFrame
+        DataFrame containing alert parameters
 
-def extract_last_g_minus_r_each_object(pdf, kind):
-    """ Extract last g-r for each object in a pandas DataFrame
+    Returns
+    ----------
+    mag: np.array
+        Apparent DC magnitude
+    err: np.array
+        Error on the apparent DC magnitude
     """
-    # extract unique objects
-    ids, indices = np.unique(pdf['i:objectId'].values, return_index=True)
-    ids = [pdf['i:objectId'].values[index] for index in sorted(indices)]
-
-    if kind == 'last':
-        pdf.loc[:, 'v:g-r'] = 0.0
-    elif kind == 'rate':
-        pdf.loc[:, 'v:rate(g-r)'] = 0.0
-
-    # loop over objects
-    for id_ in ids:
-        subpdf = pdf[pdf['i:objectId'] == id_]
-
-        subpdf['i:jd'] = subpdf['i:jd'].astype(float)
-        subpdf['i:fid'] = subpdf['i:fid'].astype(int)
-        subpdf = subpdf.sort_values('i:jd', ascending=False)
-
-        # Compute DC mag
-        cols = [
-            'i:fid', 'i:magpsf', 'i:sigmapsf', 'i:magnr', 'i:sigmagnr', 'i:magzpsci', 'i:isdiffpos',
-        ]
-
-        mag, err = np.array(
-            [
-                dc_mag(int(i[0]), float(i[1]), float(i[2]), float(i[3]), float(i[4]), float(i[5]), i[6])
-                    for i in zip(*[subpdf[j].values for j in cols])
-            ]
-        ).T
-        subpdf['i:dcmag'] = mag
+    if 'v:dcmag' in pdf.columns and 'v:dcmag_err' in pdf.columns:
+        return pdf['v:dcmag'].values, pdf['v:dcmag_err'].values
+
+    mag, err = dc_mag(
+        pdf['i:fid'].astype(int).values,
+        pdf['i:magpsf'].astype(float).values,
+        pdf['i:sigmapsf'].astype(float).values,
+        pdf['i:magnr'].astype(float).values,
+        pdf['i:sigmagnr'].astype(float).values,
+        pdf['i:magzpsci'].astype(float).values,
+        pdf['i:isdiffpos'].values
+    )
+    return np.atleast_1d(mag), np.atleast_1d(err)
 
-        # group by night
-        gpdf = subpdf.groupby('i:nid')[['i:dcmag', 'i:fid', 'i:jd', 'i:nid']].agg(list)
+def extract_color_evolution(pdf: pd.DataFrame) -> pd.DataFrame:
+    """ Extract the color evolution of all objects in a pandas DataFrame
 
-        # take only nights with at least measurements on 2 different filters
-        mask = gpdf['i:fid'].apply(
-            lambda x: (len(x) > 1) & (np.sum(x) / len(x) != x[0])
-        )
-        gpdf_night = gpdf[mask]
-
-        # compute r-g for those nights
-        values = [g_minus_r(i, j) for i, j in zip(gpdf_night['i:fid'].values, gpdf_night['i:dcmag'].values)]
-        nid = [nid_ for nid_ in gpdf[mask]['i:jd'].apply(lambda x: x[0]).values]
-        jd = [jd_ for jd_ in gpdf[mask]['i:nid'].apply(lambda x: np.mean(x)).values]
-
-        if kind == 'last':
-            vec_ = np.diff(values, prepend=np.nan)
-            for val, nid_ in zip(vec_, nid):
-                pdf['v:g-r'][pdf['i:jd'] == nid_] = val
-        elif kind == 'rate':
-            vec_ = np.diff(values, prepend=np.nan)
-            jd_diff = np.diff(jd, prepend=np.nan)
-            for val, jd_, nid_ in zip(vec_, jd_diff, nid):
-                pdf['v:rate(g-r)'][pdf['i:jd'] == nid_] = val / jd_
-
-    if kind == 'last':
-        return pdf['v:g-r'].replace(0.0, np.nan).values
-    elif kind == 'rate':
-        return pdf['v:rate(g-r)'].replace(0.0, np.nan).values
-
-def extract_delta_color(pdf: pd.DataFrame, filter_: int):
-    """ Extract last g-r for each object in a pandas DataFrame
+    All objects are processed at once (one sort, and group operations),
+    instead of looping over objects.
 
     Parameters
     ----------
     pdf: pandas DataFrame
-        DataFrame containing alert parameters from an API call
-    filter_: int
-        Filter band, as integer. g: 1, r: 2
+        DataFrame containing alert parameters from an API call. It must
+        contain i:objectId, i:jd, i:nid, and the DC magnitude or the
+        columns required to compute it (see `get_dc_mag`).
 
     Returns
     ----------
-    vec: np.array
-        Vector containing delta(mag) for the filter `filter_`. Last measurement
-        shown first.
-    rate: np.array
-        Vector containing delta(mag)/delta(time) for the filter `filter_`.
-        Last measurement shown first.
-    """
-    # extract unique objects
-    ids, indices = np.unique(pdf['i:objectId'].values, return_index=True)
-    ids = [pdf['i:objectId'].values[index] for index in sorted(indices)]
-
-    # loop over objects
-    vec = []
-    rate = []
-    for id_ in ids:
-        maskId = pdf['i:objectId'] == id_
-        subpdf = pdf[maskId]
-
-        subpdf['i:jd'] = subpdf['i:jd'].astype(float)
-        subpdf['i:fid'] = subpdf['i:fid'].astype(int)
-        subpdf = subpdf.sort_values('i:jd', ascending=False)
-
-        # Compute DC mag
-        cols = [
-            'i:fid', 'i:magpsf', 'i:sigmapsf', 'i:magnr', 'i:sigmagnr', 'i:magzpsci', 'i:isdiffpos',
-        ]
-
-        mag, err = np.array(
-            [
-                dc_mag(int(i[0]), float(i[1]), float(i[2]), float(i[3]), float(i[4]), float(i[5]), i[6])
-                    for i in zip(*[subpdf[j].values for j in cols])
-            ]
-        ).T
-        subpdf['i:dcmag'] = mag
-
-        vec_ = np.zeros_like(mag)
-        rate_ = np.zeros_like(mag)
-
-        mask = subpdf['i:fid'] == filter_
-
-        # Diff color
-        vec_[mask] = subpdf[mask]['i:dcmag'].diff(periods=-1).values
-
-        # temp diff jd
-        djd = subpdf[mask]['i:jd'].diff(periods=-1).values
-
-        # color rate
-        rate_[mask] = vec_[mask] / djd
-        vec = np.concatenate([vec, vec_])
-        rate = np.concatenate([rate, rate_])
+    out: pandas DataFrame
+        DataFrame with the same index as `pdf`, and columns:
+        - v:g-r: change of g-r with respect to the previous night having
+        both g and r measurements. Set on the last alert of the night.
+        - v:rate(g-r): v:g-r divided by the number of nights elapsed.
+        - v:dg, v:dr: change of the DC magnitude with respect to the
+        previous alert of the object in the same band. 0 for other bands.
+        - v:rate(dg), v:rate(dr): v:dg and v:dr per day.
+    """
+    mag, err = get_dc_mag(pdf)
+
+    # work with positions, as the index of `pdf` is not necessarily unique
+    work = pd.DataFrame(
+        {
+            'oid': pdf['i:objectId'].values,
+            'nid': pdf['i:nid'].values.astype(int),
+            'jd': pdf['i:jd'].values.astype(float),
+            'fid': pdf['i:fid'].values.astype(int),
+            'mag': mag
+        }
+    )
 
-    # replace nans by 0.0
-    vec = np.nan_to_num(vec)
-    rate = np.nan_to_num(rate)
+    out = pd.DataFrame(
+        {
+            'v:g-r': np.nan,
+            'v:rate(g-r)': np.nan,
+            'v:dg': 0.0,
+            'v:rate(dg)': 0.0,
+            'v:dr': 0.0,
+            'v:rate(dr)': 0.0,
+        },
+        index=work.index
+    )
 
-    return vec, rate
+    # g-r per night, using the first measurement of the night,
+    # and the first measurement in the other band.
+    work = work.sort_values(['oid', 'nid', 'jd'], kind='mergesort')
+    night = work.groupby(['oid', 'nid'], sort=True)
+    first = night.agg(fid_first=('fid', 'first'), mag_first=('mag', 'first'))
+    first['last_alert'] = night['jd'].idxmax()
+
+    fid_first = night['fid'].transform('first')
+    other = work[work['fid'] != fid_first].groupby(['oid', 'nid'], sort=True)
+    second = other.agg(fid_other=('fid', 'first'), mag_other=('mag', 'first'))
+
+    # nights with measurements in (at least) two bands
+    nights = first.join(second, how='inner').reset_index()
+    nights['g-r'] = - (nights['fid_first'] - nights['fid_other']) * (nights['mag_first'] - nights['mag_other'])
+
+    per_object = nights.groupby('oid', sort=False)
+    delta = per_object['g-r'].diff().values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate = delta / per_object['nid'].diff().values
+
+    out.loc[nights['last_alert'].values, 'v:g-r'] = delta
+    out.loc[nights['last_alert'].values, 'v:rate(g-r)'] = rate
+    out['v:g-r'] = out['v:g-r'].replace(0.0, np.nan)
+    out['v:rate(g-r)'] = out['v:rate(g-r)'].replace(0.0, np.nan)
+
+    # Evolution in each band, from one alert to the previous one
+    work = work.sort_values(['oid', 'fid', 'jd'], ascending=[True, True, False], kind='mergesort')
+    band = work.groupby(['oid', 'fid'], sort=False)
+    dmag = band['mag'].diff(periods=-1).values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dmag_rate = dmag / band['jd'].diff(periods=-1).values
+
+    for filter_, name in zip([1, 2], ['dg', 'dr']):
+        mask = work['fid'].values == filter_
+        out.loc[work.index[mask], 'v:{}'.format(name)] = np.nan_to_num(dmag[mask])
+        out.loc[work.index[mask], 'v:rate({})'.format(name)] = np.nan_to_num(dmag_rate[mask])
+
+    out.index = pdf.index
+
+    return out
 
 def queryMPC(number, kind='asteroid'):
     """Query MPC for information about object 'designation'.
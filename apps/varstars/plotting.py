@@ -22,7 +22,7 @@ from astropy.time import Time
 from dash import html, dcc, Input, Output, State, no_update
 import dash_mantine_components as dmc
 
-from apps.utils import dc_mag
+from apps.utils import get_dc_mag
 from apps.plotting import layout_phase, COLORS_ZTF
 
 from app import app
@@ -62,23 +62,13 @@ def plot_variable_star(nterms_base, nterms_band, manual_period, n_clicks, object
             'i:jd', 'i:magpsf', 'i:sigmapsf', 'i:fid',
             'i:magnr', 'i:sigmagnr', 'i:magzpsci', 'i:isdiffpos', 'i:objectId'
         ]
+        # DC magnitudes are cached only if the store was filled with them
+        cols += [col for col in ['v:dcmag', 'v:dcmag_err'] if col in pdf_.columns]
         pdf = pdf_.loc[:, cols]
         pdf['i:fid'] = pdf['i:fid'].astype(str)
         pdf = pdf.sort_values('i:jd', ascending=False)
 
-        mag_dc, err_dc = np.transpose(
-            [
-                dc_mag(*args) for args in zip(
-                    pdf['i:fid'].astype(int).values,
-                    pdf['i:magpsf'].astype(float).values,
-                    pdf['i:sigmapsf'].astype(float).values,
-                    pdf['i:magnr'].astype(float).values,
-                    pdf['i:sigmagnr'].astype(float).values,
-                    pdf['i:magzpsci'].astype(float).values,
-                    pdf['i:isdiffpos'].values
-                )
-            ]
-        )
+        mag_dc, err_dc = get_dc_mag(pdf)
 
         jd = pdf['i:jd']
         fit_period = False if manual_period is not None else True
@@ -0,0 +1,215 @@
+# Copyright 2022 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Benchmark the color evolution engine against the former per-object loops
+
+Usage (from the root of the repository):
+
+    python -m benchmarks.colors_benchmark
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from apps.utils import dc_mag, extract_color_evolution
+
+def make_alerts(nobjects: int, nalerts: int, seed: int = 0) -> pd.DataFrame:
+    """ Random lightcurves with the columns used by the color engine
+    """
+    rng = np.random.default_rng(seed)
+    n = nobjects * nalerts
+
+    oids = np.repeat(['ZTF{:07d}'.format(i) for i in range(nobjects)], nalerts)
+    nights = rng.integers(0, 200, n)
+    jd0 = np.repeat(2459000 + rng.uniform(0, 10, nobjects), nalerts)
+
+    pdf = pd.DataFrame(
+        {
+            'i:objectId': oids,
+            'i:nid': 1000 + nights,
+            'i:jd': jd0 + nights + rng.uniform(0, 0.3, n),
+            'i:fid': rng.integers(1, 3, n),
+            'i:magpsf': rng.uniform(17, 20, n),
+            'i:sigmapsf': rng.uniform(0.05, 0.2, n),
+            'i:magnr': rng.uniform(18, 21, n),
+            'i:sigmagnr': rng.uniform(0.01, 0.1, n),
+            'i:magzpsci': rng.uniform(26, 26.5, n),
+            'i:isdiffpos': rng.choice(['t', 'f'], n),
+        }
+    )
+    return pdf.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+# Former implementation, kept here as a reference
+def g_minus_r(fid, mag):
+    """ Compute r-g based on vectors of filters and magnitudes
+    """
+    if len(fid) == 2:
+        sign = np.diff(fid)[0]
+    else:
+        last_fid = fid[-1]
+        index_other = np.where(np.array(fid) != last_fid)[0][-1]
+        sign = np.diff([fid[index_other], last_fid])[0]
+        mag = [mag[index_other], mag[-1]]
+
+    return -1 * sign * np.diff(mag)[0]
+
+def extract_last_g_minus_r_each_object(pdf, kind):
+    """ Former extraction of last g-r for each object (loop over objects)
+    """
+    ids, indices = np.unique(pdf['i:objectId'].values, return_index=True)
+    ids = [pdf['i:objectId'].values[index] for index in sorted(indices)]
+
+    col = 'v:g-r' if kind == 'last' else 'v:rate(g-r)'
+    pdf.loc[:, col] = 0.0
+
+    for id_ in ids:
+        subpdf = pdf[pdf['i:objectId'] == id_].copy()
+
+        subpdf['i:jd'] = subpdf['i:jd'].astype(float)
+        subpdf['i:fid'] = subpdf['i:fid'].astype(int)
+        subpdf = subpdf.sort_values('i:jd', ascending=False)
+
+        cols = [
+            'i:fid', 'i:magpsf', 'i:sigmapsf', 'i:magnr', 'i:sigmagnr', 'i:magzpsci', 'i:isdiffpos',
+        ]
+
+        mag, err = np.array(
+            [
+                dc_mag(int(i[0]), float(i[1]), float(i[2]), float(i[3]), float(i[4]), float(i[5]), i[6])
+                    for i in zip(*[subpdf[j].values for j in cols])
+            ]
+        ).T
+        subpdf['i:dcmag'] = mag
+
+        gpdf = subpdf.groupby('i:nid')[['i:dcmag', 'i:fid', 'i:jd', 'i:nid']].agg(list)
+
+        mask = gpdf['i:fid'].apply(
+            lambda x: (len(x) > 1) & (np.sum(x) / len(x) != x[0])
+        )
+        gpdf_night = gpdf[mask]
+
+        values = [g_minus_r(i, j) for i, j in zip(gpdf_night['i:fid'].values, gpdf_night['i:dcmag'].values)]
+        nid = [nid_ for nid_ in gpdf[mask]['i:jd'].apply(lambda x: x[0]).values]
+        jd = [jd_ for jd_ in gpdf[mask]['i:nid'].apply(lambda x: np.mean(x)).values]
+
+        vec_ = np.diff(values, prepend=np.nan)
+        if kind == 'last':
+            for val, nid_ in zip(vec_, nid):
+                pdf.loc[pdf['i:jd'] == nid_, col] = val
+        elif kind == 'rate':
+            jd_diff = np.diff(jd, prepend=np.nan)
+            for val, jd_, nid_ in zip(vec_, jd_diff, nid):
+                pdf.loc[pdf['i:jd'] == nid_, col] = val / jd_
+
+    return pdf[col].replace(0.0, np.nan).values
+
+def extract_delta_color(pdf: pd.DataFrame, filter_: int):
+    """ Former extraction of delta(mag) per band (loop over objects)
+    """
+    ids, indices = np.unique(pdf['i:objectId'].values, return_index=True)
+    ids = [pdf['i:objectId'].values[index] for index in sorted(indices)]
+
+    vec = []
+    rate = []
+    for id_ in ids:
+        subpdf = pdf[pdf['i:objectId'] == id_].copy()
+
+        subpdf['i:jd'] = subpdf['i:jd'].astype(float)
+        subpdf['i:fid'] = subpdf['i:fid'].astype(int)
+        subpdf = subpdf.sort_values('i:jd', ascending=False)
+
+        cols = [
+            'i:fid', 'i:magpsf', 'i:sigmapsf', 'i:magnr', 'i:sigmagnr', 'i:magzpsci', 'i:isdiffpos',
+        ]
+
+        mag, err = np.array(
+            [
+                dc_mag(int(i[0]), float(i[1]), float(i[2]), float(i[3]), float(i[4]), float(i[5]), i[6])
+                    for i in zip(*[subpdf[j].values for j in cols])
+            ]
+        ).T
+        subpdf['i:dcmag'] = mag
+
+        vec_ = np.zeros_like(mag)
+        rate_ = np.zeros_like(mag)
+
+        mask = (subpdf['i:fid'] == filter_).values
+        vec_[mask] = subpdf[mask]['i:dcmag'].diff(periods=-1).values
+        djd = subpdf[mask]['i:jd'].diff(periods=-1).values
+        rate_[mask] = vec_[mask] / djd
+        vec = np.concatenate([vec, vec_])
+        rate = np.concatenate([rate, rate_])
+
+    return np.nan_to_num(vec), np.nan_to_num(rate)
+
+def former_color_evolution(pdf: pd.DataFrame) -> pd.DataFrame:
+    """ Color evolution as computed by the former `format_hbase_output`
+    """
+    pdf = pdf.sort_values('i:objectId')
+    pdf['v:g-r'] = extract_last_g_minus_r_each_object(pdf, kind='last')
+    pdf['v:rate(g-r)'] = extract_last_g_minus_r_each_object(pdf, kind='rate')
+
+    pdf = pdf.sort_values('i:jd', ascending=False)
+    pdf['v:dg'], pdf['v:rate(dg)'] = extract_delta_color(pdf, filter_=1)
+    pdf['v:dr'], pdf['v:rate(dr)'] = extract_delta_color(pdf, filter_=2)
+    return pdf
+
+def check_agreement(nalerts: int = 500) -> None:
+    """ Both implementations agree for a single object
+
+    For several objects, the former implementation assigned v:dg/v:dr
+    in object order to rows sorted by time, and v:g-r to every alert
+    sharing the same jd -- so only single objects are compared.
+    """
+    pdf = make_alerts(1, nalerts)
+    new = extract_color_evolution(pdf)
+    old = former_color_evolution(pdf.copy())
+
+    for col in new.columns:
+        np.testing.assert_allclose(
+            new.loc[old.index, col].values,
+            old[col].values,
+            equal_nan=True,
+            err_msg=col
+        )
+
+def benchmark(nobjects: int, nalerts: int, nrepeat: int = 3) -> None:
+    """ Time both implementations on a frame of nobjects x nalerts rows
+    """
+    pdf = make_alerts(nobjects, nalerts)
+
+    timings = {'former': [], 'vectorized': []}
+    for _ in range(nrepeat):
+        t0 = time.time()
+        former_color_evolution(pdf.copy())
+        timings['former'].append(time.time() - t0)
+
+        t0 = time.time()
+        extract_color_evolution(pdf)
+        timings['vectorized'].append(time.time() - t0)
+
+    former = np.min(timings['former'])
+    vectorized = np.min(timings['vectorized'])
+    print(
+        '{:>6} rows ({:>5} objects): former {:8.3f}s, vectorized {:8.3f}s, speed-up x{:.1f}'.format(
+            len(pdf), nobjects, former, vectorized, former / vectorized
+        )
+    )
+
+
+if __name__ == "__main__":
+    check_agreement()
+    for nobjects, nalerts in [(1, 10000), (100, 100), (1000, 10)]:
+        benchmark(nobjects, nalerts)
@@ -0,0 +1,100 @@
+# Copyright 2022 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Benchmark the conesearch on RING (one key per pixel) and NESTED (range scans) tables
+
+Usage (from the root of the repository):
+
+    # number of keys/scans and time to compute them, versus radius
+    python -m benchmarks.conesearch_benchmark
+
+    # and latency of /api/v1/explorer on a running portal
+    # (run it once with PIXEL_ORDERING: ring, and once with nested)
+    python -m benchmarks.conesearch_benchmark http://localhost:24000
+"""
+import sys
+import time
+
+import numpy as np
+import healpy as hp
+import requests
+
+from apps.healpix import disc_ranges
+
+# Radii in arcsecond, spanning the three pixel index tables
+RADII = [5, 30, 100, 1000, 3600, 18000]
+
+# Position of the test data (ZTF21abfmbix)
+RA, DEC = 193.8217409, 2.8973184
+
+def table_nside(radius: float) -> int:
+    """ Resolution of the pixel index table used by /api/v1/explorer
+    """
+    if radius <= 30.:
+        return 131072
+    elif radius <= 1000.:
+        return 4096
+    return 128
+
+def count_keys(radius: float, nrepeat: int = 5) -> None:
+    """ Keys sent for a RING table versus range scans for a NESTED table
+    """
+    nside = table_nside(radius)
+    vec = hp.ang2vec(RA, DEC, lonlat=True)
+
+    ring, nested = [], []
+    for _ in range(nrepeat):
+        t0 = time.time()
+        pixs = hp.query_disc(nside, vec, np.radians(radius / 3600.), inclusive=True)
+        ring.append(time.time() - t0)
+
+        t0 = time.time()
+        ranges = disc_ranges(RA, DEC, radius / 3600., nside)
+        nested.append(time.time() - t0)
+
+    print(
+        '{:>6}" (nside {:>6}): ring {:>6} keys ({:6.2f}ms), nested {:>4} range scans ({:6.2f}ms)'.format(
+            radius, nside, len(pixs), 1000 * np.min(ring),
+            len(ranges), 1000 * np.min(nested)
+        )
+    )
+
+def query_latency(url: str, radius: float, nrepeat: int = 3) -> None:
+    """ End-to-end latency of a conesearch, and number of scans reported by the server
+    """
+    durations = []
+    for _ in range(nrepeat):
+        t0 = time.time()
+        r = requests.post(
+            '{}/api/v1/explorer'.format(url),
+            json={'ra': RA, 'dec': DEC, 'radius': radius, 'columns': 'i:objectId'}
+        )
+        durations.append(time.time() - t0)
+
+    timing = r.headers.get('Server-Timing', '')
+    nscans = len(timing.split(',')) if timing != '' else 0
+    print(
+        '{:>6}": {:8.3f}s, {:>4} scans reported, {:>5} objects'.format(
+            radius, np.min(durations), nscans, len(r.json())
+        )
+    )
+
+
+if __name__ == "__main__":
+    for radius in RADII:
+        count_keys(radius)
+
+    if len(sys.argv) > 1:
+        for radius in RADII:
+            query_latency(sys.argv[1], radius)
@@ -0,0 +1,82 @@
+# Copyright 2022 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Benchmark the HEALPix constellation lookup against astropy get_constellation
+
+Usage (from the root of the repository):
+
+    python -m benchmarks.constellations_benchmark
+"""
+import time
+
+import numpy as np
+
+from astropy.coordinates import SkyCoord, get_constellation
+
+from apps.constellations import load_constellation_map, lookup_constellation
+
+def make_positions(npos: int, seed: int = 0) -> tuple:
+    """ Positions drawn uniformly on the sphere, in degree
+    """
+    rng = np.random.default_rng(seed)
+    ra = rng.uniform(0, 360, npos)
+    dec = np.degrees(np.arcsin(rng.uniform(-1, 1, npos)))
+    return ra, dec
+
+def check_agreement(npos: int = 1000000) -> None:
+    """ The lookup agrees with get_constellation everywhere on the sky
+    """
+    ra, dec = make_positions(npos, seed=1)
+    expected = get_constellation(SkyCoord(ra, dec, unit='deg'))
+    found = lookup_constellation(ra, dec)
+
+    mismatch = np.sum(found != expected)
+    assert mismatch == 0, '{} mismatches out of {}'.format(mismatch, npos)
+
+def benchmark(npos: int, nrepeat: int = 3) -> None:
+    """ Time both implementations on npos positions
+    """
+    ra, dec = make_positions(npos)
+
+    timings = {'astropy': [], 'lookup': []}
+    for _ in range(nrepeat):
+        t0 = time.time()
+        get_constellation(SkyCoord(ra, dec, unit='deg'))
+        timings['astropy'].append(time.time() - t0)
+
+        t0 = time.time()
+        lookup_constellation(ra, dec)
+        timings['lookup'].append(time.time() - t0)
+
+    astropy_ = np.min(timings['astropy'])
+    lookup = np.min(timings['lookup'])
+    print(
+        '{:>7} positions: astropy {:8.3f}s, lookup {:8.3f}s, speed-up x{:.1f}'.format(
+            npos, astropy_, lookup, astropy_ / lookup
+        )
+    )
+
+
+if __name__ == "__main__":
+    t0 = time.time()
+    names, index, boundary = load_constellation_map()
+    print(
+        'Map loaded in {:.1f}s: {} constellations, {:.1f}% boundary pixels'.format(
+            time.time() - t0, len(names), 100 * np.mean(boundary)
+        )
+    )
+
+    check_agreement()
+    for npos in [1000, 10000, 100000]:
+        benchmark(npos)
@@ -0,0 +1,87 @@
+# Copyright 2022 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Benchmark the catalog coordinate parsing against the former per-row SkyCoord
+
+Usage (from the root of the repository):
+
+    python -m benchmarks.coordinates_benchmark
+"""
+import time
+
+import numpy as np
+
+import astropy.units as u
+from astropy.coordinates import SkyCoord, Angle
+
+from apps.coordinates import parse_coordinates
+
+# The per-row parsing is timed on this many rows, and extrapolated
+NREF = 2000
+
+def make_catalog(nrows: int, fmt: str, seed: int = 0) -> tuple:
+    """ Random positions, as a user catalog would give them
+    """
+    rng = np.random.default_rng(seed)
+    ra = rng.uniform(0, 360, nrows)
+    dec = np.degrees(np.arcsin(rng.uniform(-1, 1, nrows)))
+
+    if fmt == 'deg':
+        return ra, dec
+
+    ras = Angle(ra, unit='deg').to_string(unit=u.hourangle, sep=':' if fmt == 'sexagesimal' else 'hms', precision=3)
+    decs = Angle(dec, unit='deg').to_string(unit=u.deg, sep=':' if fmt == 'sexagesimal' else 'dms', precision=2, alwayssign=True)
+    return ras, decs
+
+def per_row(ras, decs) -> tuple:
+    """ Former implementation in /api/v1/xmatch: one SkyCoord per row
+    """
+    ra0 = ras[0]
+    if 'h' in str(ra0):
+        coords = [SkyCoord(ra, dec, frame='icrs') for ra, dec in zip(ras, decs)]
+    elif ':' in str(ra0) or ' ' in str(ra0):
+        coords = [SkyCoord(ra, dec, frame='icrs', unit=(u.hourangle, u.deg)) for ra, dec in zip(ras, decs)]
+    else:
+        coords = [SkyCoord(ra, dec, frame='icrs', unit='deg') for ra, dec in zip(ras, decs)]
+    return np.array([c.ra.deg for c in coords]), np.array([c.dec.deg for c in coords])
+
+def benchmark(nrows: int, fmt: str) -> None:
+    """ Time both implementations, and check they agree
+    """
+    ras, decs = make_catalog(nrows, fmt)
+
+    t0 = time.time()
+    ra, dec = parse_coordinates(ras, decs)
+    vectorized = time.time() - t0
+
+    t0 = time.time()
+    ra_ref, dec_ref = per_row(ras[:NREF], decs[:NREF])
+    reference = (time.time() - t0) * nrows / min(nrows, NREF)
+
+    assert np.allclose(ra[:NREF], ra_ref, atol=1e-6)
+    assert np.allclose(dec[:NREF], dec_ref, atol=1e-6)
+
+    print(
+        '{:>7} rows {:>11}: per-row {:8.2f}s{}, vectorized {:7.3f}s, speed-up x{:.0f}'.format(
+            nrows, fmt, reference, '*' if nrows > NREF else ' ',
+            vectorized, reference / vectorized
+        )
+    )
+
+
+if __name__ == "__main__":
+    for fmt in ['deg', 'sexagesimal', 'hms']:
+        for nrows in [1000, 100000, 1000000]:
+            benchmark(nrows, fmt)
+    print('* extrapolated from {} rows'.format(NREF))
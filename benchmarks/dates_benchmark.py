@@ -0,0 +1,99 @@
+# Copyright 2022 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Benchmark the JD to ISO conversion against the former per-row conversion
+
+Usage (from the root of the repository):
+
+    python -m benchmarks.dates_benchmark
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from astropy.time import Time
+
+from apps.utils import convert_jd, convert_jd_memo
+
+def make_dates(nrows: int, nobjects: int = 100, seed: int = 0) -> pd.DataFrame:
+    """ Random jd and jdstarthist columns, jdstarthist shared by alerts of the same object
+    """
+    rng = np.random.default_rng(seed)
+    jdstarthist = 2458800 + rng.uniform(0, 1000, nobjects)
+
+    pdf = pd.DataFrame(
+        {
+            'i:jd': 2459800 + rng.uniform(0, 300, nrows),
+            'i:jdstarthist': jdstarthist[rng.integers(0, nobjects, nrows)],
+        }
+    )
+    return pdf
+
+def former_dates(pdf: pd.DataFrame) -> tuple:
+    """ Dates as computed by the former `format_hbase_output` (one Time per row)
+    """
+    lastdate = pdf['i:jd'].apply(lambda x: Time(x, format='jd').to_value('iso'))
+    firstdate = pdf['i:jdstarthist'].apply(lambda x: Time(x, format='jd').to_value('iso'))
+    return lastdate.values, firstdate.values
+
+def vectorized_dates(pdf: pd.DataFrame, memo: dict) -> tuple:
+    """ Dates as computed by `format_hbase_output`
+    """
+    lastdate = convert_jd(pdf['i:jd'].values)
+    firstdate = convert_jd_memo(pdf['i:jdstarthist'].values, memo=memo)
+    return lastdate, firstdate
+
+def check_agreement(nrows: int = 1000) -> None:
+    """ Both implementations return the same dates
+    """
+    pdf = make_dates(nrows)
+    old = former_dates(pdf)
+    new = vectorized_dates(pdf, memo={})
+    for i, j in zip(old, new):
+        np.testing.assert_array_equal(i, j.astype(str))
+
+def benchmark(nrows: int, nrepeat: int = 3) -> None:
+    """ Time both implementations on a frame of nrows rows
+
+    The memo is cold for the first repetition only, as for
+    a server answering several requests on the same objects.
+    """
+    pdf = make_dates(nrows)
+
+    memo = {}
+    timings = {'former': [], 'cold': [], 'warm': []}
+    for index in range(nrepeat):
+        # the former implementation takes minutes at 100k rows
+        if nrows <= 10000:
+            t0 = time.time()
+            former_dates(pdf)
+            timings['former'].append(time.time() - t0)
+
+        t0 = time.time()
+        vectorized_dates(pdf, memo=memo)
+        timings['cold' if index == 0 else 'warm'].append(time.time() - t0)
+
+    former = np.min(timings['former']) if len(timings['former']) > 0 else np.nan
+    print(
+        '{:>7} rows: former {:8.3f}s, vectorized {:8.3f}s (cold memo), {:8.3f}s (warm memo), speed-up x{:.1f}'.format(
+            nrows, former, timings['cold'][0], np.min(timings['warm']), former / np.min(timings['warm'])
+        )
+    )
+
+
+if __name__ == "__main__":
+    check_agreement()
+    for nrows in [1000, 10000, 100000]:
+        benchmark(nrows)
@@ -0,0 +1,114 @@
+# Copyright 2022 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Benchmark the output formats of the REST API on a latests-like result
+
+Usage (from the root of the repository):
+
+    # synthetic 100k-row result
+    python -m benchmarks.formats_benchmark
+
+    # or a real /api/v1/latests result, fetched once from a running portal
+    python -m benchmarks.formats_benchmark http://localhost:24000
+"""
+import io
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import requests
+
+from apps.api.serializers import STREAMERS
+
+def make_latests(nrows: int, seed: int = 0) -> pd.DataFrame:
+    """ Random alerts with the column types of a latests result
+    """
+    rng = np.random.default_rng(seed)
+
+    data = {
+        'i:objectId': ['ZTF{:09d}'.format(i) for i in rng.integers(0, 10**9, nrows)],
+        'i:candid': rng.integers(10**17, 10**18, nrows),
+        'i:fid': rng.integers(1, 3, nrows),
+        'i:isdiffpos': rng.choice(['t', 'f'], nrows),
+        'd:cdsxmatch': rng.choice(['Unknown', 'RRLyr', 'EB*', 'QSO'], nrows),
+        'v:classification': rng.choice(['SN candidate', 'Unknown', 'Solar System MPC'], nrows),
+        'v:lastdate': ['2022-0{}-1{} 0{}:12:34.567'.format(i % 9 + 1, i % 10, i % 10) for i in range(nrows)],
+    }
+    # ZTF and science module floats
+    for name in [
+            'i:jd', 'i:ra', 'i:dec', 'i:magpsf', 'i:sigmapsf', 'i:magnr',
+            'i:sigmagnr', 'i:magzpsci', 'i:drb', 'i:classtar', 'i:jdstarthist',
+            'd:rf_snia_vs_nonia', 'd:snn_snia_vs_nonia', 'd:snn_sn_vs_all',
+            'd:mulens', 'd:rf_kn_vs_nonkn', 'v:lapse'] + ['i:extra{}'.format(i) for i in range(40)]:
+        data[name] = rng.normal(size=nrows)
+
+    return pd.DataFrame(data)
+
+def fetch_latests(url: str, nrows: int) -> pd.DataFrame:
+    """ Latests alerts of all classes from a running portal
+    """
+    r = requests.post(
+        '{}/api/v1/latests'.format(url),
+        json={'class': 'allclasses', 'n': nrows, 'output-format': 'parquet'}
+    )
+    return pd.read_parquet(io.BytesIO(r.content))
+
+def read_back(payload: bytes, output_format: str) -> pd.DataFrame:
+    """ Client side: parse the payload into a DataFrame
+    """
+    if output_format == 'json':
+        return pd.read_json(io.BytesIO(payload))
+    elif output_format == 'parquet':
+        return pd.read_parquet(io.BytesIO(payload))
+    elif output_format == 'arrow':
+        return pa.ipc.open_stream(payload).read_pandas()
+
+def benchmark(pdf: pd.DataFrame, output_format: str, nrepeat: int = 3) -> None:
+    """ Time serialization, deserialization, and measure payload size
+    """
+    serializer, _ = STREAMERS[output_format]
+
+    write, read = [], []
+    for _ in range(nrepeat):
+        t0 = time.time()
+        payload = b''.join(
+            chunk.encode() if isinstance(chunk, str) else chunk
+            for chunk in serializer(pdf)
+        )
+        write.append(time.time() - t0)
+
+        t0 = time.time()
+        out = read_back(payload, output_format)
+        read.append(time.time() - t0)
+
+    assert len(out) == len(pdf)
+    print(
+        '{:>8}: serialization {:7.3f}s, deserialization {:7.3f}s, payload {:8.1f} MB'.format(
+            output_format, np.min(write), np.min(read), len(payload) / 1024**2
+        )
+    )
+
+
+if __name__ == "__main__":
+    nrows = 100000
+    if len(sys.argv) > 1:
+        pdf = fetch_latests(sys.argv[1], nrows)
+    else:
+        pdf = make_latests(nrows)
+    print('{} rows, {} columns'.format(len(pdf), len(pdf.columns)))
+
+    for output_format in ['json', 'parquet', 'arrow']:
+        benchmark(pdf, output_format)
@@ -0,0 +1,102 @@
+# Copyright 2022 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import requests
+import pandas as pd
+import numpy as np
+
+import io
+import sys
+
+APIURL = sys.argv[1]
+
+def batch(queries: list) -> dict:
+    """ Run several queries at once using the Fink REST API
+    """
+    r = requests.post(
+        '{}/api/v1/batch'.format(APIURL),
+        json={'queries': queries}
+    )
+    assert r.status_code == 200, r.content
+
+    return r.json()
+
+def test_batch() -> None:
+    """
+    Examples
+    ---------
+    >>> test_batch()
+    """
+    out = batch(
+        [
+            {'id': 'obj', 'endpoint': 'objects', 'payload': {'objectId': 'ZTF21abfmbix', 'columns': 'i:objectId,i:jd'}},
+            {'id': 'sso', 'endpoint': 'sso', 'payload': {'n_or_d': '8467', 'columns': 'i:ssnamenr,i:jd'}},
+            {'id': 'cone', 'endpoint': 'explorer', 'payload': {'ra': '193.8217409', 'dec': '2.8973184', 'radius': '5'}},
+        ]
+    )
+
+    assert sorted(out.keys()) == ['cone', 'obj', 'sso'], out.keys()
+    for key in out:
+        assert out[key]['status'] == 'ok', out[key]
+
+    # Same data as the single query
+    r = requests.post(
+        '{}/api/v1/objects'.format(APIURL),
+        json={'objectId': 'ZTF21abfmbix', 'columns': 'i:objectId,i:jd'}
+    )
+    pdf = pd.read_json(io.BytesIO(r.content))
+    pdf_batch = pd.DataFrame(out['obj']['data'])
+
+    assert len(pdf) == len(pdf_batch), (len(pdf), len(pdf_batch))
+    assert np.allclose(pdf['i:jd'].values, pdf_batch['i:jd'].values)
+
+def test_batch_errors() -> None:
+    """
+    Examples
+    ---------
+    >>> test_batch_errors()
+    """
+    out = batch(
+        [
+            {'endpoint': 'objects', 'payload': {'objectId': 'ZTF21abfmbix', 'columns': 'i:objectId'}},
+            {'endpoint': 'objects', 'payload': {}},
+            {'endpoint': 'unknown', 'payload': {}},
+        ]
+    )
+
+    # default ids are the positions in the list
+    assert out['0']['status'] == 'ok', out['0']
+    assert out['1']['status'] == 'error', out['1']
+    assert out['2']['status'] == 'error', out['2']
+
+def test_bad_batch() -> None:
+    """
+    Examples
+    ---------
+    >>> test_bad_batch()
+    """
+    r = requests.post(
+        '{}/api/v1/batch'.format(APIURL),
+        json={'queries': []}
+    )
+
+    assert r.status_code == 400
+
+
+if __name__ == "__main__":
+    """ Execute the test suite """
+    import sys
+    import doctest
+
+    sys.exit(doctest.testmod()[0])
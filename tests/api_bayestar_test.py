@@ -15,9 +15,14 @@
 import requests
 import pandas as pd
 import numpy as np
+import healpy as hp
+
+from astropy.io import fits
+from astropy.time import Time
 
 import io
 import sys
+import base64
 
 APIURL = sys.argv[1]
 
@@ -40,6 +45,55 @@ def bayestartest(bayestar='bayestar.fits.gz', credible_level=0.1, output_format=
 
     return pdf
 
+def credible_region(bayestar='bayestar.fits.gz', credible_level=0.1):
+    """ NESTED pixels of the credible region, and their resolution
+    """
+    hpx = hp.read_map(bayestar, nest=True)
+    i = np.flipud(np.argsort(hpx))
+    levels = np.empty_like(hpx)
+    levels[i] = np.cumsum(hpx[i])
+    return np.where(levels <= credible_level)[0], hp.npix2nside(len(hpx))
+
+def expected_alerts(bayestar='bayestar.fits.gz', credible_level=0.1):
+    """ Alerts of the credible region, found with conesearches instead
+
+    The region is covered by discs around its order-4 cells (radius below
+    4 degrees). The last alert of each object within the time window of
+    the event is kept if it lies inside the region.
+    """
+    region, nside = credible_region(bayestar, credible_level)
+    order = hp.nside2order(nside)
+
+    # 1 day before the event, to 6 days after the event
+    jdstart = Time(fits.getheader(bayestar, 1)['DATE-OBS']).jd - 1
+
+    parents = region >> (2 * (order - 4))
+    pdfs = []
+    for parent in np.unique(parents):
+        center = np.array(hp.pix2vec(16, parent, nest=True))
+        vecs = np.array(hp.pix2vec(nside, region[parents == parent], nest=True))
+        radius = np.degrees(np.arccos(np.clip(center @ vecs, -1, 1))).max()
+        radius += 2 * hp.nside2resol(nside, arcmin=True) / 60.
+        ra, dec = hp.pix2ang(16, parent, nest=True, lonlat=True)
+
+        r = requests.post(
+            '{}/api/v1/explorer'.format(APIURL),
+            json={
+                'ra': str(ra),
+                'dec': str(dec),
+                'radius': str(radius * 3600.),
+                'startdate_conesearch': '{}'.format(jdstart),
+                'window_days_conesearch': 6
+            }
+        )
+        pdfs.append(pd.read_json(io.BytesIO(r.content)))
+
+    pdf = pd.concat(pdfs, ignore_index=True)
+    pdf = pdf.loc[pdf.groupby('i:objectId')['i:jd'].idxmax()]
+
+    ipix = hp.ang2pix(nside, pdf['i:ra'].values, pdf['i:dec'].values, nest=True, lonlat=True)
+    return pdf[np.isin(ipix, region)]
+
 def test_bayestar() -> None:
     """
     Examples
@@ -48,13 +102,127 @@ def test_bayestar() -> None:
     """
     pdf = bayestartest()
 
-    assert len(pdf) == 59, len(pdf)
+    # Same alerts as the conesearches over the region
+    expected = expected_alerts()
+    assert len(expected) > 0, len(expected)
+    assert len(pdf) == len(expected), (len(pdf), len(expected))
+    assert set(pdf['i:objectId']) == set(expected['i:objectId'])
+
+    # All alerts are inside the credible region
+    region, nside = credible_region()
+    ipix = hp.ang2pix(nside, pdf['i:ra'].values, pdf['i:dec'].values, nest=True, lonlat=True)
+    assert np.all(np.isin(ipix, region)), pdf[~np.isin(ipix, region)]
+
+    # Regions are nested
+    pdf_larger = bayestartest(credible_level=0.2)
+    assert set(pdf['i:objectId']) <= set(pdf_larger['i:objectId'])
 
     a = pdf.groupby('v:classification').count()\
         .sort_values('i:objectId', ascending=False)['i:objectId']\
         .to_dict()
 
-    assert a['QSO'] == 18, a
+    b = expected.groupby('v:classification').count()['i:objectId'].to_dict()
+
+    assert a['QSO'] == b['QSO'], (a, b)
+    assert a == b, (a, b)
+
+def test_bayestar_row_counts() -> None:
+    """
+    Examples
+    ---------
+    >>> test_bayestar_row_counts()
+    """
+    data = open('bayestar.fits.gz', 'rb').read()
+    r = requests.post(
+        '{}/api/v1/bayestar'.format(APIURL),
+        json={'bayestar': str(data), 'credible_level': 0.1}
+    )
+    pdf = pd.read_json(io.BytesIO(r.content))
+
+    scanned = int(r.headers['X-Rows-Scanned'])
+    returned = int(r.headers['X-Rows-Returned'])
+
+    assert returned == len(pdf), (returned, len(pdf))
+    assert scanned >= returned, (scanned, returned)
+
+def test_bayestar_scan_timings() -> None:
+    """
+    Examples
+    ---------
+    >>> test_bayestar_scan_timings()
+    """
+    data = open('bayestar.fits.gz', 'rb').read()
+    r = requests.post(
+        '{}/api/v1/bayestar'.format(APIURL),
+        json={'bayestar': str(data), 'credible_level': 0.1}
+    )
+
+    # Range scans over the pixel index tables
+    timings = r.headers['Server-Timing'].split(', ')
+    pixel_scans = [i for i in timings if '.pixel' in i]
+    assert len(pixel_scans) > 1, timings
+    assert all(['rows' in i for i in pixel_scans]), pixel_scans
+
+def test_bayestar_encodings() -> None:
+    """
+    Examples
+    ---------
+    >>> test_bayestar_encodings()
+    """
+    data = open('bayestar.fits.gz', 'rb').read()
+
+    # base64 in the JSON payload
+    r = requests.post(
+        '{}/api/v1/bayestar'.format(APIURL),
+        json={'bayestar': base64.b64encode(data).decode(), 'credible_level': 0.1}
+    )
+    pdf_base64 = pd.read_json(io.BytesIO(r.content))
+
+    # file upload
+    r = requests.post(
+        '{}/api/v1/bayestar'.format(APIURL),
+        files={'bayestar': open('bayestar.fits.gz', 'rb')},
+        data={'credible_level': 0.1}
+    )
+    pdf_upload = pd.read_json(io.BytesIO(r.content))
+
+    pdf = bayestartest()
+
+    assert len(pdf_base64) == len(pdf), len(pdf_base64)
+    assert len(pdf_upload) == len(pdf), len(pdf_upload)
+
+def test_bayestar_cache() -> None:
+    """
+    Examples
+    ---------
+    >>> test_bayestar_cache()
+    """
+    data = open('bayestar.fits.gz', 'rb').read()
+
+    # Credible levels are computed once per sky map
+    requests.post(
+        '{}/api/v1/bayestar'.format(APIURL),
+        json={'bayestar': str(data), 'credible_level': 0.1}
+    )
+    r = requests.post(
+        '{}/api/v1/bayestar'.format(APIURL),
+        json={'bayestar': str(data), 'credible_level': 0.05}
+    )
+
+    assert r.headers['X-Cache'] == 'HIT', r.headers.get('X-Cache')
+
+def test_bayestar_invalid() -> None:
+    """
+    Examples
+    ---------
+    >>> test_bayestar_invalid()
+    """
+    r = requests.post(
+        '{}/api/v1/bayestar'.format(APIURL),
+        json={'bayestar': 'not a sky map', 'credible_level': 0.1}
+    )
+
+    assert r.status_code == 400, r.status_code
 
 
 if __name__ == "__main__":
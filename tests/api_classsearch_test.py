@@ -192,6 +192,34 @@ def test_various_outputs() -> None:
         isclose = np.isclose(pdf1[cols1], pdf2[cols2])
         assert np.alltrue(isclose), fmt
 
+def test_compression() -> None:
+    """
+    Examples
+    ---------
+    >>> test_compression()
+    """
+    payload = {
+        'class': 'Solar System MPC',
+        'n': 100,
+        'output-format': 'json'
+    }
+
+    # requests accepts gzip (and zstd if installed) by default, and decodes it transparently
+    r = requests.post('{}/api/v1/latests'.format(APIURL), json=payload)
+    assert r.headers.get('Content-Encoding') in ['gzip', 'zstd'], r.headers
+    pdf = pd.read_json(io.BytesIO(r.content))
+
+    # no compression if the client does not ask for it
+    r = requests.post(
+        '{}/api/v1/latests'.format(APIURL),
+        json=payload,
+        headers={'Accept-Encoding': 'identity'}
+    )
+    assert 'Content-Encoding' not in r.headers, r.headers
+    pdf_raw = pd.read_json(io.BytesIO(r.content))
+
+    assert len(pdf) == len(pdf_raw), (len(pdf), len(pdf_raw))
+
 
 if __name__ == "__main__":
     """ Execute the test suite """
@@ -190,6 +190,32 @@ def test_bad_request() -> None:
     }
     assert r.text == str(msg), r.text
 
+def test_bad_declination() -> None:
+    """
+    Examples
+    ---------
+    >>> test_bad_declination()
+    """
+    payload = {
+        'ra': '370',
+        'dec': '95',
+        'radius': 5,
+        'output_format': 'json'
+    }
+
+    r = requests.post(
+        '{}/api/v1/explorer'.format(APIURL),
+        json=payload
+    )
+
+    assert r.status_code == 400, r.status_code
+
+    msg = {
+        'status': 'error',
+        'text': ValueError('Latitude angle(s) must be within -90 deg <= angle <= 90 deg, got 95.0 deg')
+    }
+    assert r.text == str(msg), r.text
+
 def test_various_outputs() -> None:
     """
     Examples
@@ -210,6 +236,27 @@ def test_various_outputs() -> None:
         isclose = np.isclose(pdf1[cols1], pdf2[cols2])
         assert np.alltrue(isclose), fmt
 
+def test_conesearch_columns() -> None:
+    """
+    Examples
+    ---------
+    >>> test_conesearch_columns()
+    """
+    payload = {'ra': '193.8217409', 'dec': '2.8973184', 'radius': '1000'}
+    r = requests.post('{}/api/v1/explorer'.format(APIURL), json=payload)
+    pdf1 = pd.read_json(io.BytesIO(r.content))
+
+    payload['columns'] = 'i:objectId,i:magpsf'
+    r = requests.post('{}/api/v1/explorer'.format(APIURL), json=payload)
+    pdf2 = pd.read_json(io.BytesIO(r.content))
+
+    # Columns used to sort by distance are not sent back
+    assert list(pdf2.columns) == ['i:objectId', 'i:magpsf', 'v:separation_degree'], pdf2.columns
+
+    # Same objects, in the same order
+    assert np.all(pdf1['i:objectId'].values == pdf2['i:objectId'].values)
+    assert np.allclose(pdf1['i:magpsf'].values, pdf2['i:magpsf'].values)
+
 
 if __name__ == "__main__":
     """ Execute the test suite """
@@ -0,0 +1,147 @@
+# Copyright 2022 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import requests
+import pandas as pd
+import numpy as np
+
+import io
+import sys
+import time
+
+APIURL = sys.argv[1]
+
+def run_job(endpoint: str, payload: dict, timeout: float = 300) -> dict:
+    """ Submit an asynchronous query, and wait for it to finish
+    """
+    payload = dict(payload, **{'async': True})
+    r = requests.post(
+        '{}/api/v1/{}'.format(APIURL, endpoint),
+        json=payload
+    )
+    assert r.status_code == 202, r.content
+
+    url = r.json()['url']
+    t0 = time.time()
+    status = requests.get(url).json()
+    while status['status'] in ['queued', 'running']:
+        assert time.time() - t0 < timeout, status
+        assert 0 <= status['progress'] <= 1, status
+        time.sleep(1)
+        status = requests.get(url).json()
+
+    return status
+
+def test_latests_job() -> None:
+    """
+    Examples
+    ---------
+    >>> test_latests_job()
+    """
+    status = run_job('latests', {'class': 'Solar System MPC', 'n': 100})
+
+    assert status['status'] == 'done', status
+    assert status['progress'] == 1.0
+    assert status['nrows'] == 100, status['nrows']
+    assert status['expires'] > time.time()
+
+    # Same data in any format
+    r = requests.get(status['result'], params={'output-format': 'parquet'})
+    pdf = pd.read_parquet(io.BytesIO(r.content))
+
+    r = requests.get(status['result'])
+    pdf_json = pd.read_json(io.BytesIO(r.content))
+
+    assert len(pdf) == 100, len(pdf)
+    assert np.all(pdf['i:objectId'].values == pdf_json['i:objectId'].values)
+
+def test_explorer_job() -> None:
+    """
+    Examples
+    ---------
+    >>> test_explorer_job()
+    """
+    payload = {'ra': '193.8217409', 'dec': '2.8973184', 'radius': '5'}
+    status = run_job('explorer', payload)
+
+    assert status['status'] == 'done', status
+
+    r = requests.post('{}/api/v1/explorer'.format(APIURL), json=payload)
+    pdf = pd.read_json(io.BytesIO(r.content))
+
+    assert status['nrows'] == len(pdf), (status['nrows'], len(pdf))
+
+def test_xmatch_job() -> None:
+    """
+    Examples
+    ---------
+    >>> test_xmatch_job()
+    """
+    payload = {
+        'catalog': open('mycatalog.csv').read(),
+        'header': 'RA,Dec,ID,Time',
+        'radius': 1.5,
+        'window': 7
+    }
+    status = run_job('xmatch', payload)
+
+    assert status['status'] == 'done', status
+
+    r = requests.get(status['result'], params={'output-format': 'csv'})
+    pdf = pd.read_csv(io.BytesIO(r.content))
+
+    assert len(pdf) == 1, len(pdf)
+    assert pdf['ID'].values[0] == 'AnObjectMatching'
+
+def test_failed_job() -> None:
+    """
+    Examples
+    ---------
+    >>> test_failed_job()
+    """
+    payload = {
+        'catalog': open('mycatalog.csv').read(),
+        'header': 'RA,Dec',
+        'radius': 1.5,
+    }
+    status = run_job('xmatch', payload)
+
+    assert status['status'] == 'failed', status
+    assert 'Header' in status['error'], status['error']
+
+    r = requests.get('{}/api/v1/jobs/{}/result'.format(APIURL, status['id']))
+    assert r.status_code == 409
+
+def test_unknown_job() -> None:
+    """
+    Examples
+    ---------
+    >>> test_unknown_job()
+    """
+    r = requests.get('{}/api/v1/jobs/{}'.format(APIURL, '0' * 32))
+    assert r.status_code == 404
+
+    r = requests.get('{}/api/v1/jobs/{}/result'.format(APIURL, '0' * 32))
+    assert r.status_code == 404
+
+    r = requests.get('{}/api/v1/jobs/{}'.format(APIURL, '../config.yml'))
+    assert r.status_code == 404
+
+
+if __name__ == "__main__":
+    """ Execute the test suite """
+    import sys
+    import doctest
+
+    sys.exit(doctest.testmod()[0])
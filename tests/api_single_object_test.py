@@ -15,6 +15,9 @@
 import requests
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+
+from astropy.coordinates import SkyCoord, get_constellation
 
 import io
 import sys
@@ -45,6 +48,10 @@ def get_an_object(oid='ZTF21abfmbix', output_format='json', columns='*', withupp
         pdf = pd.read_csv(io.BytesIO(r.content))
     elif output_format == 'parquet':
         pdf = pd.read_parquet(io.BytesIO(r.content))
+    elif output_format == 'ndjson':
+        pdf = pd.read_json(io.BytesIO(r.content), lines=True)
+    elif output_format == 'arrow':
+        pdf = pa.ipc.open_stream(r.content).read_pandas()
 
     return pdf
 
@@ -78,6 +85,33 @@ def test_single_object_parquet() -> None:
 
     assert not pdf.empty
 
+def test_single_object_ndjson() -> None:
+    """
+    Examples
+    ---------
+    >>> test_single_object_ndjson()
+    """
+    pdf = get_an_object(oid=OID, output_format='ndjson')
+    pdf_json = get_an_object(oid=OID, output_format='json')
+
+    assert not pdf.empty
+
+    assert len(pdf) == len(pdf_json), (len(pdf), len(pdf_json))
+
+def test_single_object_arrow() -> None:
+    """
+    Examples
+    ---------
+    >>> test_single_object_arrow()
+    """
+    pdf = get_an_object(oid=OID, output_format='arrow')
+    pdf_json = get_an_object(oid=OID, output_format='json')
+
+    assert not pdf.empty
+
+    assert len(pdf) == len(pdf_json), (len(pdf), len(pdf_json))
+    assert np.allclose(pdf['i:jd'].values, pdf_json['i:jd'].values)
+
 def test_column_selection() -> None:
     """
     Examples
@@ -175,6 +209,106 @@ def test_multiple_objects() -> None:
     assert n_oids == n_oids_single, '{} is not equal to {}'.format(n_oids, n_oids_single)
     assert len_object == len(pdf), '{} is not equal to {}'.format(len_object, len(pdf))
 
+def test_scan_timings() -> None:
+    """
+    Examples
+    ---------
+    >>> test_scan_timings()
+    """
+    r = requests.post(
+        '{}/api/v1/objects'.format(APIURL),
+        json={
+            'objectId': 'ZTF21abfmbix,ZTF21aaxtctv,ZTF21abfaohe',
+            'columns': 'i:objectId,i:jd'
+        }
+    )
+
+    assert 'Server-Timing' in r.headers
+    assert 'keys' in r.headers['Server-Timing'], r.headers['Server-Timing']
+
+def test_constellation() -> None:
+    """
+    Examples
+    ---------
+    >>> test_constellation()
+    """
+    pdf = get_an_object(oid='ZTF21abfmbix,ZTF21aaxtctv,ZTF21abfaohe')
+
+    assert 'v:constellation' in pdf.columns
+
+    expected = get_constellation(
+        SkyCoord(pdf['i:ra'].values, pdf['i:dec'].values, unit='deg')
+    )
+    assert np.all(pdf['v:constellation'].values == expected), pdf['v:constellation'].values
+
+def test_derived_columns() -> None:
+    """
+    Examples
+    ---------
+    >>> test_derived_columns()
+    """
+    pdf = get_an_object(oid=OID, columns='i:jd,v:classification,v:lapse')
+
+    assert not pdf.empty
+
+    assert sorted(pdf.columns) == ['i:jd', 'v:classification', 'v:lapse'], pdf.columns
+
+    # same values as when all columns are requested
+    pdf_all = get_an_object(oid=OID)
+    assert np.all(pdf['v:classification'].values == pdf_all['v:classification'].values)
+    assert np.allclose(pdf['v:lapse'].values, pdf_all['v:lapse'].values)
+
+def test_cache() -> None:
+    """
+    Examples
+    ---------
+    >>> test_cache()
+    """
+    payload = {'objectId': OID, 'columns': 'i:objectId,i:jd,i:magpsf'}
+
+    # Each server process has its own cache: repeat until one serves it
+    status = []
+    for _ in range(20):
+        r = requests.post('{}/api/v1/objects'.format(APIURL), json=payload)
+        assert r.headers['X-Cache'] in ['HIT', 'MISS', 'STALE'], r.headers['X-Cache']
+        status.append(r.headers['X-Cache'])
+
+    assert 'HIT' in status, status
+
+    r = requests.get('{}/api/v1/cache'.format(APIURL))
+    report = r.json()['objects']
+    assert report['hits'] + report['misses'] + report['stale'] > 0, report
+
+def test_etag() -> None:
+    """
+    Examples
+    ---------
+    >>> test_etag()
+    """
+    payload = {'objectId': OID, 'columns': 'i:objectId,i:jd'}
+
+    r = requests.post('{}/api/v1/objects'.format(APIURL), json=payload)
+    assert r.status_code == 200
+    assert 'ETag' in r.headers, r.headers
+
+    # Same request: not modified
+    r2 = requests.post(
+        '{}/api/v1/objects'.format(APIURL),
+        json=payload,
+        headers={'If-None-Match': r.headers['ETag']}
+    )
+    assert r2.status_code == 304, r2.status_code
+    assert len(r2.content) == 0
+
+    # Other columns: other tag
+    payload['columns'] = 'i:objectId,i:jd,i:magpsf'
+    r3 = requests.post(
+        '{}/api/v1/objects'.format(APIURL),
+        json=payload,
+        headers={'If-None-Match': r.headers['ETag']}
+    )
+    assert r3.status_code == 200, r3.status_code
+
 
 if __name__ == "__main__":
     """ Execute the test suite """
@@ -152,6 +152,24 @@ def test_with_ephem_multiple_ssosearch() -> None:
     m2 = pdf['i:ssnamenr'] == 1922
     assert len(pdf[m2].values) == len(pdf2.values), (pdf[m2].values, pdf2.values)
 
+def test_etag() -> None:
+    """
+    Examples
+    ---------
+    >>> test_etag()
+    """
+    payload = {'n_or_d': '8467', 'columns': 'i:objectId,i:jd'}
+
+    r = requests.post('{}/api/v1/sso'.format(APIURL), json=payload)
+    assert 'ETag' in r.headers, r.headers
+
+    r2 = requests.post(
+        '{}/api/v1/sso'.format(APIURL),
+        json=payload,
+        headers={'If-None-Match': r.headers['ETag']}
+    )
+    assert r2.status_code == 304, r2.status_code
+
 
 if __name__ == "__main__":
     """ Execute the test suite """
@@ -52,6 +52,68 @@ def test_xmatch() -> None:
 
     assert pdf['ID'].values[0] == 'AnObjectMatching'
 
+def xmatchtest_upload(catalog='mycatalog.csv', header='RA,Dec,ID,Time', radius=1.5, window=7, output_format='csv'):
+    """ Perform a xmatch search with a catalog uploaded as a file
+    """
+    r = requests.post(
+        '{}/api/v1/xmatch'.format(APIURL),
+        files={'catalog': open(catalog, 'rb')},
+        data={
+            'header': header,
+            'radius': radius,
+            'window': window,
+            'output-format': output_format
+        }
+    )
+
+    assert r.status_code == 200, r.content
+
+    if output_format == 'csv':
+        pdf = pd.read_csv(io.BytesIO(r.content))
+    else:
+        pdf = pd.read_json(io.BytesIO(r.content), lines=(output_format == 'ndjson'))
+
+    return pdf
+
+def test_xmatch_upload() -> None:
+    """
+    Examples
+    ---------
+    >>> test_xmatch_upload()
+    """
+    pdf_json = xmatchtest()
+
+    for output_format in ['csv', 'ndjson', 'json']:
+        pdf = xmatchtest_upload(output_format=output_format)
+
+        assert len(pdf) == 1, (output_format, len(pdf))
+
+        assert pdf['ID'].values[0] == 'AnObjectMatching'
+
+        assert pdf['i:objectId'].values[0] == pdf_json['i:objectId'].values[0]
+
+def test_xmatch_upload_parquet() -> None:
+    """
+    Examples
+    ---------
+    >>> test_xmatch_upload_parquet()
+    """
+    f = io.BytesIO()
+    pd.read_csv('mycatalog.csv').to_parquet(f)
+    f.seek(0)
+
+    r = requests.post(
+        '{}/api/v1/xmatch'.format(APIURL),
+        files={'catalog': ('mycatalog.parquet', f)},
+        data={'header': 'RA,Dec,ID,Time', 'radius': 1.5, 'window': 7, 'output-format': 'csv'}
+    )
+
+    pdf = pd.read_csv(io.BytesIO(r.content))
+
+    assert len(pdf) == 1, len(pdf)
+
+    assert pdf['ID'].values[0] == 'AnObjectMatching'
+
 
 if __name__ == "__main__":
     """ Execute the test suite """